@@ -8,6 +8,7 @@ import matplotlib.cm as cm
 import matplotlib.colors as colors
 import numpy as np
 import extract_data
+import pedestal
 import os
 import array
 from scipy import optimize
@@ -199,12 +200,13 @@ def setup_trigger_6_tile():
 
     return (fig_average, average_plot, average_colorbar)
 
-def create_trigger_6_tile(lpd_data, position,  average_plot, average_colourbar, metadata): 
- 
-    trigger_gap = extract_data.get_num_images_per_train(metadata)
-
-    # Create image for the 6th trigger
-    tile_data = lpd_data[:, 32:64, 0:128]
-    average_plot.imshow(tile_data[5], cmap='jet', vmin=0, vmax=4096)
+def create_trigger_6_tile(lpd_data, position,  average_plot, average_colourbar, metadata, trigger=5): 
+    ''' Plot the tile at position from the image of the 6th trigger (or another trigger, counting
+        from 0) of the first train
+    '''
+    # Create image for the trigger - only that image's tile is read from lpd_data
+    tile_data = extract_data.get_single_tile(lpd_data, position, trigger)
+    tile_data = pedestal.subtract_pedestal(tile_data, position)
+    average_plot.imshow(tile_data, cmap='jet', vmin=0, vmax=4096)
     colorbar_type = 0 
-    display_data_plot(average_plot, tile_data[5], average_colourbar, colorbar_type)
\ No newline at end of file
+    display_data_plot(average_plot, tile_data, average_colourbar, colorbar_type)
\ No newline at end of file
@@ -0,0 +1,126 @@
+''' Runs the complete analysis of a single tile, or of every tile in a supermodule at once
+'''
+
+import numpy as np
+
+import extract_data
+import fault_tiles
+import instrumentation
+import pedestal
+import test_data
+import test_results
+
+# Tiles of a supermodule, in the order they're stacked in supermodule results
+TILE_ORIENTATIONS = ('Left Tile', 'Right Tile')
+MINI_CONNECTORS = range(1, 9)
+
+
+def get_supermodule_tiles():
+    ''' Returns a list of (tile_orientation, mini_connector) for each of the 16 tiles of a
+        supermodule - ordered by mini connector, then left before right
+    '''
+    return [(tile_orientation, mini_connector) for mini_connector in MINI_CONNECTORS
+            for tile_orientation in TILE_ORIENTATIONS]
+
+
+def get_supermodule_tile_positions():
+    ''' Returns the tile position of each tile in get_supermodule_tiles()
+    '''
+    return [extract_data.set_tile_position(tile_orientation, mini_connector)
+            for tile_orientation, mini_connector in get_supermodule_tiles()]
+
+
+def get_tile_index(tile_position):
+    ''' Returns the index of the tile at tile_position in get_supermodule_tiles()
+    '''
+    return get_supermodule_tile_positions().index(list(tile_position))
+
+
+def get_supermodule_tile_names():
+    ''' Returns the name of each tile in get_supermodule_tiles(), as shown in reports
+    '''
+    return ['{}, Mini Connector {}'.format(tile_orientation, mini_connector)
+            for tile_orientation, mini_connector in get_supermodule_tiles()]
+
+
+def get_tile_name(tile_position):
+    ''' Returns the name of the tile at tile_position, as shown in reports
+    '''
+    return get_supermodule_tile_names()[get_tile_index(tile_position)]
+
+
+def get_tile_stack(image, tile_positions):
+    ''' Cut each tile at tile_positions out of a full image, returning a stack of tiles
+        (number of tiles, 32, 128)
+    '''
+    return np.stack([image[position[0]:position[0] + 32, position[1]:position[1] + 128]
+                     for position in tile_positions])
+
+
+def test_tile(mean_tile, stdev_tile, fault_tile=None, tile=None):
+    ''' Run all tests on a tile, mean data tests first then standard deviation tests. A stack of
+        tiles (number of tiles, 32, 128) can be tested in one go
+        tile - which tile(s) of the supermodule are tested, so the thresholds of a threshold map can
+            be used (see test_data.get_thresholds())
+        Returns the fault tile and the results table in the layout of collate_results() - for a
+        stack of tiles the table is an array (number of tiles, 7, 3)
+    '''
+    if fault_tile is None:
+        fault_tile = fault_tiles.create_fault_tile(mean_tile.shape)
+
+    bad_chips_mean = test_data.bad_chips(mean_tile, fault_tile, 1, tile)
+    bad_cols_mean = test_data.bad_columns(mean_tile, fault_tile, 1, tile)
+    bad_pixels_mean = test_data.bad_pixels(mean_tile, fault_tile, 1, tile)
+
+    bad_chips_stdev = test_data.bad_chips(stdev_tile, fault_tile, 2, tile)
+    bad_cols_stdev = test_data.bad_columns(stdev_tile, fault_tile, 2, tile)
+    bad_pixels_stdev = test_data.bad_pixels(stdev_tile, fault_tile, 2, tile)
+
+    table_values = test_results.collate_results(bad_chips_mean, bad_chips_stdev, bad_cols_mean,
+                                                bad_cols_stdev, bad_pixels_mean, bad_pixels_stdev)
+    if mean_tile.ndim > 2:
+        # Each value in the table is an array of counts with a value for each tile
+        table_values = np.moveaxis(np.array(table_values, dtype=np.int16), -1, 0)
+
+    return (fault_tile, table_values)
+
+
+def analyse_tile(lpd_data, tile_position, memory_limit=extract_data.MEMORY_LIMIT, progress=None):
+    ''' Analyse a single tile of lpd_data, reading only that tile from the file. The pedestal of
+        the registered dark run (if any) is subtracted from the mean
+        progress - see extract_data.get_pixel_statistics()
+        Returns the mean, stdev and fault tiles and the results table
+    '''
+    with instrumentation.tag(tile=get_tile_name(tile_position)):
+        with instrumentation.stage('extract'):
+            tile_statistics = extract_data.get_pixel_statistics(lpd_data, tile_position,
+                                                                memory_limit, progress)
+            mean_tile = pedestal.subtract_pedestal(tile_statistics.mean(), tile_position)
+            stdev_tile = tile_statistics.stdev()
+        with instrumentation.stage('tests'):
+            fault_tile, table_values = test_tile(mean_tile, stdev_tile,
+                                                 tile=get_tile_index(tile_position))
+
+    return (mean_tile, stdev_tile, fault_tile, table_values)
+
+
+def analyse_supermodule(lpd_data, memory_limit=extract_data.MEMORY_LIMIT, progress=None):
+    ''' Analyse all 16 tiles of a supermodule from one pass over lpd_data
+        progress - see extract_data.get_pixel_statistics()
+        Returns stacks of the mean, stdev and fault tiles (16, 32, 128) and of the results tables
+        (16, 7, 3), with tiles in the order of get_supermodule_tiles(). The values for each tile are
+        identical to those from analyse_tile()
+    '''
+    with instrumentation.tag(tile='All tiles'):
+        with instrumentation.stage('extract'):
+            image_statistics = extract_data.get_pixel_statistics(lpd_data,
+                                                                 memory_limit=memory_limit,
+                                                                 progress=progress)
+            tile_positions = get_supermodule_tile_positions()
+            mean_tiles = get_tile_stack(pedestal.subtract_pedestal(image_statistics.mean()),
+                                        tile_positions)
+            stdev_tiles = get_tile_stack(image_statistics.stdev(), tile_positions)
+        with instrumentation.stage('tests'):
+            fault_tiles, results = test_tile(mean_tiles, stdev_tiles, tile=slice(None))
+
+    return (mean_tiles, stdev_tiles, fault_tiles, results)
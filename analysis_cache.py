@@ -0,0 +1,170 @@
+''' On-disk cache of analysis results, so a file that's analysed again (e.g. reopened in the notebook
+    or when regenerating a report) doesn't need any of its data read again
+'''
+
+import hashlib
+import os
+
+import numpy as np
+
+import analysis
+import extract_data
+import instrumentation
+import pedestal
+import test_data
+import threshold_maps
+
+# Default directory of cached results and the total size they're limited to (bytes)
+CACHE_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'lpd_tile_testing', 'analysis')
+CACHE_SIZE_LIMIT = 1024 * 1024 * 1024
+
+# Modules whose code determines the results of an analysis - editing any of them invalidates
+# everything in the cache
+ANALYSIS_MODULES = ('analysis', 'extract_data', 'pixel_statistics', 'test_data', 'fault_tiles',
+                    'test_results', 'threshold_maps', 'pedestal')
+
+# Arrays stored in each cache file, in the order they're returned by analysis functions
+RESULT_NAMES = ('mean', 'stdev', 'faults', 'results')
+
+_code_version = None
+
+
+def get_code_version():
+    ''' Returns a hash of the source of the analysis modules, calculated once per session
+    '''
+    global _code_version
+    if _code_version is None:
+        _code_version = get_source_hash(ANALYSIS_MODULES)
+    return _code_version
+
+
+def get_source_hash(modules):
+    ''' Returns a hash of the source of the given modules of this package
+    '''
+    code_hash = hashlib.sha1()
+    module_path = os.path.dirname(os.path.abspath(__file__))
+    for module in modules:
+        with open(os.path.join(module_path, '{}.py'.format(module)), 'rb') as source:
+            code_hash.update(source.read())
+    return code_hash.hexdigest()
+
+
+def get_cache_key(filename, tile_position=None):
+    ''' Returns the key results are cached under: a hash of the data file's path, size and
+        modification time, the tile analysed (None for a supermodule), the thresholds used (including
+        any threshold maps), the pedestal subtracted and the version of the analysis code. Any of
+        these changing gives a different key
+    '''
+    file_stat = os.stat(filename)
+    if tile_position is not None:
+        tile_position = tuple(tile_position)
+
+    key_values = (os.path.abspath(filename), file_stat.st_size, file_stat.st_mtime_ns,
+                  tile_position, test_data.get_thresholds(1), test_data.get_thresholds(2),
+                  threshold_maps.get_map_version(),
+                  pedestal.get_pedestal_version(), get_code_version())
+    return hashlib.sha1(repr(key_values).encode()).hexdigest()
+
+
+def get_cache_filename(key, cache_path=CACHE_PATH):
+    ''' Returns the path of the file results with the given key are cached in
+    '''
+    return os.path.join(cache_path, '{}.npz'.format(key))
+
+
+def load_results(key, cache_path=CACHE_PATH):
+    ''' Returns the cached results for key as a tuple of (mean, stdev, fault, results table) arrays,
+        or None if they aren't in the cache
+    '''
+    cache_filename = get_cache_filename(key, cache_path)
+    try:
+        with np.load(cache_filename) as cached_results:
+            results = tuple(cached_results[name] for name in RESULT_NAMES)
+        # Mark the results as recently used so they're the last to be evicted
+        os.utime(cache_filename)
+    except (OSError, KeyError, ValueError):
+        # Not cached, removed by another process or incomplete
+        return None
+    return results
+
+
+def save_results(key, results, cache_path=CACHE_PATH, size_limit=CACHE_SIZE_LIMIT):
+    ''' Cache a tuple of (mean, stdev, fault, results table) arrays under key, evicting the least
+        recently used results if the cache grows larger than size_limit
+    '''
+    os.makedirs(cache_path, exist_ok=True)
+    cache_filename = get_cache_filename(key, cache_path)
+
+    # Written to a temporary file first so other processes never see a partial file
+    temp_filename = '{}.{}.tmp'.format(cache_filename, os.getpid())
+    with open(temp_filename, 'wb') as temp_file:
+        np.savez(temp_file, **dict(zip(RESULT_NAMES, results)))
+    os.replace(temp_filename, cache_filename)
+
+    evict_results(cache_path, size_limit)
+
+
+def evict_results(cache_path=CACHE_PATH, size_limit=CACHE_SIZE_LIMIT, extension='.npz'):
+    ''' Delete the least recently used results until the cache is no larger than size_limit
+        extension - type of file cached, so other caches can be managed the same way
+    '''
+    cache_files = []
+    for entry in os.scandir(cache_path):
+        if entry.name.endswith(extension):
+            try:
+                entry_stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            cache_files.append((entry_stat.st_mtime, entry_stat.st_size, entry.path))
+
+    cache_size = sum(size for _, size, _ in cache_files)
+    for _, size, path in sorted(cache_files):
+        if cache_size <= size_limit:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        cache_size -= size
+
+
+def clear_cache(cache_path=CACHE_PATH):
+    ''' Delete all cached results
+    '''
+    evict_results(cache_path, 0)
+
+
+def analyse_tile(filename, tile_position, memory_limit=extract_data.MEMORY_LIMIT,
+                 cache_path=CACHE_PATH, size_limit=CACHE_SIZE_LIMIT, progress=None):
+    ''' Cached version of analysis.analyse_tile() that takes the filename of the data file. The file
+        is only opened if the results aren't cached
+        progress - see extract_data.get_pixel_statistics(), only called if the file is read
+        Returns the mean, stdev and fault tiles and the results table as arrays
+    '''
+    with instrumentation.tag(file=os.path.basename(filename)):
+        with instrumentation.stage('load cached results'):
+            key = get_cache_key(filename, tile_position)
+            results = load_results(key, cache_path)
+        if results is None:
+            with extract_data.LPDFile(filename) as lpd_file:
+                mean_tile, stdev_tile, fault_tile, table_values = analysis.analyse_tile(
+                    lpd_file.dataset, tile_position, memory_limit, progress)
+            results = (mean_tile, stdev_tile, fault_tile, np.array(table_values, dtype=np.int16))
+            save_results(key, results, cache_path, size_limit)
+    return results
+
+
+def analyse_supermodule(filename, memory_limit=extract_data.MEMORY_LIMIT, cache_path=CACHE_PATH,
+                        size_limit=CACHE_SIZE_LIMIT, progress=None):
+    ''' Cached version of analysis.analyse_supermodule() that takes the filename of the data file
+        progress - see extract_data.get_pixel_statistics(), only called if the file is read
+    '''
+    with instrumentation.tag(file=os.path.basename(filename)):
+        with instrumentation.stage('load cached results'):
+            key = get_cache_key(filename)
+            results = load_results(key, cache_path)
+        if results is None:
+            with extract_data.LPDFile(filename) as lpd_file:
+                results = analysis.analyse_supermodule(lpd_file.dataset, memory_limit, progress)
+            save_results(key, results, cache_path, size_limit)
+    return results
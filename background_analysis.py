@@ -0,0 +1,220 @@
+''' Runs analyses in background threads, so the notebook's widgets stay responsive while a file is
+    read. Files can be prefetched when they're selected - every tile of the file is analysed from
+    one pass over it and the results kept in memory, so analysing any tile of a file that's been
+    browsed returns almost straight away. Prefetches have a lower priority than analyses - they're
+    paused while an analysis runs, so they never slow down the analysis asked for
+'''
+
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import analysis
+import analysis_cache
+import extract_data
+
+# Number of files whose prefetched results are kept in memory (around 1 MB each), the least
+# recently used being dropped first
+PREFETCH_CACHE_SIZE = 8
+
+# Seconds a file must stay selected before it's prefetched, so clicking through files doesn't
+# start reading each of them
+PREFETCH_DELAY = 1.0
+
+# Seconds between checks for cancellation while a prefetch is paused
+WAIT_INTERVAL = 0.1
+
+# Bytes of image data a prefetch reads at once - less than analyses, as a prefetch can only pause
+# between blocks, so an analysis started during a prefetch doesn't wait long for the disk
+PREFETCH_MEMORY_LIMIT = 32 * 1024 * 1024
+
+
+class AnalysisCancelled(Exception):
+    ''' Raised in the thread of an analysis or prefetch that's been cancelled
+    '''
+
+
+class BackgroundAnalyser():
+    ''' Analyses tiles of data files in a background thread, one at a time, and prefetches the
+        results of every tile of files in another
+    '''
+
+    def __init__(self, cache_size=PREFETCH_CACHE_SIZE, memory_limit=extract_data.MEMORY_LIMIT,
+                 prefetch_memory_limit=PREFETCH_MEMORY_LIMIT):
+        self.cache_size = cache_size
+        self.memory_limit = memory_limit
+        self.prefetch_memory_limit = prefetch_memory_limit
+        self._analysis_executor = ThreadPoolExecutor(max_workers=1)
+        self._prefetch_executor = ThreadPoolExecutor(max_workers=1)
+        # Reentrant, as cancelling a prefetch runs its done callback straight away
+        self._lock = threading.RLock()
+        # Results of analyse_supermodule() of each prefetched file, least recently used first - keyed
+        # as analysis_cache, so results aren't used once the file, thresholds or pedestal change
+        self._results = OrderedDict()
+        # (future, cancel event) of each prefetch which hasn't finished
+        self._prefetches = {}
+        self._analysis = None
+        self._cancel_analysis = threading.Event()
+        # Number of analyses waiting or running, and an event set when there are none - prefetches
+        # only read data while it's set
+        self._num_analyses = 0
+        self._analyses_idle = threading.Event()
+        self._analyses_idle.set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+
+    def shutdown(self):
+        ''' Cancel everything running or waiting and stop the background threads
+        '''
+        self.cancel()
+        with self._lock:
+            for future, cancel_event in list(self._prefetches.values()):
+                future.cancel()
+                cancel_event.set()
+        self._analysis_executor.shutdown(wait=True)
+        self._prefetch_executor.shutdown(wait=True)
+
+    def get_cached_results(self, filename):
+        ''' Returns the prefetched results of every tile of a file (as
+            analysis.analyse_supermodule()), or None if results for the file as it is now, with the
+            current thresholds and pedestal, aren't in memory
+        '''
+        key = analysis_cache.get_cache_key(filename)
+        with self._lock:
+            results = self._results.get(key)
+            if results is not None:
+                self._results.move_to_end(key)
+        return results
+
+    def cache_results(self, key, results):
+        ''' Keep the results of every tile of a file in memory under their key (see
+            analysis_cache.get_cache_key()), dropping the least recently used results if more than
+            cache_size files are kept
+        '''
+        with self._lock:
+            self._results[key] = results
+            self._results.move_to_end(key)
+            while len(self._results) > self.cache_size:
+                self._results.popitem(last=False)
+
+    def prefetch(self, filename):
+        ''' Start analysing every tile of a file in the background, unless its results are already
+            in memory or being prefetched. Prefetches of other files which haven't started are
+            cancelled, and one that's running is stopped, as only the file selected last is needed
+        '''
+        try:
+            key = analysis_cache.get_cache_key(filename)
+        except OSError:
+            # File can't be read - left for an analysis of it to report
+            return
+
+        with self._lock:
+            if key in self._results or filename in self._prefetches:
+                return
+            for future, cancel_event in list(self._prefetches.values()):
+                future.cancel()
+                cancel_event.set()
+
+            cancel_event = threading.Event()
+            future = self._prefetch_executor.submit(self._prefetch, filename, key, cancel_event)
+            self._prefetches[filename] = (future, cancel_event)
+        future.add_done_callback(lambda _: self._prefetch_finished(filename, future))
+
+    def _prefetch(self, filename, key, cancel_event):
+        ''' Analyse every tile of a file, storing the results in memory under key. Reading starts
+            once the file has been selected for PREFETCH_DELAY, and pauses between blocks of images
+            while an analysis is running
+        '''
+        if cancel_event.wait(PREFETCH_DELAY):
+            raise AnalysisCancelled()
+        self._wait_for_analyses(cancel_event)
+
+        def update_progress(images_read, num_images):
+            self._wait_for_analyses(cancel_event)
+
+        results = analysis_cache.analyse_supermodule(filename, self.prefetch_memory_limit,
+                                                     progress=update_progress)
+        self.cache_results(key, results)
+        return results
+
+    def _wait_for_analyses(self, cancel_event):
+        ''' Wait until no analyses are waiting or running
+            Raises AnalysisCancelled if the prefetch is cancelled while waiting
+        '''
+        while not self._analyses_idle.wait(WAIT_INTERVAL):
+            if cancel_event.is_set():
+                raise AnalysisCancelled()
+        if cancel_event.is_set():
+            raise AnalysisCancelled()
+
+    def _prefetch_finished(self, filename, future):
+        ''' Forget a prefetch once it's finished, been cancelled or failed
+        '''
+        with self._lock:
+            if self._prefetches.get(filename, (None, ))[0] is future:
+                del self._prefetches[filename]
+
+    def analyse(self, filename, tile_position, progress=None):
+        ''' Start analysing a tile of a file in the background. Any analysis already running is
+            cancelled
+            progress - function called from the background thread with the fraction of the
+                analysis done (0 - 1)
+            Returns a Future of the mean, stdev and fault tiles and results table, as
+            analysis_cache.analyse_tile(). Its result raises AnalysisCancelled if cancel() is called
+            before it finishes
+        '''
+        self.cancel()
+        with self._lock:
+            # Prefetches pause from now until the analysis is done
+            self._num_analyses += 1
+            self._analyses_idle.clear()
+        self._cancel_analysis = threading.Event()
+        self._analysis = self._analysis_executor.submit(self._analyse, filename, tile_position,
+                                                        progress, self._cancel_analysis)
+        self._analysis.add_done_callback(self._analysis_finished)
+        return self._analysis
+
+    def _analysis_finished(self, future):
+        ''' Let prefetches carry on once no analyses are waiting or running
+        '''
+        with self._lock:
+            self._num_analyses -= 1
+            if self._num_analyses == 0:
+                self._analyses_idle.set()
+
+    def _analyse(self, filename, tile_position, progress, cancel_event):
+        ''' Analyse a tile - from prefetched results if there are any, otherwise reading only the
+            tile from the file. A prefetch of the file that hasn't finished is paused rather than
+            waited for, as reading one tile is quicker than reading every tile
+        '''
+        def update_progress(images_read, num_images):
+            if cancel_event.is_set():
+                raise AnalysisCancelled()
+            if progress is not None:
+                progress(images_read / num_images)
+
+        results = self.get_cached_results(filename)
+        if results is None:
+            return analysis_cache.analyse_tile(filename, tile_position, self.memory_limit,
+                                               progress=update_progress)
+
+        tile = analysis.get_tile_index(tile_position)
+        if progress is not None:
+            progress(1.0)
+        return tuple(tile_results[tile] for tile_results in results)
+
+    def cancel(self):
+        ''' Cancel the analysis started by analyse(), if it hasn't finished
+        '''
+        self._cancel_analysis.set()
+        if self._analysis is not None:
+            self._analysis.cancel()
+
+    def is_running(self):
+        ''' Returns whether an analysis started by analyse() is waiting or running
+        '''
+        return self._analysis is not None and not self._analysis.done()
@@ -0,0 +1,238 @@
+''' Analyses every LPD data file in a directory without the notebook, spreading files across a pool
+    of processes. Run as a script - see --help for the options
+'''
+
+import matplotlib
+# Figures are only ever saved to file, so no display is needed
+matplotlib.use('Agg')
+
+import argparse
+import csv
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+
+import numpy as np
+
+import analysis
+import analysis_cache
+import extract_data
+import fault_tiles
+import file_catalog
+import pedestal
+import report_pages
+import test_results
+import threshold_maps
+import trend_store
+
+# Same date format as the notebook's date range slider
+DATE_FORMAT = '%d/%m/%Y'
+
+
+def get_results_filename(output_path, filename):
+    ''' Returns the path of the file the results of analysing filename are saved to
+    '''
+    return os.path.join(output_path, '{}_results.npz'.format(filename.split('.')[0]))
+
+
+def analyse_file(data_path, filename, output_path, memory_limit=extract_data.MEMORY_LIMIT):
+    ''' Analyse every tile of the supermodule in a data file, saving the mean, stdev and fault tiles
+        and results tables to an .npz file in output_path, with the format version of the fault
+        tiles
+        Returns the results tables (16, 7, 3)
+    '''
+    # Paths of data files are formed by appending the filename to data_path
+    data_path = os.path.join(data_path, '')
+    lpd_file_name = extract_data.get_lpd_filename(data_path, filename)
+    # Results are only calculated if they aren't already cached
+    mean_tiles, stdev_tiles, fault_stack, results = analysis_cache.analyse_supermodule(
+        lpd_file_name, memory_limit)
+    np.savez(get_results_filename(output_path, filename), mean_tiles=mean_tiles,
+             stdev_tiles=stdev_tiles, fault_tiles=fault_stack, results=results,
+             fault_format_version=fault_tiles.FAULT_FORMAT_VERSION)
+
+    return results
+
+
+def load_results(output_path, filename):
+    ''' Returns the mean, stdev and fault tiles and results tables saved by analyse_file(). Fault
+        tiles saved in an earlier format are converted to the current one
+    '''
+    with np.load(get_results_filename(output_path, filename)) as results:
+        # Files saved before the format was versioned are version 1
+        format_version = 1
+        if 'fault_format_version' in results.files:
+            format_version = int(results['fault_format_version'])
+        return (results['mean_tiles'], results['stdev_tiles'],
+                fault_tiles.convert_fault_tile(results['fault_tiles'], format_version),
+                results['results'])
+
+
+def store_trends(trends_filename, data_path, output_path, file_list):
+    ''' Add the saved results of each file in file_list to a trend store
+    '''
+    data_path = os.path.join(data_path, '')
+    with trend_store.TrendStore(trends_filename) as store:
+        for filename in file_list:
+            store.add_file(extract_data.get_lpd_filename(data_path, filename),
+                           load_results(output_path, filename))
+
+
+def initialise_worker(threshold_filename=None, dark_file_name=None,
+                      pedestal_threshold_filename=None):
+    ''' Initialiser of worker processes, so they use the same threshold maps and pedestal as the
+        main process. The pedestal is loaded from its cache rather than calculated again
+    '''
+    threshold_maps.load_threshold_map(threshold_filename)
+    threshold_maps.load_threshold_map(pedestal_threshold_filename, pedestal_subtracted=True)
+    pedestal.register_dark_run(dark_file_name)
+
+
+def write_summary(summary_filename, file_results):
+    ''' Write a CSV file with a row of results for each tile of each file analysed
+        file_results - list of (filename, results tables) tuples
+    '''
+    headers = ['File', 'Tile Orientation', 'Mini Connector']
+    # Test the rows are part of - none until the first total
+    test_name = ''
+    for row in test_results.RESULTS_ROWS:
+        if row.startswith(' '):
+            # Indented rows break down the total above them - name them after that test
+            row_name = '{} {}'.format(test_name, row.strip()).strip()
+        else:
+            test_name = row.replace(' Total', '')
+            row_name = row
+        headers.extend('{} - {}'.format(row_name, column)
+                       for column in test_results.RESULTS_COLUMNS)
+
+    with open(summary_filename, 'w', newline='') as summary_file:
+        writer = csv.writer(summary_file)
+        writer.writerow(headers)
+        for filename, results in file_results:
+            for tile, (tile_orientation, mini_connector) in \
+                    enumerate(analysis.get_supermodule_tiles()):
+                writer.writerow([filename, tile_orientation, mini_connector] +
+                                results[tile].flatten().tolist())
+
+
+def analyse_directory(data_path, output_path, start_date, end_date, create_report=False,
+                      max_workers=None, memory_limit=extract_data.MEMORY_LIMIT, cmd_seq_file=None,
+                      min_images=None, max_images=None, combined_report=False,
+                      threshold_filename=None, dark_file_name=None, trends_filename=None,
+                      pedestal_threshold_filename=None):
+    ''' Analyse all files in data_path modified between start_date and end_date in parallel, writing
+        the results of each file and a summary.csv of all of them to output_path. Files can also
+        be selected by command sequence file and number of images, using the file catalog
+        create_report - create a PDF report of each file analysed
+        combined_report - also create a single PDF report of all files analysed
+        threshold_filename - calibration file of per-pixel thresholds, the default thresholds are
+            used if not given
+        dark_file_name - dark run whose pedestal is subtracted from the mean of every file
+        pedestal_threshold_filename - calibration file of per-pixel thresholds used instead of
+            threshold_filename when a dark run is given
+        trends_filename - trend store the results of every file are added to, if given
+        Returns a list of (filename, error) for any files which couldn't be analysed or
+            reported on
+    '''
+    with file_catalog.FileCatalog(data_path) as catalog:
+        catalog.update()
+        file_list = catalog.query(start_date, end_date, cmd_seq_file, min_images, max_images)
+    os.makedirs(output_path, exist_ok=True)
+    # Pedestal is calculated once here, then shared with the workers through its cache
+    initialise_worker(threshold_filename, dark_file_name, pedestal_threshold_filename)
+
+    file_results = []
+    failed_files = []
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=initialise_worker,
+                             initargs=(threshold_filename, dark_file_name,
+                                       pedestal_threshold_filename)) as executor:
+        futures = {executor.submit(analyse_file, data_path, filename, output_path,
+                                   memory_limit): filename for filename in file_list}
+        for future in as_completed(futures):
+            filename = futures[future]
+            try:
+                file_results.append((filename, future.result()))
+                print('Analysed {}'.format(filename))
+            # Any error (including the pool breaking) only fails this file, so the summary of the
+            # other files is still written
+            except Exception as error:
+                failed_files.append((filename, error))
+                print('Could not analyse {}: {}'.format(filename, error))
+
+    # Keep the summary in the same order as the file list, most recent first
+    file_order = {filename: position for position, filename in enumerate(file_list)}
+    file_results.sort(key=lambda result: file_order[result[0]])
+    write_summary(os.path.join(output_path, 'summary.csv'), file_results)
+    if trends_filename is not None:
+        store_trends(trends_filename, data_path, output_path,
+                     [filename for filename, _ in file_results])
+
+    if create_report or combined_report:
+        # Pages of the reports are rendered in parallel and cached, so files reported on before
+        # aren't plotted again
+        analysed_files = [filename for filename, _ in file_results]
+        combined_filename = 'test_results_combined.pdf' if combined_report else None
+        _, failed_reports = report_pages.create_reports(data_path, analysed_files, output_path,
+                                                        max_workers, create_report,
+                                                        combined_filename,
+                                                        memory_limit=memory_limit)
+        failed_files.extend(failed_reports)
+
+    return failed_files
+
+
+def parse_args():
+    ''' Parse command line arguments
+    '''
+    parser = argparse.ArgumentParser(
+        description='Analyse all tiles of every LPD data file in a directory')
+    parser.add_argument('data_path', help='Directory containing the .h5 data files')
+    parser.add_argument('output_path', help='Directory the results and reports are saved to')
+    parser.add_argument('--start', default=None,
+                        help='Only analyse files modified from this date ({})'.format(
+                            DATE_FORMAT.replace('%', '%%')))
+    parser.add_argument('--end', default=None,
+                        help='Only analyse files modified up to this date ({})'.format(
+                            DATE_FORMAT.replace('%', '%%')))
+    parser.add_argument('--cmd-seq-file', default=None,
+                        help='Only analyse files taken with this command sequence file')
+    parser.add_argument('--min-images', type=int, default=None,
+                        help='Only analyse files with at least this many images')
+    parser.add_argument('--max-images', type=int, default=None,
+                        help='Only analyse files with at most this many images')
+    parser.add_argument('--thresholds', default=None,
+                        help='Calibration file (.npy) of per-pixel thresholds to test against')
+    parser.add_argument('--dark-run', default=None,
+                        help='Dark run (.h5) whose pedestal is subtracted from the mean data')
+    parser.add_argument('--pedestal-thresholds', default=None,
+                        help='Calibration file (.npy) of per-pixel thresholds to test against '
+                        'when a dark run is given')
+    parser.add_argument('--trends', nargs='?', const=trend_store.TREND_STORE_FILENAME,
+                        default=None, help='Add the results to a trend store (.h5), {} if no file '
+                        'is given'.format(trend_store.TREND_STORE_FILENAME))
+    parser.add_argument('--reports', action='store_true', help='Create a PDF report for each file')
+    parser.add_argument('--combined-report', action='store_true',
+                        help='Create a single PDF report of all files analysed')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Number of processes to use (default: number of CPUs)')
+    parser.add_argument('--memory-limit', type=int, default=extract_data.MEMORY_LIMIT,
+                        help='Maximum bytes of image data each process reads at once')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    start_date = datetime.min
+    end_date = datetime.now()
+    if args.start is not None:
+        start_date = datetime.strptime(args.start, DATE_FORMAT)
+    if args.end is not None:
+        end_date = datetime.strptime(args.end, DATE_FORMAT)
+
+    failed_files = analyse_directory(args.data_path, args.output_path, start_date, end_date,
+                                     args.reports, args.workers, args.memory_limit,
+                                     args.cmd_seq_file, args.min_images, args.max_images,
+                                     args.combined_report, args.thresholds, args.dark_run,
+                                     args.trends, args.pedestal_thresholds)
+    if failed_files:
+        raise SystemExit('{} file(s) could not be analysed'.format(len(failed_files)))
@@ -0,0 +1,277 @@
+''' Benchmarks for the analysis of LPD data. Run as a script to print the timings
+'''
+
+import argparse
+import os
+import tempfile
+import timeit
+
+import matplotlib.pyplot as plt
+import numpy as np
+
+import analysis
+import extract_data
+import fault_tiles
+import generate_report
+import histogram
+import synthetic_data
+import test_data
+import test_delaminated_pixels
+
+
+def loop_detect(tile_section):
+    ''' Per-pixel implementation of fault_tiles.detect() that the vectorised version replaced, kept
+        here to measure the speedup against
+    '''
+    pixel_fault_count = 0
+    for i in range(0, len(tile_section)):
+        for j in range(0, len(tile_section[i])):
+            if tile_section[i][j] != 0:
+                pixel_fault_count += 1
+    return not (pixel_fault_count / len(tile_section[0])) * 100 > 95
+
+
+def loop_bad_sections(tile_data, fault_tile, test_type, section_width):
+    ''' Loop implementation of test_data.bad_chips() and test_data.bad_columns()
+    '''
+    threshold = test_data.get_thresholds(test_type)
+    num_bad_sections = [0, 0]
+    for section in range(0, 128, section_width):
+        if loop_detect(fault_tile[:, section:section + section_width]):
+            section_mean = np.mean(tile_data[:, section:section + section_width])
+            if section_mean < threshold[0]:
+                num_bad_sections[0] += 1
+                fault_tile[:, section:section + section_width] = test_type
+            elif section_mean > threshold[1]:
+                num_bad_sections[1] += 1
+                fault_tile[:, section:section + section_width] = test_type
+    return num_bad_sections
+
+
+def loop_bad_pixels(tile_data, fault_tile, test_type):
+    ''' Loop implementation of test_data.bad_pixels()
+    '''
+    threshold = test_data.get_thresholds(test_type)
+    num_bad_pixels = [0, 0]
+    for i in range(0, len(tile_data)):
+        for j in range(0, len(tile_data[i])):
+            if fault_tile[i][j] == 0:
+                if tile_data[i][j] < threshold[0]:
+                    num_bad_pixels[0] += 1
+                    fault_tile[i, j] = test_type
+                elif tile_data[i][j] > threshold[1]:
+                    num_bad_pixels[1] += 1
+                    fault_tile[i, j] = test_type
+    return num_bad_pixels
+
+
+def loop_test_tile(mean_tile, stdev_tile, fault_tile):
+    ''' All tests on a tile, in the same order as the notebook, using the loop implementations
+    '''
+    for tile_data, test_type in ((mean_tile, 1), (stdev_tile, 2)):
+        loop_bad_sections(tile_data, fault_tile, test_type, 16)
+        loop_bad_sections(tile_data, fault_tile, test_type, 1)
+        loop_bad_pixels(tile_data, fault_tile, test_type)
+
+
+def vectorised_test_tile(mean_tile, stdev_tile, fault_tile):
+    ''' All tests on a tile (or stack of tiles), in the same order as the notebook
+    '''
+    for tile_data, test_type in ((mean_tile, 1), (stdev_tile, 2)):
+        test_data.bad_chips(tile_data, fault_tile, test_type)
+        test_data.bad_columns(tile_data, fault_tile, test_type)
+        test_data.bad_pixels(tile_data, fault_tile, test_type)
+
+
+def create_test_tiles(num_tiles=16, seed=0):
+    ''' Create a stack of mean & stdev tiles with a few bad chips, columns and pixels in each
+    '''
+    rng = np.random.RandomState(seed)
+    mean_tiles = rng.normal(3400, 100, (num_tiles, 32, 128))
+    stdev_tiles = rng.normal(25, 5, (num_tiles, 32, 128))
+    for tile in range(num_tiles):
+        chip = rng.randint(8) * 16
+        mean_tiles[tile, :, chip:chip + 16] = 100
+        mean_tiles[tile, :, rng.randint(128)] = 4000
+        stdev_tiles[tile, rng.randint(32, size=10), rng.randint(128, size=10)] = 80
+    return mean_tiles, stdev_tiles
+
+
+def time_function(function, repeat=5):
+    ''' Return the best time in seconds of function() over a number of runs
+    '''
+    return min(timeit.repeat(function, number=1, repeat=repeat))
+
+
+def benchmark_fault_detection():
+    ''' Time the fault detection tests per tile and per supermodule (16 tiles), comparing the loop
+        implementations with the vectorised ones
+    '''
+    mean_tiles, stdev_tiles = create_test_tiles()
+
+    def run_tests(test_function, num_tiles):
+        for tile in range(num_tiles):
+            test_function(mean_tiles[tile], stdev_tiles[tile], fault_tiles.create_fault_tile())
+
+    def run_stack():
+        vectorised_test_tile(mean_tiles, stdev_tiles, fault_tiles.create_fault_tile((16, 32, 128)))
+
+    tile_results = [
+        ('Loops', time_function(lambda: run_tests(loop_test_tile, 1))),
+        ('Vectorised', time_function(lambda: run_tests(vectorised_test_tile, 1))),
+    ]
+    supermodule_results = [
+        ('Loops', time_function(lambda: run_tests(loop_test_tile, 16))),
+        ('Vectorised, one tile at a time', time_function(lambda: run_tests(vectorised_test_tile,
+                                                                           16))),
+        ('Vectorised, stack of 16 tiles', time_function(run_stack)),
+    ]
+    return tile_results, supermodule_results
+
+
+def benchmark_histograms(num_images=100, seed=0):
+    ''' Time a histogram of the raw values of a block of full images, binning with np.histogram
+        compared with counting values with histogram.Histogram
+    '''
+    rng = np.random.RandomState(seed)
+    images = rng.randint(0, histogram.NUM_VALUES, (num_images, 256, 256)).astype(np.uint16)
+    bin_edges = np.arange(histogram.NUM_VALUES + 1) - 0.5
+
+    def run_bincount():
+        histogram.Histogram().add(images)
+
+    return [
+        ('np.histogram', time_function(lambda: np.histogram(images, bins=bin_edges))),
+        ('Counting values (bincount)', time_function(run_bincount)),
+    ]
+
+
+def benchmark_delamination(seed=0):
+    ''' Time the delamination test of every tile of full mean and stdev images, compared with
+        finding the local medians of a single tile at a time
+    '''
+    rng = np.random.RandomState(seed)
+    mean_image = rng.normal(3400, 30, (256, 256))
+    stdev_image = rng.normal(25, 2, (256, 256))
+    tiles = test_delaminated_pixels.split_tiles(mean_image)
+
+    def run_tiles():
+        for tile in tiles:
+            test_delaminated_pixels.get_local_medians(tile)
+
+    return [
+        ('Local medians, one tile at a time', time_function(run_tiles)),
+        ('Local medians, stack of 16 tiles',
+         time_function(lambda: test_delaminated_pixels.get_local_medians(tiles))),
+        ('Mean & stdev tests, full images', time_function(
+            lambda: test_delaminated_pixels.delaminated_image_pixels(mean_image, stdev_image))),
+    ]
+
+
+def benchmark_file_sizes(train_counts=(10, 100, 1000), images_per_train=10, layout='data',
+                         repeat=3):
+    ''' Time each stage of analysing a tile - extracting statistics from the file, the tests,
+        plotting the report's figures and exporting them - on synthetic files of several sizes, so
+        regressions in any stage show up. Files are read just after they're written, so are likely
+        to be in the page cache
+        Returns a list of (description of file, results) for each number of trains
+    '''
+    tile_orientation, mini_connector = ('Left Tile', 1)
+    tile_name = '{}, Mini Connector {}'.format(tile_orientation, mini_connector)
+    tile_position = extract_data.set_tile_position(tile_orientation, mini_connector)
+    tile = analysis.get_tile_index(tile_position)
+
+    size_results = []
+    with tempfile.TemporaryDirectory() as data_path:
+        for num_trains in train_counts:
+            filename = 'synthetic_{}.h5'.format(num_trains)
+            lpd_file_name = os.path.join(data_path, filename)
+            synthetic_data.write_lpd_file(lpd_file_name, num_trains, images_per_train, layout)
+            file_size = os.path.getsize(lpd_file_name)
+
+            with extract_data.LPDFile(lpd_file_name) as lpd_file:
+                lpd_data = lpd_file.dataset
+                mean_tile, stdev_tile, fault_tile, table_values = \
+                    analysis.analyse_tile(lpd_data, tile_position)
+                mean_tiles, stdev_tiles, _, _ = analysis.analyse_supermodule(lpd_data)
+                tile_results = (mean_tile, stdev_tile, fault_tile, table_values)
+
+                def create_figures():
+                    return generate_report.create_tile_figures(*tile_results, tile_name, filename,
+                                                               data_path, lpd_file)
+
+                def run_plotting():
+                    fig_list = create_figures()
+                    for figure in fig_list:
+                        figure.canvas.draw()
+                    generate_report.close_figures(fig_list)
+
+                fig_list = create_figures()
+                results = [
+                    ('Extract tile statistics', time_function(
+                        lambda: extract_data.get_pixel_statistics(lpd_data, tile_position),
+                        repeat)),
+                    ('Extract supermodule statistics', time_function(
+                        lambda: extract_data.get_pixel_statistics(lpd_data), repeat)),
+                    ('Tests - single tile', time_function(
+                        lambda: analysis.test_tile(mean_tile, stdev_tile, tile=tile), repeat)),
+                    ('Tests - supermodule', time_function(
+                        lambda: analysis.test_tile(mean_tiles, stdev_tiles, tile=slice(None)),
+                        repeat)),
+                    ('Plotting tile figures', time_function(run_plotting, repeat)),
+                    ('generate_report.export', time_function(
+                        lambda: generate_report.export(fig_list, filename, data_path, data_path),
+                        repeat)),
+                ]
+                generate_report.close_figures(fig_list)
+
+            os.remove(lpd_file_name)
+            description = '{} trains of {} images ({:.1f} MB)'.format(
+                num_trains, images_per_train, file_size / 1024 ** 2)
+            size_results.append((description, results))
+
+    return size_results
+
+
+def print_results(title, results, relative=True):
+    ''' Print the timings of a benchmark, with the speedup relative to the first result unless
+        relative is False
+    '''
+    print(title)
+    baseline = results[0][1]
+    for name, seconds in results:
+        if relative:
+            print('    {:<40} {:>10.3f} ms {:>8.1f}x'.format(name, seconds * 1000,
+                                                           baseline / seconds))
+        else:
+            print('    {:<40} {:>10.3f} ms'.format(name, seconds * 1000))
+
+
+def parse_args():
+    ''' Parse command line arguments
+    '''
+    parser = argparse.ArgumentParser(description='Benchmark the analysis of LPD data')
+    parser.add_argument('--trains', type=int, nargs='+', default=[10, 100, 1000],
+                        help='Numbers of trains in the synthetic files analysed')
+    parser.add_argument('--images-per-train', type=int, default=10,
+                        help='Number of images in each train of the synthetic files')
+    parser.add_argument('--layout', choices=sorted(synthetic_data.LAYOUTS), default='data',
+                        help='Layout of datasets in the synthetic files')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Number of runs of each stage on the synthetic files')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    tile_results, supermodule_results = benchmark_fault_detection()
+    print_results('Fault detection - single tile', tile_results)
+    print_results('Fault detection - supermodule', supermodule_results)
+    print_results('Raw histogram - 100 full images', benchmark_histograms())
+    print_results('Delamination - supermodule', benchmark_delamination())
+
+    # Figures are only drawn to memory
+    plt.switch_backend('Agg')
+    for description, results in benchmark_file_sizes(args.trains, args.images_per_train,
+                                                      args.layout, args.repeat):
+        print_results('Analysis of a tile - {}'.format(description), results, relative=False)
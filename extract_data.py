@@ -5,8 +5,34 @@ import h5py
 import numpy as np
 import xml.etree.ElementTree as ET
 import os
+import time
+from bisect import bisect_left, bisect_right, insort
 from datetime import datetime
 
+import instrumentation
+from pixel_statistics import PixelStatistics
+
+try:
+    # Registers extra HDF5 compression filters (e.g. blosc), so files repacked with them can be read
+    import hdf5plugin  # noqa: F401
+except ImportError:
+    hdf5plugin = None
+
+# Default upper limit (in bytes) on the amount of image data read from a file at any one time.
+# Calculations on each block of data read may create temporary arrays a few times this size
+MEMORY_LIMIT = 256 * 1024 * 1024
+
+# Directory (inside the directory of each data file) holding repacked copies of data files - see
+# repack.py
+REPACKED_DIR = '.repacked'
+
+# Minimum seconds between rescans of a data directory by a FileIndex, unless the directory itself has
+# changed - dragging the date filter queries the index many times a second
+INDEX_REFRESH_INTERVAL = 10
+
+# Index of each data directory listed by get_files_by_date()
+_file_indexes = {}
+
 
 def get_lpd_filename(file_path, filename):
     ''' Returns absolute path of data file
@@ -14,10 +40,145 @@ def get_lpd_filename(file_path, filename):
     return file_path + filename
 
 
+def get_repacked_filename(filename):
+    ''' Returns the path of the repacked copy of a data file, whether or not it exists
+    '''
+    data_path, name = os.path.split(os.path.abspath(filename))
+    return os.path.join(data_path, REPACKED_DIR, name)
+
+
+def is_repacked_file_current(repacked_file, filename):
+    ''' Returns whether an open repacked file was made from the data file as it is now, and can be
+        read with the compression filters available
+    '''
+    file_stat = os.stat(filename)
+    if repacked_file.attrs.get('sourceSize') != file_stat.st_size or \
+            repacked_file.attrs.get('sourceMtimeNs') != file_stat.st_mtime_ns:
+        return False
+
+    create_plist = get_lpd_dataset(repacked_file).id.get_create_plist()
+    return all(h5py.h5z.filter_avail(create_plist.get_filter(index)[0])
+               for index in range(create_plist.get_nfilters()))
+
+
+def open_data_file(filename, use_repacked=True):
+    ''' Open a data file, or its repacked copy if there's an up to date one (and use_repacked is
+        True). The copy holds the same images and metadata in a layout that's quicker to read a
+        tile from
+    '''
+    if use_repacked:
+        repacked_filename = get_repacked_filename(filename)
+        if os.path.exists(repacked_filename):
+            repacked_file = h5py.File(repacked_filename, 'r')
+            if is_repacked_file_current(repacked_file, filename):
+                return repacked_file
+            repacked_file.close()
+    return h5py.File(filename, 'r')
+
+
+class LPDFile():
+    ''' An LPD data file, which can be used as a context manager. The hdf file is opened when it's
+        first needed and the layout of the file (data & metadata or lpd/data/image & lpd/metadata)
+        is resolved once. Metadata attributes and the readoutParamFile XML are each read and parsed
+        the first time they're used, then cached so they're still available after the file is
+        closed. The image dataset is only accessed by callers needing pixel data
+        If the file has an up to date repacked copy (see repack.py) the copy is read instead,
+        unless use_repacked is False
+        LPDFile objects can be passed to functions in this module in place of both a h5py file and
+        its metadata group
+    '''
+    __slots__ = ('filename', 'use_repacked', '_file', '_dataset', '_metadata', '_attrs',
+                 '_readout_params')
+
+    def __init__(self, filename, use_repacked=True):
+        self.filename = filename
+        self.use_repacked = use_repacked
+        self._file = None
+        self._dataset = None
+        self._metadata = None
+        self._attrs = None
+        self._readout_params = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        ''' Close the hdf file - metadata that's been read stays available
+        '''
+        if self._file is not None:
+            self._file.close()
+        self._file = None
+        self._dataset = None
+        self._metadata = None
+
+    @property
+    def file(self):
+        ''' The h5py file, opened on first use - see open_data_file()
+        '''
+        if self._file is None:
+            self._file = open_data_file(self.filename, self.use_repacked)
+        return self._file
+
+    @property
+    def dataset(self):
+        ''' Dataset containing all images in the file - see get_lpd_dataset()
+        '''
+        if self._dataset is None:
+            self._dataset = get_lpd_dataset(self.file)
+        return self._dataset
+
+    @property
+    def metadata(self):
+        ''' The h5py metadata group of the file
+        '''
+        if self._metadata is None:
+            self._metadata = get_file_metadata(self.file)
+        return self._metadata
+
+    @property
+    def attrs(self):
+        ''' Dictionary of the attributes of the metadata group
+        '''
+        if self._attrs is None:
+            self._attrs = dict(self.metadata.attrs)
+        return self._attrs
+
+    @property
+    def readout_params(self):
+        ''' Dictionary of the parameters in the readoutParamFile XML
+        '''
+        if self._readout_params is None:
+            self._readout_params = parse_readout_params(self.metadata['readoutParamFile'][0])
+        return self._readout_params
+
+    @property
+    def num_images_per_train(self):
+        ''' See get_num_images_per_train()
+        '''
+        return int(self.readout_params['numberImages'])
+
+    @property
+    def num_trains(self):
+        ''' See get_num_trains()
+        '''
+        return get_num_trains(self)
+
+    @property
+    def total_num_images(self):
+        ''' See get_total_num_images()
+        '''
+        return self.num_images_per_train * self.num_trains
+
+
 def get_lpd_file(filename):
     ''' Gets hdf file based on filename
     '''
-    lpd_file = h5py.File(filename, 'r')
+    lpd_file = LPDFile(filename)
+    # Open file straight away so any problem opening it is found here
+    lpd_file.file
     return lpd_file
 
 
@@ -26,17 +187,61 @@ def get_lpd_data(lpd_file):
         has been separated so the metadata can be accessed without the need of two h5py file
         objects in the code
     '''
+    lpd_data = get_lpd_dataset(lpd_file)[()]
+    return lpd_data
+
+
+def get_lpd_dataset(lpd_file):
+    ''' Get the dataset containing all images in a hdf file without reading it into memory. This
+        can be used in place of lpd_data in the functions below - slicing it only reads the
+        hyperslab needed from the file, so the file must stay open while it's being used
+    '''
+    if isinstance(lpd_file, LPDFile):
+        return lpd_file.dataset
+
     try:
-        lpd_data = lpd_file['data'][()]
+        lpd_dataset = lpd_file['data']
     except KeyError:
-        lpd_data = lpd_file['lpd/data/image'][()]
-    return lpd_data
+        lpd_dataset = lpd_file['lpd/data/image']
+    return lpd_dataset
+
+
+def get_image_chunks(lpd_data, tile_position=None, memory_limit=MEMORY_LIMIT, start=0,
+                     stop=None):
+    ''' Generator which reads lpd_data in blocks of consecutive images, each block using no more
+        than memory_limit bytes. Only the tile at tile_position is read if one is given, otherwise
+        the full images are read. Only images from start up to stop (all remaining images if None)
+        are read
+    '''
+    if tile_position is None:
+        rows = slice(0, lpd_data.shape[1])
+        cols = slice(0, lpd_data.shape[2])
+    else:
+        rows = slice(tile_position[0], tile_position[0] + 32)
+        cols = slice(tile_position[1], tile_position[1] + 128)
+
+    image_bytes = (rows.stop - rows.start) * (cols.stop - cols.start) * lpd_data.dtype.itemsize
+    chunk_length = max(1, memory_limit // image_bytes)
+
+    # Align blocks with the HDF5 chunks of the dataset (if it has any) so no chunk is read twice
+    hdf_chunks = getattr(lpd_data, 'chunks', None)
+    if hdf_chunks is not None and chunk_length > hdf_chunks[0]:
+        chunk_length -= chunk_length % hdf_chunks[0]
+
+    if stop is None:
+        stop = lpd_data.shape[0]
+    for chunk_start in range(start, stop, chunk_length):
+        with instrumentation.stage('read'):
+            image_data = lpd_data[chunk_start:min(chunk_start + chunk_length, stop), rows, cols]
+            instrumentation.add_bytes_read(image_data.nbytes)
+        yield image_data
 
 
 def get_first_image(lpd_data):
     ''' Get first image from lpd_data
     '''
     single_image = lpd_data[:1, :, :]
+    instrumentation.add_bytes_read(single_image.nbytes)
     single_image = np.reshape(single_image, (256, 256))
     return single_image
 
@@ -46,39 +251,58 @@ def get_single_tile(lpd_data, tile_position, image_num):
     '''
     single_tile = lpd_data[image_num:image_num + 1, tile_position[0]:tile_position[0] + 32,
                            tile_position[1]:tile_position[1] + 128]
+    instrumentation.add_bytes_read(single_tile.nbytes)
     single_tile = np.reshape(single_tile, (32, 128))
     return single_tile
 
 
-def get_mean_tile(lpd_data, tile_position):
-    ''' Get a mean tile of all the tiles in the file
+def get_mean_tile(lpd_data, tile_position, memory_limit=MEMORY_LIMIT):
+    ''' Get a mean tile of all the tiles in the file. The tiles are read in blocks so lpd_data can
+        be a h5py dataset larger than the memory available
     '''
-    tile_data = get_total_tile(lpd_data, tile_position)
-    mean_tile = np.mean(tile_data, axis=0)
+    mean_tile = get_pixel_statistics(lpd_data, tile_position, memory_limit).mean()
     return mean_tile
 
 
+def get_pixel_statistics(lpd_data, tile_position=None, memory_limit=MEMORY_LIMIT, progress=None):
+    ''' Read through lpd_data once, in blocks, accumulating statistics of each pixel of the tile at
+        tile_position (or of the full image if no position is given). Use this to get both the mean
+        and stdev from one pass over the file
+        progress - function called with the number of images read so far and the total after each
+            block, e.g. to show progress. Any exception it raises stops the read
+    '''
+    if tile_position is None:
+        statistics = PixelStatistics(lpd_data.shape[1:])
+    else:
+        statistics = PixelStatistics((32, 128))
+
+    for image_data in get_image_chunks(lpd_data, tile_position, memory_limit):
+        with instrumentation.stage('accumulate'):
+            statistics.add(image_data)
+        if progress is not None:
+            progress(statistics.count, lpd_data.shape[0])
+    return statistics
+
+
 def get_total_tile(lpd_data, tile_position):
     ''' Return a 32 x 128 tile that contains the aggregate of all the images in the file
-        Used in get_stdev_tile()
     '''
     total_tile_data = lpd_data[:lpd_data.shape[0], tile_position[0]:tile_position[0] + 32,
                                tile_position[1]:tile_position[1] + 128]
     return total_tile_data
 
 
-def get_stdev_image(lpd_data):
+def get_stdev_image(lpd_data, memory_limit=MEMORY_LIMIT):
     ''' Get an image that contains the standard deviation of all data in the file
     '''
-    stdev_image = np.std(lpd_data, axis=0)
+    stdev_image = get_pixel_statistics(lpd_data, memory_limit=memory_limit).stdev()
     return stdev_image
 
 
-def get_stdev_tile(lpd_data, tile_position):
+def get_stdev_tile(lpd_data, tile_position, memory_limit=MEMORY_LIMIT):
     ''' Get a tile that contains the standard deviation of the data in the file
     '''
-    tile_data = get_total_tile(lpd_data, tile_position)
-    stdev_tile = np.std(tile_data, axis=0)
+    stdev_tile = get_pixel_statistics(lpd_data, tile_position, memory_limit).stdev()
     return stdev_tile
 
 
@@ -97,6 +321,17 @@ def get_single_column(tile, col_position):
     single_column = tile[:, col_position:col_position + 1]
     return single_column
 
+
+def get_section_means(tile, section_width):
+    ''' Get the mean value of each section of a tile in one go, where the tile is split into
+        sections section_width columns wide - 16 gives the mean of each chip, 1 of each column.
+        tile can also be a stack of tiles (..., 32, 128)
+    '''
+    sections = tile.reshape(tile.shape[:-1] + (-1, section_width))
+    section_means = np.mean(sections, axis=(-3, -1))
+    return section_means
+
+
 def get_single_row(tile, row_position): 
     ''' Get a single row within the tile 
     '''
@@ -121,9 +356,114 @@ def set_tile_position(tile_orientation, mini_connector):
     return tile_position
 
 
+class FileIndex():
+    ''' The .h5 files in a data directory, sorted by modification time, so the files modified in a
+        date range are found by bisection rather than by listing and stat'ing the directory. Each
+        query first rescans the directory (with a single stat per file) if it has changed or hasn't
+        been scanned for refresh_interval seconds, only re-sorting files which were added, changed
+        or removed
+    '''
+
+    def __init__(self, data_file_path, refresh_interval=INDEX_REFRESH_INTERVAL):
+        self.data_file_path = data_file_path
+        self.refresh_interval = refresh_interval
+        # Modification time of each file
+        self._mtimes = {}
+        # (mtime, name) of every file in order, and the mtimes alone to bisect
+        self._index = []
+        self._index_mtimes = []
+        # Modification time of the directory and time it was scanned
+        self._directory_mtime = None
+        self._update_time = None
+
+    def update(self, force=False):
+        ''' Rescan the directory if needed (or always if force is True)
+            Returns the number of files added, changed or removed
+        '''
+        directory_mtime = os.stat(self.data_file_path).st_mtime_ns
+        if not force and directory_mtime == self._directory_mtime and \
+                time.time() - self._update_time < self.refresh_interval:
+            return 0
+        self._directory_mtime = directory_mtime
+        self._update_time = time.time()
+
+        mtimes = {}
+        with os.scandir(self.data_file_path) as entries:
+            for entry in entries:
+                if entry.name.endswith('.h5') and entry.is_file():
+                    mtimes[entry.name] = entry.stat().st_mtime
+
+        changed_files = [name for name, mtime in self._mtimes.items() if mtimes.get(name) != mtime]
+        new_files = [name for name in mtimes if name not in self._mtimes]
+        if len(changed_files) + len(new_files) > len(self._index) // 2:
+            # Quicker to sort everything again
+            self._index = sorted((mtime, name) for name, mtime in mtimes.items())
+        else:
+            for name in changed_files:
+                del self._index[bisect_left(self._index, (self._mtimes[name], name))]
+            for name in changed_files + new_files:
+                if name in mtimes:
+                    insort(self._index, (mtimes[name], name))
+
+        self._mtimes = mtimes
+        if changed_files or new_files:
+            self._index_mtimes = [mtime for mtime, _ in self._index]
+        return len(changed_files) + len(new_files)
+
+    def get_files(self, start_date=datetime.min, end_date=datetime.max):
+        ''' Returns the names of the files last modified between start_date and end_date (datetime
+            objects), sorted from most to least recent
+        '''
+        self.update()
+        start = bisect_left(self._index_mtimes, get_timestamp(start_date))
+        end = bisect_right(self._index_mtimes, get_timestamp(end_date))
+        return [name for _, name in reversed(self._index[start:end])]
+
+    def get_oldest_mtime(self):
+        ''' Returns the modification time of the least recently modified file, or None if there are
+            no files
+        '''
+        self.update()
+        if not self._index:
+            return None
+        return self._index[0][0]
+
+
+def get_file_index(data_file_path):
+    ''' Returns the FileIndex of a data directory, created the first time it's needed and kept for
+        the rest of the session
+    '''
+    file_index = _file_indexes.get(data_file_path)
+    if file_index is None:
+        file_index = FileIndex(data_file_path)
+        _file_indexes[data_file_path] = file_index
+    return file_index
+
+
+def get_timestamp(date):
+    ''' Convert a datetime to a Unix timestamp, treating datetime.min/max as unbounded
+    '''
+    if date == datetime.min:
+        return float('-inf')
+    if date == datetime.max:
+        return float('inf')
+    return date.timestamp()
+
+
+def get_files_by_date(data_file_path, start_date, end_date):
+    ''' Returns the names of the .h5 files in data_file_path which were last modified between
+        start_date and end_date (datetime objects), sorted from most to least recent
+    '''
+    return get_file_index(data_file_path).get_files(start_date, end_date)
+
+
 def get_file_metadata(file):
     ''' Gets metadata groups from open h5 file
+        An LPDFile is returned as it is, so its cached metadata is used by the functions below
     '''
+    if isinstance(file, LPDFile):
+        return file
+
     try:
         metadata = file['metadata']
     except KeyError:
@@ -135,14 +475,25 @@ def get_num_images_per_train(metadata):
     ''' Gets value for the number of images per train, which is then used in the analysis details
         and when plotting the trigger images
     '''
+    if isinstance(metadata, LPDFile):
+        # Readout parameters are only parsed once per file
+        return metadata.num_images_per_train
+
     # Get contents of readoutParamFile
     readout = metadata['readoutParamFile'][0]
 
-    # Pass contents of readout (of type bytes) into an XML parser and find relevant parameter
-    tree = ET.fromstring(readout)
-    img_param = tree.find('numberImages')
+    return int(parse_readout_params(readout)['numberImages'])
 
-    return int(img_param.get('val'))
+
+def parse_readout_params(readout):
+    ''' Pass contents of readoutParamFile (of type bytes) into an XML parser, returning a dictionary
+        of the value of each parameter
+    '''
+    tree = ET.fromstring(readout)
+    readout_params = {}
+    for param in tree:
+        readout_params.setdefault(param.tag, param.get('val'))
+    return readout_params
 
 
 def get_num_trains(metadata):
@@ -1,24 +1,172 @@
+''' Fault tiles record the faults found in each pixel of a tile (or stack of tiles) as a bitmask,
+    with a bit for each test type (mean, stdev) and level of component (chip, column, pixel,
+    delaminated pixel) - so a pixel failing several tests keeps every fault, in one byte
+'''
+
+import numpy as np
+
 import plot
 
+# Type of fault tiles - one bit for each of the 2 test types x 4 fault levels
+FAULT_DTYPE = np.uint8
+
+# Levels of component a fault can be found in, in the order of their bits for each test type
+FAULT_LEVELS = ('chip', 'column', 'pixel', 'delaminated')
+
+# Level of faults found in sections of each width (see test_data.bad_sections())
+SECTION_LEVELS = {16: 'chip', 1: 'column'}
+
+# Values of decoded fault tiles, as shown on fault plots (see plot.setup_fault_plots())
+NO_FAULT = 0
+MEAN_FAULT = 1
+STDEV_FAULT = 2
+
+# Version of the format of fault tiles, saved with them in results files and trend stores. Version 1
+# tiles held one of the decoded values for each pixel, a stdev fault replacing a mean fault
+FAULT_FORMAT_VERSION = 2
+
+
+def get_fault_bit(test_type, level='pixel'):
+    ''' Returns the bit of a fault tile marking a fault of test_type (1 - mean, 2 - stdev) in a
+        level of component from FAULT_LEVELS. Other test types have no bit (0), so their faults are
+        ignored
+    '''
+    if test_type not in (1, 2):
+        return 0
+    return 1 << ((test_type - 1) * len(FAULT_LEVELS) + FAULT_LEVELS.index(level))
+
+
+def get_fault_bits(test_types=(1, 2), levels=FAULT_LEVELS):
+    ''' Returns the bits of every combination of test_types and levels, combined into one mask
+    '''
+    fault_bits = 0
+    for test_type in test_types:
+        for level in levels:
+            fault_bits |= get_fault_bit(test_type, level)
+    return fault_bits
+
+
+# Bits of all faults of each test type
+MEAN_FAULT_BITS = get_fault_bits((1, ))
+STDEV_FAULT_BITS = get_fault_bits((2, ))
+
 
-def add_fault(fault_tile, test_type, x, y, end_points=None):
+def create_fault_tile(shape=(32, 128)):
+    ''' Returns an empty fault tile, or stack of them (e.g. (16, 32, 128) for a supermodule)
+    '''
+    return np.zeros(shape, dtype=FAULT_DTYPE)
+
+
+def add_fault(fault_tile, test_type, x, y, end_points=None, level=None):
     '''
     Add a faulty component (pixel/column/chip) to fault_tile
     test_type should only be 1 or 2 - any other value that's passed will be ignored
         1 - The test type is a test using mean data
         2 - The type type is a test using standard deviation data
     Only pass end_points (tuple) if you want to add a fault to a section (column or chip)
+    level - from FAULT_LEVELS, by default a pixel, or a chip or column depending on the width of
+        the section
     '''
     if end_points is None:
         # Used when adding a pixel fault as endpoints are always 1 above the actual pixel fault
         end_points = (x + 1, y + 1)
+        default_level = 'pixel'
+    else:
+        default_level = 'chip' if end_points[1] - y >= 16 else 'column'
+
+    fault_tile[x:end_points[0], y:end_points[1]] |= get_fault_bit(test_type,
+                                                                   level or default_level)
+
+
+def add_faults(fault_tile, test_type, fault_mask, level='pixel'):
+    ''' Add every faulty pixel marked True in fault_mask (boolean array broadcastable to the shape
+        of fault_tile) to fault_tile in one go. Same test_type values as add_fault()
+    '''
+    fault_bit = get_fault_bit(test_type, level)
+    if fault_bit:
+        np.bitwise_or(fault_tile, fault_bit, out=fault_tile, where=fault_mask,
+                      casting='unsafe')
 
-    if test_type == 1:
-        # Mean fault
-        fault_tile[x:end_points[0], y:end_points[1]] = 1
-    elif test_type == 2:
-        # Stdev fault
-        fault_tile[x:end_points[0], y:end_points[1]] = 2
+
+def convert_fault_tile(fault_tile, format_version):
+    ''' Returns a fault tile (or stack of them) saved in format_version in the current format.
+        Version 1 tiles don't record the level of component, so their faults become pixel faults
+        Raises ValueError if format_version is unknown, e.g. from a newer version of this code
+    '''
+    if format_version == FAULT_FORMAT_VERSION:
+        return np.asarray(fault_tile, dtype=FAULT_DTYPE)
+    if format_version == 1:
+        converted_tile = create_fault_tile(np.shape(fault_tile))
+        add_faults(converted_tile, 1, fault_tile == MEAN_FAULT)
+        add_faults(converted_tile, 2, fault_tile == STDEV_FAULT)
+        return converted_tile
+    raise ValueError('Unknown fault tile format version {}'.format(format_version))
+
+
+def get_fault_mask(fault_tile, test_types=(1, 2), levels=FAULT_LEVELS):
+    ''' Returns a boolean array marking pixels with a fault of any of test_types in any of levels
+    '''
+    return (fault_tile & get_fault_bits(test_types, levels)) != 0
+
+
+def decode_faults(fault_tile):
+    ''' Returns the values of fault_tile as shown on fault plots: STDEV_FAULT for pixels with any
+        stdev fault, otherwise MEAN_FAULT for pixels with any mean fault, otherwise NO_FAULT
+    '''
+    decoded_tile = np.where(fault_tile & MEAN_FAULT_BITS, MEAN_FAULT, NO_FAULT)
+    decoded_tile[(fault_tile & STDEV_FAULT_BITS) != 0] = STDEV_FAULT
+    return decoded_tile.astype(FAULT_DTYPE)
+
+
+def union(fault_tile, other_fault_tile):
+    ''' Returns every fault in either of two fault tiles (e.g. of two runs of the same tile)
+    '''
+    return np.bitwise_or(fault_tile, other_fault_tile)
+
+
+def intersection(fault_tile, other_fault_tile):
+    ''' Returns the faults found in both of two fault tiles - the same test type and level in the
+        same pixel
+    '''
+    return np.bitwise_and(fault_tile, other_fault_tile)
+
+
+def difference(fault_tile, other_fault_tile):
+    ''' Returns the faults of fault_tile which aren't in other_fault_tile, e.g. the new faults of a
+        run compared with an earlier run
+    '''
+    return np.bitwise_and(fault_tile, np.invert(np.asarray(other_fault_tile, dtype=FAULT_DTYPE)))
+
+
+def run_length_encode(fault_tile):
+    ''' Encode a fault tile (or stack of them) as runs of pixels with the same faults, in the order
+        of the flattened tile. Runs of pixels without faults are left out, so this is compact for
+        the few faults usually found
+        Returns an array of (start, length, faults) of each run, where start is an index into the
+        flattened tile
+    '''
+    values = np.ravel(fault_tile)
+    # Indices where a run starts - the first pixel and each pixel different from the one before
+    run_starts = np.append(0, np.flatnonzero(values[1:] != values[:-1]) + 1)
+    run_lengths = np.diff(np.append(run_starts, values.size))
+    run_values = values[run_starts]
+
+    fault_runs = run_values != 0
+    return np.stack([run_starts[fault_runs], run_lengths[fault_runs], run_values[fault_runs]],
+                    axis=-1)
+
+
+def run_length_decode(runs, shape=(32, 128)):
+    ''' Returns the fault tile (or stack of them) of shape encoded by run_length_encode()
+    '''
+    fault_tile = create_fault_tile(int(np.prod(shape)))
+    if len(runs) > 0:
+        starts, lengths, values = np.asarray(runs).T
+        # Index of the run each pixel of the runs belongs to
+        run_indices = np.repeat(np.arange(len(starts)), lengths)
+        offsets = np.arange(run_indices.size) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        fault_tile[starts[run_indices] + offsets] = values[run_indices]
+    return fault_tile.reshape(shape)
 
 
 def detect(tile_section):
@@ -29,13 +177,7 @@ def detect(tile_section):
     test_section = True
 
     # Counts the number of bad pixels in the given area
-    pixel_fault_count = 0
-
-    # Count number of faulty pixels in section
-    for i in range(0, len(tile_section)):
-        for j in range(0, len(tile_section[i])):
-            if tile_section[i][j] != 0:
-                pixel_fault_count += 1
+    pixel_fault_count = np.count_nonzero(tile_section)
 
     # Total number of pixels in tile_section
     num_pixels = len(tile_section[0])
@@ -47,7 +189,34 @@ def detect(tile_section):
     return test_section
 
 
+def detect_sections(fault_tile, section_width):
+    ''' Vectorised version of detect() - determines whether each section of fault_tile should be
+        tested or not, where the tile is split into sections section_width columns wide (16 for
+        chips, 1 for columns). fault_tile can also be a stack of tiles (..., 32, 128)
+        Returns a boolean array with a value for each section of each tile (..., 128 / section_width)
+    '''
+    sections = fault_tile.reshape(fault_tile.shape[:-1] + (-1, section_width))
+    pixel_fault_count = np.count_nonzero(sections, axis=(-3, -1))
+
+    # As in detect(), the count is compared to the width of the section rather than its area
+    return ~((pixel_fault_count / section_width) * 100 > 95)
+
+
+def expand_sections(section_mask, section_width, rows=32):
+    ''' Expand a boolean array with a value for each section (as returned by detect_sections()) into
+        a mask with a value for each pixel of the tile(s), to be passed to add_faults()
+    '''
+    pixel_mask = np.repeat(section_mask, section_width, axis=-1)[..., np.newaxis, :]
+    return np.broadcast_to(pixel_mask, section_mask.shape[:-1] + (rows, pixel_mask.shape[-1]))
+
+
 def plot_faults(fault_tile_plot, fault_tile):
     ''' Plot all the faults found during testing the tile
     '''
-    plot.display_data_plot(fault_tile_plot, fault_tile)
+    plot.display_data_plot(fault_tile_plot, decode_faults(fault_tile), colorbar_type=2)
+
+
+def update_fault_plot(fault_image, fault_tile):
+    ''' Plot the faults of a tile on an image created once with plot.setup_data_plot()
+    '''
+    plot.update_data_plot(fault_image, decode_faults(fault_tile))
@@ -0,0 +1,193 @@
+''' Local SQLite catalog of the metadata of every data file in a directory, so files can be browsed
+    and searched without opening each one
+'''
+
+import hashlib
+import os
+import sqlite3
+import xml.etree.ElementTree as ET
+
+import extract_data
+
+# Default directory catalogs are kept in - one catalog per data directory
+CATALOG_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'lpd_tile_testing', 'catalogs')
+
+# Metadata stored for each file, in addition to its name, size and modification time
+METADATA_COLUMNS = ('date_created', 'num_trains', 'images_per_train', 'total_images',
+                    'cmd_seq_file', 'readout_param_file', 'setup_param_file', 'error')
+
+CREATE_TABLE = '''
+    CREATE TABLE IF NOT EXISTS files (
+        name TEXT PRIMARY KEY,
+        size INTEGER,
+        mtime_ns INTEGER,
+        mtime REAL,
+        date_created TEXT,
+        num_trains INTEGER,
+        images_per_train INTEGER,
+        total_images INTEGER,
+        cmd_seq_file TEXT,
+        readout_param_file TEXT,
+        setup_param_file TEXT,
+        error TEXT
+    )
+'''
+CREATE_INDEXES = (
+    'CREATE INDEX IF NOT EXISTS files_mtime ON files (mtime)',
+    'CREATE INDEX IF NOT EXISTS files_cmd_seq_file ON files (cmd_seq_file)',
+    'CREATE INDEX IF NOT EXISTS files_total_images ON files (total_images)',
+)
+
+
+def get_catalog_filename(data_file_path, catalog_path=CATALOG_PATH):
+    ''' Returns the path of the catalog for a data directory
+    '''
+    path_hash = hashlib.sha1(os.path.abspath(data_file_path).encode()).hexdigest()
+    return os.path.join(catalog_path, '{}.sqlite'.format(path_hash))
+
+
+def read_file_metadata(file_path):
+    ''' Read the catalogued metadata of a data file, returned as a dict with a value for each of
+        METADATA_COLUMNS. If the file can't be read, error describes why
+    '''
+    file_metadata = dict.fromkeys(METADATA_COLUMNS)
+    try:
+        # Only metadata is read - the image dataset is never accessed
+        with extract_data.LPDFile(file_path) as lpd_file:
+            file_metadata['date_created'] = extract_data.get_file_date_created(file_path,
+                                                                               lpd_file)
+            file_metadata['num_trains'] = lpd_file.num_trains
+            file_metadata['images_per_train'] = lpd_file.num_images_per_train
+            file_metadata['total_images'] = lpd_file.total_num_images
+            file_metadata['cmd_seq_file'] = extract_data.get_cmd_seq_filename(lpd_file)
+            file_metadata['readout_param_file'] = \
+                str(lpd_file.attrs['readoutParamFile']).split('/')[-1]
+            file_metadata['setup_param_file'] = \
+                str(lpd_file.attrs['setupParamFile']).split('/')[-1]
+    # Malformed readout parameter XML or non-numeric attributes are recorded like any other
+    # unreadable file, so one bad file can't stop the catalog being updated
+    except (OSError, KeyError, ValueError, TypeError, ET.ParseError) as error:
+        file_metadata['error'] = '{}: {}'.format(type(error).__name__, error)
+    return file_metadata
+
+
+class FileCatalog():
+    ''' Catalog of the .h5 files in data_file_path. update() rescans only files that are new or
+        have changed (by size or modification time) since they were last catalogued
+    '''
+
+    def __init__(self, data_file_path, catalog_filename=None):
+        self.data_file_path = data_file_path
+        if catalog_filename is None:
+            catalog_filename = get_catalog_filename(data_file_path)
+            os.makedirs(os.path.dirname(catalog_filename), exist_ok=True)
+
+        self.connection = sqlite3.connect(catalog_filename)
+        self.connection.row_factory = sqlite3.Row
+        with self.connection:
+            self.connection.execute(CREATE_TABLE)
+            for create_index in CREATE_INDEXES:
+                self.connection.execute(create_index)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        ''' Close connection to the catalog
+        '''
+        self.connection.close()
+
+    def update(self):
+        ''' Bring the catalog up to date with the files in the data directory
+            Returns the number of files that were (re)scanned
+        '''
+        catalogued_files = {row['name']: (row['size'], row['mtime_ns']) for row in
+                            self.connection.execute('SELECT name, size, mtime_ns FROM files')}
+
+        changed_files = []
+        current_files = set()
+        for entry in os.scandir(self.data_file_path):
+            if entry.name.endswith('.h5') and entry.is_file():
+                entry_stat = entry.stat()
+                current_files.add(entry.name)
+                if catalogued_files.get(entry.name) != (entry_stat.st_size, entry_stat.st_mtime_ns):
+                    changed_files.append((entry.name, entry_stat))
+
+        with self.connection:
+            removed_files = set(catalogued_files) - current_files
+            self.connection.executemany('DELETE FROM files WHERE name = ?',
+                                        [(name,) for name in removed_files])
+            for name, file_stat in changed_files:
+                self.add_file(name, file_stat)
+
+        return len(changed_files)
+
+    def update_file(self, name):
+        ''' Rescan a single file if it's new or has changed, removing it if it no longer exists
+        '''
+        file_path = os.path.join(self.data_file_path, name)
+        row = self.connection.execute('SELECT size, mtime_ns FROM files WHERE name = ?',
+                                      (name,)).fetchone()
+        with self.connection:
+            try:
+                file_stat = os.stat(file_path)
+            except FileNotFoundError:
+                self.connection.execute('DELETE FROM files WHERE name = ?', (name,))
+                return
+            if row is None or (row['size'], row['mtime_ns']) != (file_stat.st_size,
+                                                                 file_stat.st_mtime_ns):
+                self.add_file(name, file_stat)
+
+    def add_file(self, name, file_stat):
+        ''' Read a file's metadata and store it in the catalog, replacing any previous entry
+        '''
+        file_metadata = read_file_metadata(os.path.join(self.data_file_path, name))
+        values = [name, file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_mtime]
+        values.extend(file_metadata[column] for column in METADATA_COLUMNS)
+        self.connection.execute(
+            'INSERT OR REPLACE INTO files (name, size, mtime_ns, mtime, {}) VALUES ({})'.format(
+                ', '.join(METADATA_COLUMNS), ', '.join('?' * len(values))),
+            values)
+
+    def get_details(self, name):
+        ''' Returns the catalogued details of a file as a dict (None if it isn't catalogued), first
+            rescanning the file if it has changed
+        '''
+        self.update_file(name)
+        row = self.connection.execute('SELECT * FROM files WHERE name = ?', (name,)).fetchone()
+        if row is None:
+            return None
+        return dict(row)
+
+    def query(self, start_date=None, end_date=None, cmd_seq_file=None, min_images=None,
+              max_images=None):
+        ''' Returns names of catalogued files matching all of the conditions given, sorted from most
+            to least recently modified. Dates (datetime objects) are compared against the
+            modification time of the file, as in extract_data.get_files_by_date()
+        '''
+        conditions = []
+        values = []
+        if start_date is not None:
+            conditions.append('mtime >= ?')
+            values.append(extract_data.get_timestamp(start_date))
+        if end_date is not None:
+            conditions.append('mtime <= ?')
+            values.append(extract_data.get_timestamp(end_date))
+        if cmd_seq_file is not None:
+            conditions.append('cmd_seq_file = ?')
+            values.append(cmd_seq_file)
+        if min_images is not None:
+            conditions.append('total_images >= ?')
+            values.append(min_images)
+        if max_images is not None:
+            conditions.append('total_images <= ?')
+            values.append(max_images)
+
+        sql = 'SELECT name FROM files'
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        sql += ' ORDER BY mtime DESC'
+        return [row['name'] for row in self.connection.execute(sql, values)]
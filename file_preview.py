@@ -0,0 +1,173 @@
+''' Previews of data files, so any file can be browsed without reading its pixel data. A preview
+    holds the first full image, the first image of the first few triggers, a pyramid of downsampled
+    mean and stdev frames and a histogram of the raw values. It's made once - when a file is
+    ingested by watch_folder.py or first looked at - and cached on disk like analysis_cache
+'''
+
+import hashlib
+import os
+
+import numpy as np
+
+import analysis_cache
+import extract_data
+import histogram
+import instrumentation
+from pixel_statistics import PixelStatistics
+
+# Default directory of cached previews and the total size they're limited to (bytes)
+PREVIEW_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'lpd_tile_testing', 'previews')
+PREVIEW_SIZE_LIMIT = 256 * 1024 * 1024
+
+# Modules whose code determines the contents of a preview - editing any of them invalidates every
+# preview
+PREVIEW_MODULES = ('file_preview', 'extract_data', 'pixel_statistics', 'histogram')
+
+# Number of images the mean, stdev and histogram of a preview are taken from - the first images of
+# the file, so a preview costs a fraction of reading the file
+NUM_PREVIEW_IMAGES = 500
+
+# Number of triggers whose first image is kept, as shown by test_results.update_trigger_images()
+NUM_TRIGGER_IMAGES = 4
+
+# Factors the mean and stdev frames are downsampled by - each level of the pyramid has a
+# (256 / factor)^2 frame
+PYRAMID_FACTORS = (2, 4, 8)
+
+# Frames kept at each level of the pyramid
+PYRAMID_FRAMES = ('first_image', 'mean', 'stdev')
+
+_code_version = None
+
+
+def get_code_version():
+    ''' Returns a hash of the source of the preview modules, calculated once per session
+    '''
+    global _code_version
+    if _code_version is None:
+        _code_version = analysis_cache.get_source_hash(PREVIEW_MODULES)
+    return _code_version
+
+
+def get_preview_key(filename):
+    ''' Returns the key a file's preview is cached under: a hash of the data file's path, size and
+        modification time and the version of the preview code
+    '''
+    file_stat = os.stat(filename)
+    key_values = (os.path.abspath(filename), file_stat.st_size, file_stat.st_mtime_ns,
+                  get_code_version())
+    return hashlib.sha1(repr(key_values).encode()).hexdigest()
+
+
+def downsample(image, factor):
+    ''' Returns the mean of each factor x factor block of pixels of an image
+    '''
+    rows, cols = image.shape
+    blocks = np.asarray(image, dtype=np.float32).reshape(rows // factor, factor,
+                                                         cols // factor, factor)
+    return blocks.mean(axis=(1, 3))
+
+
+def get_level_name(frame, factor):
+    ''' Returns the name a level of the pyramid of a frame is stored under
+    '''
+    return '{}_{}'.format(frame, factor)
+
+
+def get_level(preview, frame, size):
+    ''' Returns the smallest level of the pyramid of a frame ('first_image', 'mean' or 'stdev') that
+        is at least size pixels across, or the full frame if none are (first image only)
+    '''
+    for factor in sorted(PYRAMID_FACTORS, reverse=True):
+        if 256 // factor >= size:
+            return preview[get_level_name(frame, factor)]
+    return preview.get(frame, preview[get_level_name(frame, min(PYRAMID_FACTORS))])
+
+
+def create_preview(filename, num_images=NUM_PREVIEW_IMAGES, num_triggers=NUM_TRIGGER_IMAGES,
+                   memory_limit=extract_data.MEMORY_LIMIT):
+    ''' Read the parts of a data file needed for its preview
+        Returns the preview as a dictionary of arrays
+    '''
+    with extract_data.LPDFile(filename) as lpd_file:
+        lpd_data = lpd_file.dataset
+        trigger_gap = lpd_file.num_images_per_train
+        num_images = min(num_images, lpd_data.shape[0])
+
+        statistics = PixelStatistics((256, 256))
+        raw_histogram = histogram.Histogram()
+        for image_data in extract_data.get_image_chunks(lpd_data, memory_limit=memory_limit,
+                                                        stop=num_images):
+            statistics.add(image_data)
+            raw_histogram.add(image_data)
+
+        trigger_numbers = np.arange(num_triggers) * trigger_gap
+        trigger_numbers = trigger_numbers[trigger_numbers < lpd_data.shape[0]]
+        trigger_images = lpd_data[trigger_numbers.tolist()]
+        instrumentation.add_bytes_read(trigger_images.nbytes)
+
+    preview = {
+        'first_image': trigger_images[0],
+        'trigger_images': trigger_images,
+        'trigger_numbers': trigger_numbers,
+        'histogram': raw_histogram.total(),
+        'num_images': np.array(num_images),
+    }
+    frames = {'first_image': trigger_images[0], 'mean': statistics.mean(),
+              'stdev': statistics.stdev()}
+    for frame in PYRAMID_FRAMES:
+        for factor in PYRAMID_FACTORS:
+            preview[get_level_name(frame, factor)] = downsample(frames[frame], factor)
+    return preview
+
+
+def get_preview_filename(key, preview_path=PREVIEW_PATH):
+    ''' Returns the path of the file the preview with the given key is cached in
+    '''
+    return os.path.join(preview_path, '{}.npz'.format(key))
+
+
+def load_preview(key, preview_path=PREVIEW_PATH):
+    ''' Returns the cached preview for key as a dictionary of arrays, or None if it isn't cached
+    '''
+    preview_filename = get_preview_filename(key, preview_path)
+    try:
+        with np.load(preview_filename) as cached_preview:
+            preview = {name: cached_preview[name] for name in cached_preview.files}
+        # Mark the preview as recently used so it's one of the last to be evicted
+        os.utime(preview_filename)
+    except (OSError, KeyError, ValueError):
+        return None
+    return preview
+
+
+def save_preview(key, preview, preview_path=PREVIEW_PATH, size_limit=PREVIEW_SIZE_LIMIT):
+    ''' Cache a preview under key, evicting the least recently used previews if the cache grows
+        larger than size_limit
+    '''
+    os.makedirs(preview_path, exist_ok=True)
+    preview_filename = get_preview_filename(key, preview_path)
+
+    # Written to a temporary file first so other processes never see a partial file
+    temp_filename = '{}.{}.tmp'.format(preview_filename, os.getpid())
+    with open(temp_filename, 'wb') as temp_file:
+        np.savez(temp_file, **preview)
+    os.replace(temp_filename, preview_filename)
+
+    analysis_cache.evict_results(preview_path, size_limit)
+
+
+def get_preview(filename, preview_path=PREVIEW_PATH, size_limit=PREVIEW_SIZE_LIMIT,
+                memory_limit=extract_data.MEMORY_LIMIT):
+    ''' Returns the preview of a data file, from the cache if it's there - otherwise it's created and
+        cached. The file is only opened if the preview isn't cached
+    '''
+    with instrumentation.tag(file=os.path.basename(filename)):
+        with instrumentation.stage('load preview'):
+            key = get_preview_key(filename)
+            preview = load_preview(key, preview_path)
+        if preview is None:
+            with instrumentation.stage('create preview'):
+                preview = create_preview(filename, memory_limit=memory_limit)
+            save_preview(key, preview, preview_path, size_limit)
+    return preview
@@ -1,28 +1,93 @@
 from matplotlib.backends.backend_pdf import PdfPages
+import matplotlib.pyplot as plt
 import os
 
+import plot
+import fault_tiles
+import instrumentation
+import test_data
+import test_results
 
-def export(fig_list, filename, data_path):
+
+# Directory reports are saved in unless another is given
+DEFAULT_SAVE_PATH = os.path.join(os.path.expanduser('~'), 'develop', 'projects', 'lpd',
+                                 'tile_analysis')
+
+
+def get_report_filename(filename):
+    ''' Returns the filename of the PDF report of a data file
+    '''
+    # split() - remove file extension from filename of data
+    return 'test_results_{}.pdf'.format(filename.split('.')[0])
+
+
+def export(fig_list, filename, data_path, save_path=None):
     ''' Creates PDF file of all the figures displayed in the notebook
+        save_path - directory the PDF is saved in, DEFAULT_SAVE_PATH if not given
     '''
-    # Protecting path from trailing '/' from $HOME
-    home_location = os.environ['HOME']
-    if home_location[-1] == '/':
-        home_location = home_location[:-1]
+    if save_path is None:
+        save_path = DEFAULT_SAVE_PATH
+    os.makedirs(save_path, exist_ok=True)
+    pdf_name = get_report_filename(filename)
 
-    save_path = "{}/develop/projects/lpd/tile_analysis".format(os.environ['HOME'])
-    # split() - remove file extension from filename of data
-    pdf_name = 'test_results_{}.pdf'.format(filename.split('.')[0])
-    pdf_file = PdfPages('{}/{}'.format(save_path, pdf_name))
+    with instrumentation.tag(file=filename), instrumentation.stage('export'):
+        pdf_file = PdfPages(os.path.join(save_path, pdf_name))
 
-    for figure in fig_list:
-        # Insert each figure into PDF created by Matplotlib
-        figure.savefig(pdf_file, format='pdf')
+        for figure in fig_list:
+            # Insert each figure into PDF created by Matplotlib
+            figure.savefig(pdf_file, format='pdf')
 
-    # Add metadata to PDF file
-    d = pdf_file.infodict()
-    d['Title'] = "Analysis of {}".format(filename)
+        # Add metadata to PDF file
+        d = pdf_file.infodict()
+        d['Title'] = "Analysis of {}".format(filename)
 
-    pdf_file.close()
+        pdf_file.close()
 
     return pdf_name
+
+
+def create_tile_figures(mean_tile, stdev_tile, fault_tile, table_values, tile_name, filename,
+                        data_path, metadata):
+    ''' Creates the figures displayed in the notebook for an analysed tile, so reports can be made
+        without the notebook. tile_name is added to each figure's title and label, allowing figures
+        of several tiles to exist at once
+    '''
+    with instrumentation.tag(file=filename, tile=tile_name), instrumentation.stage('plot'):
+        mean_fig, mean_tile_plot, mean_tile_colorbar, mean_histogram = plot.setup_test_plots(1)
+        stdev_fig, stdev_tile_plot, stdev_tile_colorbar, stdev_histogram = plot.setup_test_plots(2)
+        fault_fig, fault_tile_plot, _ = plot.setup_fault_plots()
+        results_fig, results_table, analysis_textarea, analysis_text_list = \
+            test_results.setup_results_figure()
+        fig_list = [mean_fig, stdev_fig, fault_fig, results_fig]
+
+        mean_tile_plot.set_title("Plot of Tile Using Mean Data", fontsize=16)
+        mean_histogram.set_title("Histogram of Mean Tile Data", fontsize=16)
+        plot.disable_ticks(mean_tile_plot)
+        test_data.manage_figure(mean_tile, mean_tile_plot, mean_tile_colorbar, mean_histogram, 0)
+
+        stdev_tile_plot.set_title("Plot of Tile Using Standard Deviation Data", fontsize=16)
+        stdev_histogram.set_title("Histogram of Standard Deviation Tile Data", fontsize=16)
+        plot.disable_ticks(stdev_tile_plot)
+        test_data.manage_figure(stdev_tile, stdev_tile_plot, stdev_tile_colorbar, stdev_histogram,
+                                1)
+
+        fault_tile_plot.set_title("Plot of Tile's Faults", fontsize=16)
+        plot.disable_ticks(fault_tile_plot)
+        fault_tiles.plot_faults(fault_tile_plot, fault_tile)
+
+        test_results.update_table(table_values, results_table)
+        test_results.set_analysis_text(analysis_textarea, analysis_text_list, filename, data_path,
+                                       metadata)
+
+        for figure in fig_list:
+            figure.suptitle(tile_name)
+            figure.set_label('{} - {}'.format(figure.get_label(), tile_name))
+
+    return fig_list
+
+
+def close_figures(fig_list):
+    ''' Close figures created outside of the notebook once they've been exported
+    '''
+    for figure in fig_list:
+        plt.close(figure)
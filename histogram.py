@@ -0,0 +1,111 @@
+''' Histograms of 12 bit LPD data, calculated by counting each value rather than binning
+'''
+
+import numpy as np
+
+import analysis
+import extract_data
+
+# Data is 12 bit, so every value has its own bin
+NUM_VALUES = 4096
+
+
+class Histogram():
+    ''' Counts of each value from 0 to 4095 as blocks of data are added, in one or more separate
+        histograms (e.g. one per chip). Values above 4095 are counted in the last bin and values
+        below 0 in the first. Only integer data can be counted - floating point data is rejected
+        rather than silently truncated.
+
+        Counts are exact integers, so histograms of separate blocks (e.g. from different processes)
+        can be combined with merge() and give the same counts as counting all the data at once
+    '''
+
+    def __init__(self, num_histograms=1):
+        self.counts = np.zeros((num_histograms, NUM_VALUES), dtype=np.int64)
+
+    def add(self, data, groups=None, first_histogram=0):
+        ''' Count the values in a block of integer data
+            groups - array of the histogram each value is counted in, broadcastable to the shape of
+                data (e.g. a label for each pixel of an image). All values are counted in the first
+                histogram if not given
+            first_histogram - histogram the groups are numbered from, so a block only counts into
+                the histograms it has values for (e.g. the frames it holds)
+        '''
+        if not np.issubdtype(np.asarray(data).dtype, np.integer):
+            raise ValueError('Only integer data can be counted, not {}'.format(
+                np.asarray(data).dtype))
+        values = np.clip(data, 0, NUM_VALUES - 1)
+
+        if groups is None:
+            self.counts[first_histogram] += np.bincount(values.ravel(), minlength=NUM_VALUES)
+        else:
+            # Give each histogram its own range of bins so they're all counted by one bincount,
+            # which only covers the histograms this block is counted in
+            num_groups = int(np.max(groups)) + 1
+            counts = self.counts[first_histogram:first_histogram + num_groups]
+            index = np.broadcast_to(groups, values.shape) * NUM_VALUES + values
+            counts += np.bincount(index.ravel(), minlength=counts.size).reshape(counts.shape)
+
+    def merge(self, other):
+        ''' Combine the counts of another Histogram with the same number of histograms
+        '''
+        self.counts += other.counts
+
+    def total(self):
+        ''' Return the counts of all histograms combined
+        '''
+        return np.sum(self.counts, axis=0)
+
+
+def get_pixel_groups(shape, group_by=None):
+    ''' Returns an array labelling the histogram each pixel of an image or tile of shape (rows,
+        columns) is counted in, and the number of histograms
+        group_by - None for a single histogram, 'chip' for one per chip or 'tile' for one per tile
+            (for full images, in the order of analysis.get_supermodule_tiles())
+    '''
+    rows, cols = np.indices(shape)
+    if group_by == 'chip':
+        pixel_groups = (rows // 32) * (shape[1] // 16) + cols // 16
+    elif group_by == 'tile' and tuple(shape) == (256, 256):
+        pixel_groups = np.zeros(shape, dtype=np.intp)
+        for tile, position in enumerate(analysis.get_supermodule_tile_positions()):
+            pixel_groups[position[0]:position[0] + 32, position[1]:position[1] + 128] = tile
+    elif group_by in (None, 'tile'):
+        pixel_groups = np.zeros(shape, dtype=np.intp)
+    else:
+        raise ValueError('Unknown histogram grouping: {}'.format(group_by))
+
+    return (pixel_groups, int(pixel_groups.max()) + 1)
+
+
+def get_histogram(lpd_data, tile_position=None, group_by=None,
+                  memory_limit=extract_data.MEMORY_LIMIT):
+    ''' Read through lpd_data once, in blocks, counting the raw values of the tile at tile_position
+        (or of the full images if no position is given)
+        group_by - as in get_pixel_groups(), or 'frame' for a histogram of each image
+        Returns a Histogram
+    '''
+    if tile_position is None:
+        shape = lpd_data.shape[1:]
+    else:
+        shape = (32, 128)
+
+    if group_by == 'frame':
+        histogram = Histogram(lpd_data.shape[0])
+    else:
+        pixel_groups, num_histograms = get_pixel_groups(shape, group_by)
+        histogram = Histogram(num_histograms)
+        if num_histograms == 1:
+            # No need to label every pixel
+            pixel_groups = None
+
+    image_num = 0
+    for image_data in extract_data.get_image_chunks(lpd_data, tile_position, memory_limit):
+        if group_by == 'frame':
+            # Frames of the block are counted into their own histograms
+            histogram.add(image_data, np.arange(image_data.shape[0]).reshape(-1, 1, 1), image_num)
+        else:
+            histogram.add(image_data, pixel_groups)
+        image_num += image_data.shape[0]
+
+    return histogram
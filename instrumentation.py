@@ -0,0 +1,233 @@
+''' Opt-in timing and memory instrumentation of the stages of analysis - reading data, accumulating
+    statistics, the tests, plotting and exporting reports. Each stage records its wall time, the
+    bytes of data it read and its peak memory, tagged with the file and tile analysed. Records can be
+    summarised, or exported as JSON lines or in Chrome's trace format (chrome://tracing)
+'''
+
+import json
+import os
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+
+# Whether stages are recorded, and whether their peak memory is measured too (much slower, as every
+# allocation is traced)
+_enabled = False
+_trace_memory = False
+
+# Records of stages finished, by every thread
+_records = []
+_records_lock = threading.Lock()
+
+# Stages in progress (innermost last) and tags of the current file/tile - each thread has its own, so
+# analyses running on different threads don't mix their stages or tags
+_thread_state = threading.local()
+
+# Wall time and performance counter when instrumentation was enabled - stages are timed with the
+# performance counter, and their start converted to wall time so records of processes line up
+_time_base = (0.0, 0.0)
+
+# Returned by stage() when instrumentation is disabled, so stages cost almost nothing
+_NULL_STAGE = nullcontext()
+
+
+def _get_thread_state():
+    ''' Returns the stages in progress and tags of the current thread, created on first use
+    '''
+    if not hasattr(_thread_state, 'stages'):
+        _thread_state.stages = []
+        _thread_state.tags = {}
+    return _thread_state
+
+
+class _Stage():
+    ''' A stage in progress. Memory is measured relative to the start of the stage
+    '''
+
+    __slots__ = ('name', 'tags', 'stages', 'start', 'start_counter', 'bytes_read', 'memory_base',
+                 'peak_memory')
+
+    def __init__(self, name, thread_state):
+        self.name = name
+        self.tags = dict(thread_state.tags)
+        self.stages = thread_state.stages
+        self.start_counter = time.perf_counter()
+        self.start = _time_base[0] + self.start_counter - _time_base[1]
+        self.bytes_read = 0
+        self.memory_base = 0
+        self.peak_memory = 0
+
+    def __enter__(self):
+        if _trace_memory:
+            _update_peak_memory(self.stages, reset=True)
+        self.stages.append(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        duration = time.perf_counter() - self.start_counter
+        if _trace_memory:
+            _update_peak_memory(self.stages)
+        self.stages.pop()
+
+        record = {'stage': self.name, 'start': self.start, 'duration': duration,
+                  'bytes_read': self.bytes_read, 'depth': len(self.stages), 'pid': os.getpid(),
+                  'thread': threading.current_thread().name}
+        if _trace_memory:
+            record['peak_memory'] = self.peak_memory
+        record.update(self.tags)
+        with _records_lock:
+            _records.append(record)
+
+
+def _update_peak_memory(stages, reset=False):
+    ''' Update the peak memory of stages in progress from the memory traced since the last reset.
+        Python 3.7 can't reset the peak on its own, so resetting clears the traces - blocks
+        allocated before then are no longer counted when they're freed, so peaks are upper bounds.
+        Memory is traced for the whole process, so it includes that of stages on other threads
+    '''
+    current, peak = tracemalloc.get_traced_memory()
+    for stage in stages:
+        stage.peak_memory = max(stage.peak_memory, stage.memory_base + peak)
+        if reset:
+            stage.memory_base += current
+    if reset:
+        tracemalloc.clear_traces()
+
+
+def enable(trace_memory=False):
+    ''' Start recording stages of analysis, on every thread
+        trace_memory - whether to measure the peak memory of each stage, using tracemalloc
+    '''
+    global _enabled, _trace_memory, _time_base
+    _enabled = True
+    _time_base = (time.time(), time.perf_counter())
+    _trace_memory = trace_memory
+    if trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def disable():
+    ''' Stop recording stages. Records made so far are kept until clear_records() is called
+    '''
+    global _enabled, _trace_memory
+    if _trace_memory and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    _enabled = False
+    _trace_memory = False
+
+
+def is_enabled():
+    ''' Returns whether stages are being recorded
+    '''
+    return _enabled
+
+
+def stage(name):
+    ''' Context manager recording a stage of analysis, tagged with the current tags of the thread
+        (see tag()) and its name. Stages can be nested - the time, bytes read and memory of inner
+        stages are included in the stages around them
+    '''
+    if not _enabled:
+        return _NULL_STAGE
+    return _Stage(name, _get_thread_state())
+
+
+@contextmanager
+def tag(**tags):
+    ''' Context manager adding tags (e.g. file and tile) to every stage recorded inside it, on the
+        current thread. Tags of outer calls are kept unless they're given again
+    '''
+    thread_state = _get_thread_state()
+    outer_tags = thread_state.tags
+    thread_state.tags = dict(outer_tags, **tags)
+    try:
+        yield
+    finally:
+        thread_state.tags = outer_tags
+
+
+def add_bytes_read(num_bytes):
+    ''' Count bytes of data read in every stage in progress on the current thread
+    '''
+    if _enabled:
+        for stage in _get_thread_state().stages:
+            stage.bytes_read += num_bytes
+
+
+def get_records():
+    ''' Returns a list of the records of stages finished, in the order they finished. Each record is
+        a dict of the stage's name, start time (seconds since the epoch), duration (seconds),
+        bytes_read, depth (number of stages around it), pid, thread (name), peak_memory (bytes, if
+        traced) and tags
+    '''
+    with _records_lock:
+        return list(_records)
+
+
+def clear_records():
+    ''' Discard all records made so far
+    '''
+    with _records_lock:
+        del _records[:]
+
+
+def get_summary(records):
+    ''' Totals of each stage in records, in the order they first finished
+        Returns a list of (stage, count, total duration, total bytes read, peak memory) - peak
+        memory is None if it wasn't traced
+    '''
+    totals = {}
+    for record in records:
+        count, duration, bytes_read, peak_memory = totals.get(record['stage'], (0, 0.0, 0, None))
+        if 'peak_memory' in record:
+            peak_memory = max(peak_memory or 0, record['peak_memory'])
+        totals[record['stage']] = (count + 1, duration + record['duration'],
+                                   bytes_read + record['bytes_read'], peak_memory)
+    return [(name, ) + values for name, values in totals.items()]
+
+
+def format_summary(records):
+    ''' Returns a table of the totals of each stage in records, as text
+    '''
+    lines = ['{:<24} {:>6} {:>12} {:>12} {:>12}'.format('Stage', 'Count', 'Time (ms)',
+                                                       'Read (MB)', 'Peak (MB)')]
+    for name, count, duration, bytes_read, peak_memory in get_summary(records):
+        peak = '-' if peak_memory is None else '{:.1f}'.format(peak_memory / 1024 ** 2)
+        lines.append('{:<24} {:>6} {:>12.1f} {:>12.1f} {:>12}'.format(
+            name, count, duration * 1000, bytes_read / 1024 ** 2, peak))
+    return '\n'.join(lines)
+
+
+def export_json_lines(filename, records=None):
+    ''' Save records (all records made if not given) to a file, one JSON object per line
+    '''
+    if records is None:
+        records = get_records()
+    with open(filename, 'w') as records_file:
+        for record in records:
+            records_file.write(json.dumps(record, default=str) + '\n')
+
+
+def export_chrome_trace(filename, records=None):
+    ''' Save records (all records made if not given) as a trace that can be viewed in
+        chrome://tracing or Perfetto, with a complete event for each stage
+    '''
+    if records is None:
+        records = get_records()
+    events = []
+    # Threads are numbered in the trace, with a metadata event naming each
+    thread_ids = {}
+    for record in records:
+        thread_key = (record['pid'], record.get('thread', ''))
+        if thread_key not in thread_ids:
+            thread_ids[thread_key] = len(thread_ids)
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': record['pid'],
+                           'tid': thread_ids[thread_key], 'args': {'name': thread_key[1]}})
+        args = {key: value for key, value in record.items()
+                if key not in ('stage', 'start', 'duration', 'depth', 'pid', 'thread')}
+        events.append({'name': record['stage'], 'ph': 'X', 'ts': record['start'] * 1e6,
+                       'dur': record['duration'] * 1e6, 'pid': record['pid'],
+                       'tid': thread_ids[thread_key], 'args': args})
+    with open(filename, 'w') as trace_file:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, trace_file, default=str)
@@ -0,0 +1,261 @@
+''' Extracts LED profiles of every tile from LPD data and fits models to many profiles at once, so
+    LED runs can be classified for whole supermodules rather than one profile at a time
+'''
+
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import analysis
+import extract_data
+import pedestal
+
+# Tolerances for the relative change of the sum of squares and of the parameters between
+# iterations at which a fit has converged - the defaults of scipy.optimize.curve_fit()
+FTOL = 1.49012e-8
+XTOL = 1.49012e-8
+MAX_ITERATIONS = 1000
+
+
+def sigmoid(x_vals, k, x_0, L):
+    ''' Sigmoid falling from L to 0 around x_0, with steepness k
+    '''
+    return L / (1.0 + np.exp(-k * (x_0 - x_vals)))
+
+
+def sigmoid_jacobian(x_vals, k, x_0, L):
+    ''' Derivatives of sigmoid() with respect to each of its parameters, (..., len(x_vals), 3)
+    '''
+    exp_term = np.exp(-k * (x_0 - x_vals))
+    denominator = 1.0 + exp_term
+    d_k = L * exp_term * (x_0 - x_vals) / denominator ** 2
+    d_x_0 = L * exp_term * k / denominator ** 2
+    d_L = 1.0 / denominator
+    return np.stack(np.broadcast_arrays(d_k, d_x_0, d_L), axis=-1)
+
+
+def sigmoid_initial_params(x_vals, profiles):
+    ''' Initial parameters of a sigmoid fit to each profile (number of profiles, values): L is the
+        maximum of the profile and x_0 is where it last drops below half of that
+    '''
+    L = np.max(profiles, axis=-1)
+    above_half = profiles >= L[:, np.newaxis] / 2
+    # Index of the last value above half the maximum
+    last_above = profiles.shape[-1] - 1 - np.argmax(above_half[:, ::-1], axis=-1)
+    x_0 = x_vals[last_above]
+    k = np.ones(len(profiles))
+    return np.stack([k, x_0, L], axis=-1)
+
+
+def exp_rolloff(x_vals, a, b, c):
+    ''' Constant c, rolling off exponentially as x_vals increase
+    '''
+    return c - a * np.exp(b * x_vals)
+
+
+def exp_rolloff_jacobian(x_vals, a, b, c):
+    ''' Derivatives of exp_rolloff() with respect to each of its parameters, (..., len(x_vals), 3)
+    '''
+    exp_term = np.exp(b * x_vals)
+    d_a = -exp_term
+    d_b = -a * x_vals * exp_term
+    d_c = np.ones_like(exp_term)
+    return np.stack(np.broadcast_arrays(d_a, d_b, d_c), axis=-1)
+
+
+def exp_rolloff_initial_params(x_vals, profiles):
+    ''' Initial parameters of an exponential rolloff fit to each profile: c is the maximum of the
+        profile and the rolloff reaches the last value of the profile with a = 1
+    '''
+    c = np.max(profiles, axis=-1)
+    rolloff = np.maximum(c - profiles[:, -1], 1.0)
+    b = np.log(rolloff) / (x_vals[-1] - x_vals[0])
+    a = np.ones(len(profiles))
+    return np.stack([a, b, c], axis=-1)
+
+
+# Function, derivatives and initial parameters of each model that can be fitted
+MODELS = {
+    'sigmoid': (sigmoid, sigmoid_jacobian, sigmoid_initial_params),
+    'exp_rolloff': (exp_rolloff, exp_rolloff_jacobian, exp_rolloff_initial_params),
+}
+
+
+def evaluate_model(model_fn, x_vals, params):
+    ''' Evaluate a model at x_vals for each set of parameters (number of profiles, parameters)
+        Returns an array (number of profiles, len(x_vals))
+    '''
+    return model_fn(x_vals, *[param[:, np.newaxis] for param in params.T])
+
+
+def fit_profiles(x_vals, profiles, model_name, init_params=None, max_iterations=MAX_ITERATIONS):
+    ''' Fit a model (a key of MODELS) to every profile (number of profiles, len(x_vals)) at once,
+        with the Levenberg-Marquardt algorithm used by scipy.optimize.curve_fit() - each iteration
+        updates all profiles that haven't converged with a single set of array operations
+        init_params - initial parameters (number of profiles, 3), estimated from the profiles if not
+            given
+        Returns (params, errors, chisq_dof, converged): the fitted parameters and their standard
+        errors (number of profiles, 3), the reduced chi-squared of each fit and whether it converged
+    '''
+    model_fn, jacobian_fn, initial_params_fn = MODELS[model_name]
+    x_vals = np.asarray(x_vals, dtype=np.float64)
+    profiles = np.atleast_2d(np.asarray(profiles, dtype=np.float64))
+    if init_params is None:
+        params = initial_params_fn(x_vals, profiles)
+    else:
+        params = np.array(np.broadcast_to(init_params, (len(profiles), 3)), dtype=np.float64)
+
+    num_params = params.shape[-1]
+    damping = np.full(len(profiles), 1e-3)
+    converged = np.zeros(len(profiles), dtype=bool)
+
+    # Parameters outside the range of the model (e.g. overflowing exponentials) give infinite or
+    # nan sums of squares, which are never accepted
+    with np.errstate(over='ignore', invalid='ignore', divide='ignore'):
+        residuals = profiles - evaluate_model(model_fn, x_vals, params)
+        sum_squares = np.sum(np.square(residuals), axis=-1)
+
+        for _ in range(max_iterations):
+            active = ~converged
+            if not np.any(active):
+                break
+
+            jacobian = jacobian_fn(x_vals, *[param[active, np.newaxis] for param in params.T])
+            jtj = np.matmul(np.swapaxes(jacobian, -1, -2), jacobian)
+            gradient = np.matmul(np.swapaxes(jacobian, -1, -2),
+                                 residuals[active, :, np.newaxis])[..., 0]
+
+            # Scale damping by the diagonal of J^T J, as in MINPACK
+            diagonal = np.diagonal(jtj, axis1=-2, axis2=-1)
+            diagonal = np.maximum(diagonal, 1e-12 * np.max(diagonal, axis=-1, keepdims=True))
+            damped = jtj + (damping[active, np.newaxis] * diagonal)[..., np.newaxis] * \
+                np.eye(num_params)
+            step = np.linalg.solve(damped, gradient[..., np.newaxis])[..., 0]
+
+            new_params = params[active] + step
+            new_residuals = profiles[active] - evaluate_model(model_fn, x_vals, new_params)
+            new_sum_squares = np.sum(np.square(new_residuals), axis=-1)
+
+            # Steps that reduce the sum of squares are taken and the damping reduced, otherwise the
+            # damping is increased to take a shorter step closer to gradient descent
+            improved = np.isfinite(new_sum_squares) & (new_sum_squares <= sum_squares[active])
+            active_index = np.flatnonzero(active)
+            taken = active_index[improved]
+            reduction = (sum_squares[taken] - new_sum_squares[improved]) / \
+                np.maximum(sum_squares[taken], np.finfo(np.float64).tiny)
+            param_change = np.linalg.norm(step[improved], axis=-1) / \
+                (np.linalg.norm(params[taken], axis=-1) + XTOL)
+
+            params[taken] = new_params[improved]
+            residuals[taken] = new_residuals[improved]
+            sum_squares[taken] = new_sum_squares[improved]
+            damping[taken] /= 10
+            damping[active_index[~improved]] *= 10
+
+            converged[taken] = (reduction < FTOL) | (param_change < XTOL)
+            # Fits which can't be improved at all have reached the best they can
+            converged[active_index[~improved]] = damping[active_index[~improved]] > 1e16
+
+        # Covariance of the parameters scaled by the residual variance, as curve_fit() does
+        num_dof = profiles.shape[-1] - num_params
+        # (J^T J)^-1 is found from the SVD of J, ignoring singular values too small to be trusted
+        jacobian = jacobian_fn(x_vals, *[param[:, np.newaxis] for param in params.T])
+        _, singular_values, vt = np.linalg.svd(jacobian, full_matrices=False)
+        cutoff = np.finfo(np.float64).eps * max(jacobian.shape[-2:]) * singular_values[:, :1]
+        inverse_squares = np.where(singular_values > cutoff, 1 / singular_values ** 2, 0)
+        covariance = np.matmul(np.swapaxes(vt, -1, -2) * inverse_squares[:, np.newaxis, :], vt)
+        covariance *= (sum_squares / num_dof)[:, np.newaxis, np.newaxis]
+        errors = np.sqrt(np.diagonal(covariance, axis1=-2, axis2=-1))
+
+        # Pearson's chi-squared (as scipy.stats.chisquare()) per degree of freedom
+        expected = profiles - residuals
+        chisq_dof = np.sum(np.square(residuals) / expected, axis=-1) / num_dof
+
+    return (params, errors, chisq_dof, converged)
+
+
+def get_trigger_image(lpd_data, metadata, trigger=None, memory_limit=extract_data.MEMORY_LIMIT):
+    ''' Returns the mean image of lpd_data, reading it in blocks, with the pedestal of the
+        registered dark run (if any) subtracted. If trigger is given, only that image of each train
+        is included (e.g. 5 for the 6th trigger)
+        Raises ValueError if trigger isn't an image of the file's trains
+    '''
+    if trigger is None:
+        mean_image = extract_data.get_pixel_statistics(lpd_data, memory_limit=memory_limit).mean()
+        return pedestal.subtract_pedestal(mean_image)
+
+    images_per_train = extract_data.get_num_images_per_train(metadata)
+    if not 0 <= trigger < min(images_per_train, lpd_data.shape[0]):
+        raise ValueError('Trigger {} is out of range - the file has {} images per train and {} '
+                         'images'.format(trigger, images_per_train, lpd_data.shape[0]))
+    image_bytes = lpd_data.shape[1] * lpd_data.shape[2] * lpd_data.dtype.itemsize
+    trains_per_block = max(1, memory_limit // image_bytes)
+
+    total = np.zeros(lpd_data.shape[1:], dtype=np.int64)
+    num_images = 0
+    block_step = images_per_train * trains_per_block
+    for start in range(trigger, lpd_data.shape[0], block_step):
+        images = lpd_data[start:start + block_step:images_per_train]
+        total += np.sum(images, axis=0, dtype=np.int64)
+        num_images += images.shape[0]
+    return pedestal.subtract_pedestal(total / num_images)
+
+
+def get_tile_profiles(image, axis='row'):
+    ''' Returns the profile of every tile of a supermodule image, in the order of
+        analysis.get_supermodule_tiles(): the mean of each row (16, 32) for 'row' profiles, or of
+        each column (16, 128) for 'column' profiles
+    '''
+    tiles = analysis.get_tile_stack(image, analysis.get_supermodule_tile_positions())
+    if axis == 'row':
+        return np.mean(tiles, axis=-1)
+    elif axis == 'column':
+        return np.mean(tiles, axis=-2)
+    raise ValueError('Unknown profile axis: {}'.format(axis))
+
+
+def fit_tile_profiles(profiles, model_names=tuple(MODELS)):
+    ''' Fit each model to a stack of profiles (..., values), using the position of each value as x
+        Returns a dict of the results of fit_profiles() for each model, with the leading axes of
+        profiles restored
+    '''
+    profiles = np.asarray(profiles, dtype=np.float64)
+    x_vals = np.arange(profiles.shape[-1], dtype=np.float64)
+    flat_profiles = profiles.reshape(-1, profiles.shape[-1])
+
+    fits = {}
+    for model_name in model_names:
+        results = fit_profiles(x_vals, flat_profiles, model_name)
+        fits[model_name] = tuple(result.reshape(profiles.shape[:-1] + result.shape[1:])
+                                 for result in results)
+    return fits
+
+
+def fit_file(lpd_file_name, trigger=None, axis='row', memory_limit=extract_data.MEMORY_LIMIT):
+    ''' Extract the profile of every tile in a data file and fit each model to them
+        Returns the profiles and a dict of fit results, as fit_tile_profiles()
+    '''
+    with extract_data.LPDFile(lpd_file_name) as lpd_file:
+        image = get_trigger_image(lpd_file.dataset, lpd_file, trigger, memory_limit)
+    profiles = get_tile_profiles(image, axis)
+    return (profiles, fit_tile_profiles(profiles))
+
+
+def fit_files(lpd_file_names, trigger=None, axis='row', max_workers=None,
+              memory_limit=extract_data.MEMORY_LIMIT):
+    ''' Fit the tile profiles of many files in parallel, one file per process. Workers subtract the
+        same pedestal as this process
+        Returns the profiles (number of files, 16, values) and a dict of fit results for each model,
+        each array with the files along the first axis
+    '''
+    num_files = len(lpd_file_names)
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=pedestal.register_dark_run,
+                             initargs=(pedestal.get_dark_file_name(),)) as executor:
+        file_fits = list(executor.map(fit_file, lpd_file_names, [trigger] * num_files,
+                                      [axis] * num_files, [memory_limit] * num_files))
+
+    profiles = np.stack([profiles for profiles, _ in file_fits])
+    fits = {model_name: tuple(np.stack([fits[model_name][result] for _, fits in file_fits])
+                              for result in range(4))
+            for model_name in MODELS}
+    return (profiles, fits)
@@ -0,0 +1,223 @@
+''' Live analysis of a data file while it's still being written, giving early feedback on faults
+    during long runs. The file is opened in SWMR (single writer, multiple reader) mode and each new
+    train is added to running statistics as it appears. Run as a script to plot a tile live - see
+    --help for the options, and synthetic_data.write_live_lpd_file() to try it without the DAQ
+'''
+
+import argparse
+import time
+
+import h5py
+import numpy as np
+
+import analysis
+import extract_data
+import pedestal
+from pixel_statistics import PixelStatistics
+
+# Seconds between checks for new trains
+POLL_INTERVAL = 0.5
+
+# Minimum seconds between updates of the results (and plots), however quickly trains arrive
+REFRESH_INTERVAL = 2
+
+# Seconds without a new train after which a file that isn't complete is given up on
+IDLE_TIMEOUT = 60
+
+
+class LiveAnalysis():
+    ''' Running statistics and test results of a tile (or all tiles of a supermodule if tile_position
+        is None) of a file being written. Only whole trains are added, so the results always cover
+        complete trains. Can be used as a context manager
+    '''
+
+    def __init__(self, filename, tile_position=None):
+        self.filename = filename
+        self.tile_position = tile_position
+        if tile_position is None:
+            self.statistics = PixelStatistics((256, 256))
+        else:
+            self.statistics = PixelStatistics((32, 128))
+        self._file = None
+        self._dataset = None
+        self.images_per_train = None
+        self.expected_images = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def open(self):
+        ''' Open the file for reading while it's written. The metadata must already be in the file
+        '''
+        self._file = h5py.File(self.filename, 'r', libver='latest', swmr=True)
+        self._dataset = extract_data.get_lpd_dataset(self._file)
+        metadata = extract_data.get_file_metadata(self._file)
+        self.images_per_train = extract_data.get_num_images_per_train(metadata)
+        self.expected_images = extract_data.get_total_num_images(metadata)
+
+    def close(self):
+        ''' Close the file - the statistics accumulated so far are kept
+        '''
+        if self._file is not None:
+            self._file.close()
+        self._file = None
+        self._dataset = None
+
+    @property
+    def num_images(self):
+        ''' Number of images added so far
+        '''
+        return self.statistics.count
+
+    @property
+    def is_complete(self):
+        ''' Whether every image the metadata says the file will hold has been added
+        '''
+        return self.expected_images is not None and self.num_images >= self.expected_images
+
+    def update(self, memory_limit=extract_data.MEMORY_LIMIT):
+        ''' Add any whole trains written since the last update, opening the file if needed
+            Returns the number of images added
+        '''
+        if self._file is None:
+            try:
+                self.open()
+            except (OSError, KeyError):
+                # The writer hasn't created the file, or switched it to SWMR mode, yet
+                self.close()
+                return 0
+        self._dataset.refresh()
+        available = self._dataset.shape[0] - self._dataset.shape[0] % self.images_per_train
+        start = self.num_images
+        if available <= start:
+            return 0
+
+        for image_data in extract_data.get_image_chunks(self._dataset, self.tile_position,
+                                                        memory_limit, start, available):
+            self.statistics.add(image_data)
+        return available - start
+
+    def get_results(self):
+        ''' Returns the mean, stdev and fault tiles and the results table of the images added so
+            far, as analysis.analyse_tile() - or stacks of every tile, as
+            analysis.analyse_supermodule(), if no tile position was given
+        '''
+        if self.tile_position is None:
+            tile_positions = analysis.get_supermodule_tile_positions()
+            mean_tile = analysis.get_tile_stack(
+                pedestal.subtract_pedestal(self.statistics.mean()), tile_positions)
+            stdev_tile = analysis.get_tile_stack(self.statistics.stdev(), tile_positions)
+            tile = slice(None)
+        else:
+            mean_tile = pedestal.subtract_pedestal(self.statistics.mean(), self.tile_position)
+            stdev_tile = self.statistics.stdev()
+            tile = analysis.get_tile_index(self.tile_position)
+
+        fault_tile, table_values = analysis.test_tile(mean_tile, stdev_tile, tile=tile)
+        return (mean_tile, stdev_tile, fault_tile, table_values)
+
+
+def run_live_analysis(filename, tile_position=None, update_callback=None,
+                      poll_interval=POLL_INTERVAL, refresh_interval=REFRESH_INTERVAL,
+                      idle_timeout=IDLE_TIMEOUT, memory_limit=extract_data.MEMORY_LIMIT):
+    ''' Follow a file as it's written until every image in its metadata has been analysed, or no
+        new train has arrived for idle_timeout seconds
+        update_callback - called with the LiveAnalysis and the results of get_results() whenever
+            new trains have been added, at most once every refresh_interval seconds and once more
+            at the end
+        Returns the final results, as LiveAnalysis.get_results()
+    '''
+    with LiveAnalysis(filename, tile_position) as live_analysis:
+        last_image_time = time.time()
+        last_refresh = 0
+        refresh_needed = False
+        while True:
+            if live_analysis.update(memory_limit) > 0:
+                last_image_time = time.time()
+                refresh_needed = True
+
+            finished = live_analysis.is_complete or \
+                time.time() - last_image_time > idle_timeout
+            if refresh_needed and (finished or time.time() - last_refresh >= refresh_interval):
+                results = live_analysis.get_results()
+                if update_callback is not None:
+                    update_callback(live_analysis, results)
+                last_refresh = time.time()
+                refresh_needed = False
+            if finished:
+                break
+            time.sleep(poll_interval)
+
+        if live_analysis.num_images == 0:
+            raise ValueError('No complete trains were written to {}'.format(filename))
+        return live_analysis.get_results()
+
+
+def format_fault_counts(table_values):
+    ''' Returns the totals of bad chips, columns and pixels in a results table, as text
+    '''
+    overall_total = np.asarray(table_values)[-1]
+    return 'Bad chips: {}, bad columns: {}, bad pixels: {}'.format(*overall_total)
+
+
+def parse_args():
+    ''' Parse command line arguments
+    '''
+    parser = argparse.ArgumentParser(
+        description='Plot the analysis of a tile of an LPD data file while it is being written')
+    parser.add_argument('filename', help='Data file (.h5) being written in SWMR mode')
+    parser.add_argument('--tile', choices=analysis.TILE_ORIENTATIONS, default='Left Tile',
+                        help='Tile orientation')
+    parser.add_argument('--mini-connector', type=int, choices=analysis.MINI_CONNECTORS,
+                        default=1, help='Mini connector of the tile')
+    parser.add_argument('--refresh-interval', type=float, default=REFRESH_INTERVAL,
+                        help='Minimum seconds between updates of the plots')
+    parser.add_argument('--idle-timeout', type=float, default=IDLE_TIMEOUT,
+                        help='Seconds without a new train before giving up on the file')
+    parser.add_argument('--dark-run', default=None,
+                        help='Dark run (.h5) whose pedestal is subtracted from the mean data')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    import matplotlib.pyplot as plt
+
+    import fault_tiles
+    import plot
+    import test_data
+
+    args = parse_args()
+    pedestal.register_dark_run(args.dark_run)
+    tile_position = extract_data.set_tile_position(args.tile, args.mini_connector)
+
+    mean_fig, mean_tile_plot, mean_tile_colorbar, mean_histogram = plot.setup_test_plots(1)
+    stdev_fig, stdev_tile_plot, stdev_tile_colorbar, stdev_histogram = plot.setup_test_plots(2)
+    fault_fig, fault_tile_plot, _ = plot.setup_fault_plots()
+    mean_tile_image = plot.setup_data_plot(mean_tile_plot, (32, 128), mean_tile_colorbar, 0)
+    mean_histogram_bars = plot.setup_histogram(mean_histogram)
+    stdev_tile_image = plot.setup_data_plot(stdev_tile_plot, (32, 128), stdev_tile_colorbar, 1)
+    stdev_histogram_bars = plot.setup_histogram(stdev_histogram)
+    fault_tile_image = plot.setup_data_plot(fault_tile_plot, (32, 128), colorbar_type=2)
+    plt.show(block=False)
+
+    def update_plots(live_analysis, results):
+        mean_tile, stdev_tile, fault_tile, table_values = results
+        test_data.update_figure(mean_tile, mean_tile_image, mean_histogram, mean_histogram_bars)
+        test_data.update_figure(stdev_tile, stdev_tile_image, stdev_histogram,
+                                stdev_histogram_bars)
+        fault_tiles.update_fault_plot(fault_tile_image, fault_tile)
+        for figure in (mean_fig, stdev_fig, fault_fig):
+            figure.suptitle('{} of {} images'.format(live_analysis.num_images,
+                                                     live_analysis.expected_images))
+            figure.canvas.draw_idle()
+        print('{} images - {}'.format(live_analysis.num_images,
+                                      format_fault_counts(table_values)))
+        # Process events so the figures are redrawn
+        plt.pause(0.001)
+
+    run_live_analysis(args.filename, tile_position, update_plots,
+                      refresh_interval=args.refresh_interval, idle_timeout=args.idle_timeout)
+    plt.show()
@@ -0,0 +1,111 @@
+''' Pedestal (dark) subtraction - the mean of each pixel in a dark run is subtracted from the mean
+    data of other runs, so detector offsets aren't mixed into fault decisions
+'''
+
+import hashlib
+import os
+
+import numpy as np
+
+import extract_data
+
+# Default directory pedestal maps are cached in
+PEDESTAL_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'lpd_tile_testing', 'pedestals')
+
+# Pedestal maps calculated or loaded this session, by key - shared by every run they're used with
+_session_pedestals = {}
+
+# Dark run currently registered, its key and pedestal map - None when no pedestal is subtracted
+_dark_file_name = None
+_pedestal_key = None
+_pedestal = None
+
+
+def get_pedestal_key(dark_file_name):
+    ''' Returns the key a dark run's pedestal map is cached under: a hash of the file's path, size
+        and modification time
+    '''
+    file_stat = os.stat(dark_file_name)
+    key_values = (os.path.abspath(dark_file_name), file_stat.st_size, file_stat.st_mtime_ns)
+    return hashlib.sha1(repr(key_values).encode()).hexdigest()
+
+
+def calculate_pedestal(lpd_data, memory_limit=extract_data.MEMORY_LIMIT):
+    ''' Calculate the pedestal map of a dark run - the mean of each pixel - in one pass over the
+        data. Stored as 32 bit floats, a quarter of the size of the sums it's calculated from
+    '''
+    statistics = extract_data.get_pixel_statistics(lpd_data, memory_limit=memory_limit)
+    return statistics.mean().astype(np.float32)
+
+
+def get_pedestal(dark_file_name, memory_limit=extract_data.MEMORY_LIMIT,
+                 cache_path=PEDESTAL_PATH):
+    ''' Returns the pedestal map of a dark run, only calculating it if it hasn't been already - in
+        this session or (as it's cached on disk) a previous one
+    '''
+    key = get_pedestal_key(dark_file_name)
+    if key in _session_pedestals:
+        return _session_pedestals[key]
+
+    cache_filename = os.path.join(cache_path, '{}.npy'.format(key))
+    try:
+        pedestal = np.load(cache_filename)
+    except (OSError, ValueError):
+        with extract_data.LPDFile(dark_file_name) as lpd_file:
+            pedestal = calculate_pedestal(lpd_file.dataset, memory_limit)
+
+        # Written to a temporary file first so other processes never see a partial file
+        os.makedirs(cache_path, exist_ok=True)
+        temp_filename = '{}.{}.tmp'.format(cache_filename, os.getpid())
+        with open(temp_filename, 'wb') as temp_file:
+            np.save(temp_file, pedestal)
+        os.replace(temp_filename, cache_filename)
+
+    _session_pedestals[key] = pedestal
+    return pedestal
+
+
+def register_dark_run(dark_file_name, memory_limit=extract_data.MEMORY_LIMIT,
+                      cache_path=PEDESTAL_PATH):
+    ''' Subtract the pedestal of a dark run from all data analysed from now on
+        dark_file_name - None to stop subtracting a pedestal
+    '''
+    global _dark_file_name, _pedestal_key, _pedestal
+    if dark_file_name is None:
+        _dark_file_name = None
+        _pedestal_key = None
+        _pedestal = None
+        return
+
+    _pedestal = get_pedestal(dark_file_name, memory_limit, cache_path)
+    _pedestal_key = get_pedestal_key(dark_file_name)
+    _dark_file_name = dark_file_name
+
+
+def get_dark_file_name():
+    ''' Returns the filename of the registered dark run, or None if there isn't one
+    '''
+    return _dark_file_name
+
+
+def get_pedestal_version():
+    ''' Returns the key of the registered pedestal, or None if no pedestal is subtracted
+    '''
+    return _pedestal_key
+
+
+def subtract_pedestal(data, tile_position=None):
+    ''' Subtract the registered pedestal from mean data or from single images, returning data
+        unchanged if no dark run is registered. data is either the tile at tile_position (or a stack
+        of them), or full images if no position is given.
+        Standard deviations don't need the pedestal subtracted - a constant offset doesn't change them
+    '''
+    if _pedestal is None:
+        return data
+
+    if tile_position is None:
+        pedestal = _pedestal
+    else:
+        pedestal = _pedestal[tile_position[0]:tile_position[0] + 32,
+                             tile_position[1]:tile_position[1] + 128]
+    return data - pedestal
@@ -0,0 +1,87 @@
+''' Calculates statistics of every pixel while streaming through the images in a file
+'''
+
+import numpy as np
+
+
+class PixelStatistics():
+    ''' Accumulates the number of images, and the sum and sum of squares of each pixel, as blocks of
+        images are added. This gives the mean and standard deviation of every pixel from a single
+        pass over the data, holding only a few arrays the size of one image in memory.
+
+        Integer data (i.e. raw ADC values) is summed exactly in 64 bit integers, so the results
+        don't depend on how the images were split into blocks or the order they were added in, and
+        statistics of separate blocks (e.g. from different processes) can be combined with merge().
+        The mean and standard deviation then agree with np.mean() and np.std() of the whole stack to
+        within floating point rounding - a relative difference of less than 1e-12.
+        Floating point data is summed in 64 bit floats, which loses precision when the standard
+        deviation is many orders of magnitude smaller than the mean.
+    '''
+
+    def __init__(self, shape=(256, 256)):
+        self.shape = tuple(shape)
+        self.count = 0
+        self.total = None
+        self.total_squared = None
+
+    def add(self, images):
+        ''' Add a block of images, with shape (number of images, rows, columns)
+        '''
+        if images.shape[0] == 0:
+            return
+
+        if np.issubdtype(images.dtype, np.integer):
+            images = images.astype(np.int64)
+        else:
+            images = images.astype(np.float64)
+
+        if self.total is None:
+            self.total = np.zeros(self.shape, dtype=images.dtype)
+            self.total_squared = np.zeros(self.shape, dtype=images.dtype)
+        elif self.total.dtype != images.dtype:
+            # Mixing integer and float blocks - carry on with float sums
+            self.total = self.total.astype(np.float64)
+            self.total_squared = self.total_squared.astype(np.float64)
+
+        self.count += images.shape[0]
+        self.total += np.sum(images, axis=0)
+        # Square in place to avoid another temporary copy of the block
+        self.total_squared += np.sum(np.square(images, out=images), axis=0)
+
+    def merge(self, other):
+        ''' Combine the images accumulated in another PixelStatistics object with this one
+        '''
+        if other.total is None:
+            return
+
+        if self.total is None:
+            self.total = other.total.copy()
+            self.total_squared = other.total_squared.copy()
+        elif self.total.dtype == other.total.dtype:
+            self.total += other.total
+            self.total_squared += other.total_squared
+        else:
+            self.total = self.total + other.total.astype(np.float64)
+            self.total_squared = self.total_squared + other.total_squared.astype(np.float64)
+        self.count += other.count
+
+    def mean(self):
+        ''' Return the mean of each pixel of the images added
+        '''
+        return self.total / self.count
+
+    def stdev(self):
+        ''' Return the (population) standard deviation of each pixel of the images added
+        '''
+        if np.issubdtype(self.total.dtype, np.integer):
+            # n * sum(x^2) - sum(x)^2 is calculated exactly with Python ints, which avoids both the
+            # overflow of int64 and the cancellation of floats. It's only done once per pixel
+            total = self.total.astype(object)
+            variance_numerator = self.count * self.total_squared.astype(object) - total * total
+            variance = variance_numerator.astype(np.float64) / self.count ** 2
+        else:
+            mean = self.total / self.count
+            variance = self.total_squared / self.count - np.square(mean)
+            # Rounding can make the variance of a constant pixel slightly negative
+            np.maximum(variance, 0, out=variance)
+        return np.sqrt(variance)
@@ -6,6 +6,9 @@ import matplotlib.gridspec as gridspec
 import matplotlib.patches as mpatches
 import matplotlib.cm as cm
 import matplotlib.colors as colors
+import matplotlib.collections as mcollections
+from matplotlib import rcParams
+import numpy as np
 
 
 def setup_test_plots(test_type):
@@ -91,6 +94,32 @@ def setup_first_image_plot():
     return (fig_first_image, first_image_plot, first_image_colorbar)
 
 
+def setup_preview_plots(thumbnail_size=64):
+    ''' Create figure & plots for the preview of a file - thumbnails of its first image, mean and
+        stdev and a histogram of its raw values. The thumbnails are created once, so previews can be
+        shown with update_data_plot()
+        Returns (figure, list of thumbnail images, histogram plot)
+    '''
+    fig_preview = plt.figure(figsize=(8, 2.5), num='File Preview')
+    gs_preview = gridspec.GridSpec(1, 4, width_ratios=[1, 1, 1, 2], wspace=0.3)
+
+    thumbnail_images = []
+    titles = ('First Image', 'Mean', 'Stdev')
+    colorbar_types = (0, 0, 1)
+    for plot_pos, (title, colorbar_type) in enumerate(zip(titles, colorbar_types)):
+        thumbnail_plot = fig_preview.add_subplot(gs_preview[0, plot_pos])
+        thumbnail_plot.set_title(title, fontsize=10)
+        disable_ticks(thumbnail_plot)
+        cmap_name, c_ticks, data_max = get_colorbar_settings(colorbar_type)
+        thumbnail_images.append(thumbnail_plot.imshow(np.zeros((thumbnail_size, thumbnail_size)),
+                                                      cmap=cmap_name, vmin=0, vmax=data_max))
+
+    preview_histogram = fig_preview.add_subplot(gs_preview[0, 3])
+    preview_histogram.set_title('Histogram of Raw Data', fontsize=10)
+
+    return (fig_preview, thumbnail_images, preview_histogram)
+
+
 def disable_ticks(ax):
     ''' Disable ticks on both x & y axis - used to remove them from colorbars and image/tile plots
     '''
@@ -105,7 +134,8 @@ def disable_ticks(ax):
 def set_plot_titles(mean_tile_plot, mean_histogram, stdev_tile_plot, stdev_histogram,
                     fault_tile_plot, trigger_plots, first_image_plot):
     ''' Set titles of all plots and remove ticks on images
-        Titles are removed on each gca() call so must be re-set for every analysis done
+        Titles are removed by cla(), so must be re-set if plots are cleared. Plots whose artists are
+        updated in place (see setup_data_plot()) only need this done once
     '''
     mean_tile_plot.set_title("Plot of Tile Using Mean Data", fontsize=16)
     mean_histogram.set_title("Histogram of Mean Tile Data", fontsize=16)
@@ -133,6 +163,44 @@ def display_data_plot(ax, data, colorbar=None, colorbar_type=0):
             1 - Colorbar for image using standard deviation data
             2 - Colorbar for showing tile's faults
     '''
+    cmap_name, c_ticks, data_max = get_colorbar_settings(colorbar_type)
+    image = ax.imshow(data, cmap=cmap_name, vmin=0, vmax=data_max)
+
+    if colorbar is not None:
+        add_colorbar(image, colorbar, colorbar_type)
+
+    add_separator_lines(ax, data.shape)
+
+
+def setup_data_plot(ax, shape, colorbar=None, colorbar_type=0):
+    ''' Creates the image, colorbar and separator lines of a plot once, so data can be displayed on
+        it with update_data_plot() without rebuilding the plot each time. Arguments are the same as
+        display_data_plot(), apart from shape (rows, cols) - the shape of data that will be displayed
+        Returns the image artist
+    '''
+    cmap_name, c_ticks, data_max = get_colorbar_settings(colorbar_type)
+    image = ax.imshow(np.zeros(shape), cmap=cmap_name, vmin=0, vmax=data_max)
+
+    if colorbar is not None:
+        add_colorbar(image, colorbar, colorbar_type)
+
+    add_separator_lines(ax, shape)
+    return image
+
+
+def update_data_plot(image, data, clim=None):
+    ''' Display new data on an image created by setup_data_plot()
+        clim - optional (min, max) tuple to change the colour scale of the image
+    '''
+    image.set_data(data)
+    if clim is not None:
+        image.set_clim(*clim)
+
+
+def get_colorbar_settings(colorbar_type):
+    ''' Returns the colormap name, colorbar ticks and max value of data displayed for each type of
+        colorbar - see display_data_plot()
+    '''
     # Use jet unless displaying fault plot
     cmap_name = 'jet'
 
@@ -150,32 +218,97 @@ def display_data_plot(ax, data, colorbar=None, colorbar_type=0):
         data_max = 2
         cmap_name = 'CMRmap_r'
 
-    image = ax.imshow(data, cmap=cmap_name, vmin=0, vmax=data_max)
+    return (cmap_name, c_ticks, data_max)
 
-    if colorbar is not None:
-        # Create and add colorbar
-        cbar = plt.colorbar(image, cax=colorbar)
-        cbar.set_ticks(ticks=c_ticks)
-
-        if colorbar_type == 2:
-            # Change ticks to strings to make them more understandable to user
-            string_ticks = ['No Fault', 'Fault in mean data', 'Fault in stdev. data']
-            # set_ticks() is executed before to get 3 ticks, instead of more
-            cbar.ax.set_yticklabels(string_ticks)
-
-    rows = data.shape[0]
-    cols = data.shape[1]
-    # Add vertical and horizontal lines to differentiate between chips and tiles
+
+def add_colorbar(image, colorbar, colorbar_type):
+    ''' Create and add colorbar for an image to the colorbar subplot
+    '''
+    c_ticks = get_colorbar_settings(colorbar_type)[1]
+    cbar = plt.colorbar(image, cax=colorbar)
+    cbar.set_ticks(ticks=c_ticks)
+
+    if colorbar_type == 2:
+        # Change ticks to strings to make them more understandable to user
+        string_ticks = ['No Fault', 'Fault in mean data', 'Fault in stdev. data']
+        # set_ticks() is executed before to get 3 ticks, instead of more
+        cbar.ax.set_yticklabels(string_ticks)
+
+
+def add_separator_lines(ax, shape):
+    ''' Add vertical and horizontal lines to differentiate between chips and tiles, all drawn as a
+        single collection
+    '''
+    rows = shape[0]
+    cols = shape[1]
+    segments = []
+    line_widths = []
     for i in range(16, cols, 16):
         # Separate chips
-        ax.vlines(i - 0.5, 0, rows - 1, color='k', linestyles='solid', linewidth=0.4)
-        # Add vertical lines to differentiate between tiles
-        ax.vlines(128 - 0.5, 0, rows - 1, color='k', linestyle='solid')
+        segments.append([(i - 0.5, 0), (i - 0.5, rows - 1)])
+        line_widths.append(0.4)
+    if cols > 16:
+        # Vertical line to differentiate between tiles
+        segments.append([(128 - 0.5, 0), (128 - 0.5, rows - 1)])
+        line_widths.append(rcParams['lines.linewidth'])
     for i in range(32, rows, 32):
-        ax.hlines(i - 0.5, 0, rows - 1, color='k', linestyles='solid')
+        segments.append([(0, i - 0.5), (rows - 1, i - 0.5)])
+        line_widths.append(rcParams['lines.linewidth'])
+
+    if segments:
+        ax.add_collection(mcollections.LineCollection(segments, colors='k', linestyles='solid',
+                                                      linewidths=line_widths))
 
 
 def display_histogram(ax, data):
     ''' Displays histograms
     '''
-    ax.hist(data.flatten(), bins=250)
\ No newline at end of file
+    counts, bin_edges = np.histogram(data.flatten(), bins=250)
+    display_steps(ax, counts, bin_edges)
+
+
+def display_counts(ax, counts):
+    ''' Displays a histogram of precomputed counts of each value (e.g. from histogram.Histogram),
+        without binning the data again. Only the range of values which occur is drawn
+    '''
+    values = np.flatnonzero(counts)
+    if values.size == 0:
+        return
+    first_value = values[0]
+    last_value = values[-1]
+
+    # Each value's bin is centred on it
+    bin_edges = np.arange(first_value, last_value + 2) - 0.5
+    display_steps(ax, counts[first_value:last_value + 1], bin_edges)
+
+
+def display_steps(ax, counts, bin_edges):
+    ''' Draw binned counts as a single filled outline with a step for each bin - much quicker to
+        draw than a bar for each bin
+    '''
+    # Last count is repeated to draw the final step
+    steps = ax.fill_between(bin_edges, np.append(counts, counts[-1]), step='post')
+    # Keep the bottom of the axis at 0, as with ax.hist()
+    steps.sticky_edges.y.append(0)
+
+
+def setup_histogram(ax, bins=250):
+    ''' Creates the bars of a histogram once, so they can be updated with update_histogram()
+        Returns the bars
+    '''
+    bars = ax.bar(np.zeros(bins), np.zeros(bins), width=0, align='edge')
+    return bars
+
+
+def update_histogram(ax, bars, data):
+    ''' Display a histogram of data on bars created by setup_histogram(), binned the same way as
+        display_histogram()
+    '''
+    counts, bin_edges = np.histogram(data.flatten(), bins=len(bars))
+    for bar, count, left, right in zip(bars, counts, bin_edges[:-1], bin_edges[1:]):
+        bar.set_x(left)
+        bar.set_width(right - left)
+        bar.set_height(count)
+
+    ax.relim()
+    ax.autoscale_view()
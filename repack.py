@@ -0,0 +1,151 @@
+''' Repacks LPD data files into a layout that's quick to analyse a tile at a time. Raw files are
+    chunked however the DAQ wrote them, so reading one tile across every image touches every chunk
+    of the file. Repacked files have one tile of a block of images in each chunk, compressed with a
+    fast filter, so a tile's analysis only reads that tile's chunks
+    Repacked copies are saved in extract_data.REPACKED_DIR next to the data files, and are read in
+    place of the data files by extract_data.LPDFile while they're up to date. Run as a script - see
+    --help for the options
+'''
+
+import argparse
+import os
+
+import h5py
+
+import extract_data
+import instrumentation
+
+try:
+    # Provides blosc (with lz4) compression, otherwise lzf is used
+    import hdf5plugin
+except ImportError:
+    hdf5plugin = None
+
+# Number of images in each chunk of a repacked file. Each chunk holds one tile (32 x 128) of these
+# images - 1 MB of uint16 data before compression
+CHUNK_IMAGES = 128
+
+# Compression filters repacked files can be written with
+COMPRESSION_TYPES = ('blosc-lz4', 'lzf')
+
+
+def get_compression_options(compression=None):
+    ''' Returns the keyword arguments of h5py create_dataset() for a compression type (from
+        COMPRESSION_TYPES). blosc-lz4 is used by default if hdf5plugin is installed, otherwise lzf.
+        Both shuffle the bytes of each value first, as neighbouring pixels have similar high bytes
+    '''
+    if compression is None:
+        compression = 'lzf' if hdf5plugin is None else 'blosc-lz4'
+
+    if compression == 'blosc-lz4':
+        if hdf5plugin is None:
+            raise ValueError('blosc-lz4 compression needs the hdf5plugin package')
+        return dict(hdf5plugin.Blosc(cname='lz4', clevel=5, shuffle=hdf5plugin.Blosc.SHUFFLE))
+    if compression == 'lzf':
+        return {'compression': 'lzf', 'shuffle': True}
+    raise ValueError('Unknown compression type {}'.format(compression))
+
+
+def repack_file(filename, compression=None, chunk_images=CHUNK_IMAGES,
+                memory_limit=extract_data.MEMORY_LIMIT):
+    ''' Write the repacked copy of a data file, with the images in the dataset data and the
+        metadata group (all its attributes and datasets, including readoutParamFile) copied to
+        metadata, whichever layout the data file has
+        Returns the filename of the repacked copy
+    '''
+    repacked_filename = extract_data.get_repacked_filename(filename)
+    os.makedirs(os.path.dirname(repacked_filename), exist_ok=True)
+    # Written under a temporary name so a partly written copy is never read in place of the file
+    temp_filename = repacked_filename + '.tmp'
+    file_stat = os.stat(filename)
+
+    with extract_data.LPDFile(filename, use_repacked=False) as lpd_file, \
+            h5py.File(temp_filename, 'w') as repacked_file:
+        lpd_dataset = lpd_file.dataset
+        num_images = lpd_dataset.shape[0]
+        chunks = (max(1, min(chunk_images, num_images)), 32, 128)
+        repacked_dataset = repacked_file.create_dataset(
+            'data', lpd_dataset.shape, dtype=lpd_dataset.dtype, chunks=chunks,
+            **get_compression_options(compression))
+
+        # Blocks are whole chunks of the repacked file, so each chunk is compressed once
+        image_bytes = 256 * 256 * lpd_dataset.dtype.itemsize
+        block_length = max(1, memory_limit // (image_bytes * chunks[0])) * chunks[0]
+        for start in range(0, num_images, block_length):
+            with instrumentation.stage('repack'):
+                block = slice(start, min(start + block_length, num_images))
+                image_data = lpd_dataset[block]
+                instrumentation.add_bytes_read(image_data.nbytes)
+                repacked_dataset[block] = image_data
+
+        lpd_file.file.copy(lpd_file.metadata, repacked_file, 'metadata')
+        repacked_file.attrs['sourceFile'] = os.path.basename(filename)
+        repacked_file.attrs['sourceSize'] = file_stat.st_size
+        repacked_file.attrs['sourceMtimeNs'] = file_stat.st_mtime_ns
+
+    os.replace(temp_filename, repacked_filename)
+    return repacked_filename
+
+
+def is_repacked(filename):
+    ''' Returns whether a data file has an up to date repacked copy which can be read
+    '''
+    repacked_filename = extract_data.get_repacked_filename(filename)
+    if not os.path.exists(repacked_filename):
+        return False
+    try:
+        with h5py.File(repacked_filename, 'r') as repacked_file:
+            return extract_data.is_repacked_file_current(repacked_file, filename)
+    except (OSError, KeyError):
+        return False
+
+
+def repack_directory(data_path, compression=None, chunk_images=CHUNK_IMAGES, force=False,
+                     memory_limit=extract_data.MEMORY_LIMIT):
+    ''' Repack every .h5 file in data_path without an up to date repacked copy (or every file if
+        force is True)
+        Returns a list of (filename, error) for any files which couldn't be repacked
+    '''
+    failed_files = []
+    for filename in sorted(os.listdir(data_path)):
+        file_path = os.path.join(data_path, filename)
+        if not filename.endswith('.h5') or not os.path.isfile(file_path):
+            continue
+        if not force and is_repacked(file_path):
+            continue
+        try:
+            repack_file(file_path, compression, chunk_images, memory_limit)
+            print('Repacked {}'.format(filename))
+        except (OSError, KeyError, ValueError) as error:
+            failed_files.append((filename, error))
+            print('Could not repack {}: {}'.format(filename, error))
+    return failed_files
+
+
+def parse_args():
+    ''' Parse command line arguments
+    '''
+    parser = argparse.ArgumentParser(
+        description='Repack LPD data files into a tile-chunked, compressed layout for analysis')
+    parser.add_argument('paths', nargs='+', help='Data files (.h5) or directories of them')
+    parser.add_argument('--compression', choices=COMPRESSION_TYPES, default=None,
+                        help='Compression filter (default: blosc-lz4 if hdf5plugin is installed, '
+                        'otherwise lzf)')
+    parser.add_argument('--chunk-images', type=int, default=CHUNK_IMAGES,
+                        help='Number of images in each chunk')
+    parser.add_argument('--force', action='store_true',
+                        help='Repack files even if they have an up to date repacked copy')
+    parser.add_argument('--memory-limit', type=int, default=extract_data.MEMORY_LIMIT,
+                        help='Maximum bytes of image data read at once')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    for path in args.paths:
+        if os.path.isdir(path):
+            repack_directory(path, args.compression, args.chunk_images, args.force,
+                             args.memory_limit)
+        elif args.force or not is_repacked(path):
+            print('Repacked {}'.format(repack_file(path, args.compression, args.chunk_images,
+                                                   args.memory_limit)))
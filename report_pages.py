@@ -0,0 +1,227 @@
+''' Renders each page of a tile's report once, in parallel worker processes, caching it as an image.
+    PDF reports of any combination of tiles and files are then assembled from the cached pages, so
+    regenerating or merging reports doesn't plot anything again
+'''
+
+import hashlib
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import matplotlib.image as mpimg
+import matplotlib.pyplot as plt
+import numpy as np
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.backends.backend_pdf import PdfPages
+from matplotlib.figure import Figure
+
+import analysis
+import analysis_cache
+import extract_data
+import generate_report
+import instrumentation
+import pedestal
+import threshold_maps
+
+# Default directory of cached pages and the total size they're limited to (bytes)
+PAGES_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'lpd_tile_testing', 'report_pages')
+PAGES_SIZE_LIMIT = 1024 * 1024 * 1024
+
+# Modules whose code determines how pages look - editing any of them invalidates every page
+REPORT_MODULES = ('generate_report', 'plot', 'fault_tiles', 'test_data', 'test_results',
+                  'threshold_maps')
+
+# Resolution pages are rendered at
+PAGE_DPI = 150
+
+_code_version = None
+
+
+def initialise_worker(threshold_filename=None, dark_file_name=None,
+                      pedestal_threshold_filename=None):
+    ''' Initialiser of worker processes - pages are only saved to file, so no display is needed.
+        Workers use the same threshold maps and pedestal as the process that started them
+    '''
+    plt.switch_backend('Agg')
+    threshold_maps.load_threshold_map(threshold_filename)
+    threshold_maps.load_threshold_map(pedestal_threshold_filename, pedestal_subtracted=True)
+    pedestal.register_dark_run(dark_file_name)
+
+
+def get_code_version():
+    ''' Returns a hash of the source of the report modules, calculated once per process
+    '''
+    global _code_version
+    if _code_version is None:
+        _code_version = analysis_cache.get_source_hash(REPORT_MODULES)
+    return _code_version
+
+
+def get_page_key(tile_results, tile_name, filename, data_path):
+    ''' Returns the key the pages of a tile are cached under: a hash of the tile's analysis results
+        (mean, stdev and fault tiles and results table), its name, the data file (whose metadata is
+        shown on the results page), the threshold map used and the version of the plotting code
+    '''
+    lpd_file_name = extract_data.get_lpd_filename(data_path, filename)
+    file_stat = os.stat(lpd_file_name)
+
+    page_hash = hashlib.sha1()
+    for result in tile_results:
+        result = np.ascontiguousarray(result)
+        page_hash.update(repr((result.dtype.str, result.shape)).encode())
+        page_hash.update(result.tobytes())
+    key_values = (tile_name, filename, os.path.abspath(lpd_file_name), file_stat.st_size,
+                  file_stat.st_mtime_ns, threshold_maps.get_map_version(),
+                  get_code_version(), PAGE_DPI)
+    page_hash.update(repr(key_values).encode())
+    return page_hash.hexdigest()
+
+
+def get_page_filenames(key, cache_path=PAGES_PATH):
+    ''' Returns the paths of the cached pages of the tile with the given key, in report order
+    '''
+    # One page for each figure of generate_report.create_tile_figures()
+    return [os.path.join(cache_path, '{}_{}.png'.format(key, page)) for page in range(4)]
+
+
+def render_tile_pages(tile_results, tile_name, filename, data_path, cache_path=PAGES_PATH,
+                      size_limit=PAGES_SIZE_LIMIT):
+    ''' Render the pages of a tile's report, unless they're already cached. The date of analysis
+        shown is the date the pages were first rendered
+        Returns the filenames of the pages
+    '''
+    key = get_page_key(tile_results, tile_name, filename, data_path)
+    page_filenames = get_page_filenames(key, cache_path)
+    if all(os.path.exists(page_filename) for page_filename in page_filenames):
+        for page_filename in page_filenames:
+            # Mark the pages as recently used so they're the last to be evicted
+            os.utime(page_filename)
+        return page_filenames
+
+    os.makedirs(cache_path, exist_ok=True)
+    lpd_file_name = extract_data.get_lpd_filename(data_path, filename)
+    with extract_data.LPDFile(lpd_file_name) as metadata:
+        fig_list = generate_report.create_tile_figures(*tile_results, tile_name, filename,
+                                                       data_path, metadata)
+    try:
+        with instrumentation.tag(file=filename, tile=tile_name), instrumentation.stage('render'):
+            for figure, page_filename in zip(fig_list, page_filenames):
+                # Written to a temporary file first so other processes never see a partial page
+                temp_filename = '{}.{}.tmp'.format(page_filename, os.getpid())
+                figure.savefig(temp_filename, format='png', dpi=PAGE_DPI)
+                os.replace(temp_filename, page_filename)
+    finally:
+        generate_report.close_figures(fig_list)
+
+    analysis_cache.evict_results(cache_path, size_limit, '.png')
+    return page_filenames
+
+
+def assemble_pdf(page_filenames, pdf_filename, title):
+    ''' Create a PDF from cached pages, in the order given
+    '''
+    with PdfPages(pdf_filename) as pdf_file:
+        for page_filename in page_filenames:
+            page = mpimg.imread(page_filename)
+            # A figure the exact size of the page, so the image is neither scaled nor resampled.
+            # Not created through pyplot, so it's never displayed in the notebook
+            figure = Figure(figsize=(page.shape[1] / PAGE_DPI, page.shape[0] / PAGE_DPI))
+            FigureCanvasAgg(figure)
+            figure.figimage(page)
+            pdf_file.savefig(figure, dpi=PAGE_DPI)
+
+        pdf_file.infodict()['Title'] = title
+
+
+def create_file_report(data_path, filename, output_path=None, cache_path=PAGES_PATH,
+                       size_limit=PAGES_SIZE_LIMIT, memory_limit=extract_data.MEMORY_LIMIT):
+    ''' Create the PDF report of a single file in this process, one tile at a time - for callers
+        that already spread files across worker processes. The file is analysed (and cached) first
+        if it hasn't been already
+        Returns the path of the report
+    '''
+    if output_path is None:
+        output_path = generate_report.DEFAULT_SAVE_PATH
+    os.makedirs(output_path, exist_ok=True)
+    data_path = os.path.join(data_path, '')
+    results = analysis_cache.analyse_supermodule(
+        extract_data.get_lpd_filename(data_path, filename), memory_limit)
+
+    page_filenames = []
+    for tile, tile_name in enumerate(analysis.get_supermodule_tile_names()):
+        tile_results = tuple(result[tile] for result in results)
+        page_filenames.extend(render_tile_pages(tile_results, tile_name, filename, data_path,
+                                                cache_path, size_limit))
+
+    report_filename = os.path.join(output_path, generate_report.get_report_filename(filename))
+    assemble_pdf(page_filenames, report_filename, 'Analysis of {}'.format(filename))
+    return report_filename
+
+
+def create_reports(data_path, file_list, output_path=None, max_workers=None, file_reports=True,
+                   combined_filename=None, cache_path=PAGES_PATH, size_limit=PAGES_SIZE_LIMIT,
+                   memory_limit=extract_data.MEMORY_LIMIT):
+    ''' Create PDF reports of every tile of the supermodule in the files of file_list, rendering the
+        pages of each tile in parallel. Files which haven't been analysed yet are analysed (and
+        cached) first
+        output_path - directory reports are saved in, generate_report.DEFAULT_SAVE_PATH by default
+        file_reports - whether to save a report of each file
+        combined_filename - if given, a single report of all files is saved with this name
+        Returns a list of the paths of the reports created, and a list of (filename, error) for any
+        files which couldn't be reported on - these are left out of the combined report
+    '''
+    if output_path is None:
+        output_path = generate_report.DEFAULT_SAVE_PATH
+    os.makedirs(output_path, exist_ok=True)
+    # Paths of data files are formed by appending the filename to data_path
+    data_path = os.path.join(data_path, '')
+    lpd_file_names = [extract_data.get_lpd_filename(data_path, filename) for filename in file_list]
+
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=initialise_worker,
+                             initargs=(threshold_maps.get_map_filename(),
+                                       pedestal.get_dark_file_name(),
+                                       threshold_maps.get_map_filename(True))) as executor:
+        analysis_futures = [executor.submit(analysis_cache.analyse_supermodule, lpd_file_name,
+                                            memory_limit) for lpd_file_name in lpd_file_names]
+
+        failed_files = []
+        page_futures = []
+        for filename, analysis_future in zip(file_list, analysis_futures):
+            # Any error only fails this file, so the reports of the other files are still created
+            try:
+                results = analysis_future.result()
+            except Exception as error:
+                failed_files.append((filename, error))
+                print('Could not analyse {}: {}'.format(filename, error))
+                continue
+            tile_futures = []
+            for tile, tile_name in enumerate(analysis.get_supermodule_tile_names()):
+                tile_results = tuple(result[tile] for result in results)
+                tile_futures.append(executor.submit(render_tile_pages, tile_results, tile_name,
+                                                    filename, data_path, cache_path, size_limit))
+            page_futures.append((filename, tile_futures))
+
+        file_pages = []
+        for filename, tile_futures in page_futures:
+            try:
+                file_pages.append((filename, [page_filename for future in tile_futures
+                                              for page_filename in future.result()]))
+            except Exception as error:
+                failed_files.append((filename, error))
+                print('Could not render the report of {}: {}'.format(filename, error))
+
+    report_filenames = []
+    if file_reports:
+        for filename, page_filenames in file_pages:
+            report_filename = os.path.join(output_path,
+                                           generate_report.get_report_filename(filename))
+            assemble_pdf(page_filenames, report_filename, 'Analysis of {}'.format(filename))
+            report_filenames.append(report_filename)
+
+    if combined_filename is not None:
+        report_filename = os.path.join(output_path, combined_filename)
+        assemble_pdf([page_filename for _, page_filenames in file_pages
+                      for page_filename in page_filenames], report_filename,
+                     'Analysis of {} files'.format(len(file_pages)))
+        report_filenames.append(report_filename)
+
+    return (report_filenames, failed_files)
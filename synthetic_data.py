@@ -0,0 +1,207 @@
+''' Writes synthetic LPD data files with faulty pixels, columns and chips injected, for benchmarking
+    and trying out the analysis without real data. Run as a script - see --help for the options
+'''
+
+import argparse
+import time
+from datetime import datetime
+
+import h5py
+import numpy as np
+
+import extract_data
+
+# Datasets of images and metadata groups of the file layouts read by extract_data
+LAYOUTS = {
+    'data': ('data', 'metadata'),
+    'lpd': ('lpd/data/image', 'lpd/metadata'),
+}
+
+# Typical values of good pixels (ADC counts) - each pixel's mean is spread around PIXEL_MEAN, with
+# noise of PIXEL_NOISE. Both are well inside the default thresholds of test_data
+PIXEL_MEAN = 3400
+PIXEL_SPREAD = 30
+PIXEL_NOISE = 25
+
+# Values of dead and hot pixels, and how much noisier noisy pixels are
+DEAD_VALUE = 100
+HOT_VALUE = 4000
+NOISY_FACTOR = 4
+
+# Noise of each image is taken from a bank of this many noise images, so large files can be written
+# at the speed of the disk rather than of the random number generator
+NUM_NOISE_IMAGES = 64
+
+
+def create_readout_params(images_per_train):
+    ''' Returns the contents of a readoutParamFile XML with the number of images per train
+    '''
+    return ('<?xml version="1.0"?>\n<lpd_readout_config>\n'
+            '    <numberImages val="{}"/>\n</lpd_readout_config>\n'.format(images_per_train)).encode()
+
+
+def create_faults(rng, dead_pixels=20, hot_pixels=20, noisy_pixels=20, dead_columns=2,
+                  hot_columns=2, dead_chips=1, hot_chips=1):
+    ''' Choose random positions of faults in a full image
+        Returns (fault_values, noisy_mask): the fixed value of each faulty pixel, -1 for pixels
+        without a fixed value, and a mask of pixels that are noisier than normal
+    '''
+    fault_values = np.full((256, 256), -1, dtype=np.int32)
+
+    # Chips are 32 rows by 16 columns - 8 rows of 16 chips in an image
+    for num_chips, value in ((dead_chips, DEAD_VALUE), (hot_chips, HOT_VALUE)):
+        for chip in rng.choice(128, num_chips, replace=False):
+            row = (chip // 16) * 32
+            col = (chip % 16) * 16
+            fault_values[row:row + 32, col:col + 16] = value
+
+    # Columns are within a single tile
+    for num_columns, value in ((dead_columns, DEAD_VALUE), (hot_columns, HOT_VALUE)):
+        for _ in range(num_columns):
+            row = rng.randint(8) * 32
+            fault_values[row:row + 32, rng.randint(256)] = value
+
+    for num_pixels, value in ((dead_pixels, DEAD_VALUE), (hot_pixels, HOT_VALUE)):
+        fault_values[rng.randint(256, size=num_pixels), rng.randint(256, size=num_pixels)] = value
+
+    noisy_mask = np.zeros((256, 256), dtype=bool)
+    noisy_mask[rng.randint(256, size=noisy_pixels), rng.randint(256, size=noisy_pixels)] = True
+
+    return (fault_values, noisy_mask)
+
+
+def get_num_trains(size, images_per_train):
+    ''' Returns the number of trains needed for a file of roughly size bytes
+    '''
+    image_bytes = 256 * 256 * np.dtype(np.uint16).itemsize
+    return max(1, int(size // (image_bytes * images_per_train)))
+
+
+def create_pixel_model(rng, faults=None):
+    ''' Choose the mean of each pixel and the bank of noise images that images are generated from
+        faults - (fault_values, noisy_mask) as returned by create_faults(), random faults if None
+        Returns (pixel_means, noise_images, faults)
+    '''
+    if faults is None:
+        faults = create_faults(rng)
+    noisy_mask = faults[1]
+
+    pixel_means = rng.normal(PIXEL_MEAN, PIXEL_SPREAD, (256, 256)).astype(np.float32)
+    noise_images = rng.normal(0, PIXEL_NOISE, (NUM_NOISE_IMAGES, 256, 256)).astype(np.float32)
+    noise_images[:, noisy_mask] *= NOISY_FACTOR
+    return (pixel_means, noise_images, faults)
+
+
+def generate_images(rng, pixel_model, num_images):
+    ''' Generate a block of images (num_images, 256, 256) from a model made by create_pixel_model()
+    '''
+    pixel_means, noise_images, (fault_values, _) = pixel_model
+    fixed_pixels = fault_values >= 0
+
+    images = noise_images[rng.randint(NUM_NOISE_IMAGES, size=num_images)]
+    images += pixel_means
+    np.clip(images, 0, 4095, out=images)
+    images = images.astype(np.uint16)
+    images[:, fixed_pixels] = fault_values[fixed_pixels]
+    return images
+
+
+def write_metadata(lpd_file, layout, num_trains, images_per_train):
+    ''' Create the metadata group of a file, with the attributes and readoutParamFile XML read by
+        extract_data
+    '''
+    metadata = lpd_file.create_group(LAYOUTS[layout][1])
+    metadata.attrs['numTrains'] = num_trains
+    metadata.attrs['runDate'] = datetime.now().strftime('%d-%m-%Y %H:%M:%S')
+    metadata.attrs['cmdSequenceFile'] = '/config/synthetic_cmd_sequence.xml'
+    metadata.attrs['readoutParamFile'] = '/config/synthetic_readout_params.xml'
+    metadata.attrs['setupParamFile'] = '/config/synthetic_setup_params.xml'
+    metadata['readoutParamFile'] = np.array([create_readout_params(images_per_train)])
+
+
+def write_lpd_file(filename, num_trains=100, images_per_train=10, layout='data', faults=None,
+                   seed=0, memory_limit=extract_data.MEMORY_LIMIT):
+    ''' Write a synthetic data file, in blocks of images using no more than about memory_limit
+        bytes, so files can be much larger than the memory available
+        faults - (fault_values, noisy_mask) as returned by create_faults(), random faults if None
+        Returns the faults injected
+    '''
+    rng = np.random.RandomState(seed)
+    pixel_model = create_pixel_model(rng, faults)
+
+    num_images = num_trains * images_per_train
+    # Blocks are generated in 32 bit floats, twice the size of the images written
+    block_length = max(1, memory_limit // (256 * 256 * 4))
+
+    with h5py.File(filename, 'w') as lpd_file:
+        dataset = lpd_file.create_dataset(LAYOUTS[layout][0], (num_images, 256, 256),
+                                          dtype=np.uint16,
+                                          chunks=(min(images_per_train, num_images), 256, 256))
+        for start in range(0, num_images, block_length):
+            length = min(block_length, num_images - start)
+            dataset[start:start + length] = generate_images(rng, pixel_model, length)
+
+        write_metadata(lpd_file, layout, num_trains, images_per_train)
+
+    return pixel_model[2]
+
+
+def write_live_lpd_file(filename, num_trains=100, images_per_train=10, layout='data',
+                        faults=None, seed=0, train_interval=0.1):
+    ''' Write a synthetic data file one train at a time, every train_interval seconds, in SWMR
+        (single writer, multiple reader) mode so it can be read while it's written - a stand-in for
+        the DAQ when trying out live_analysis. The metadata is written before any images, as nothing
+        new can be added to a file in SWMR mode
+        Returns the faults injected
+    '''
+    rng = np.random.RandomState(seed)
+    pixel_model = create_pixel_model(rng, faults)
+
+    # SWMR needs the latest file format
+    with h5py.File(filename, 'w', libver='latest') as lpd_file:
+        dataset = lpd_file.create_dataset(LAYOUTS[layout][0], (0, 256, 256), dtype=np.uint16,
+                                          chunks=(images_per_train, 256, 256),
+                                          maxshape=(None, 256, 256))
+        write_metadata(lpd_file, layout, num_trains, images_per_train)
+        lpd_file.swmr_mode = True
+
+        for train in range(num_trains):
+            start = train * images_per_train
+            dataset.resize(start + images_per_train, axis=0)
+            dataset[start:] = generate_images(rng, pixel_model, images_per_train)
+            # Make the new train visible to readers
+            dataset.flush()
+            time.sleep(train_interval)
+
+    return pixel_model[2]
+
+
+def parse_args():
+    ''' Parse command line arguments
+    '''
+    parser = argparse.ArgumentParser(description='Write a synthetic LPD data file')
+    parser.add_argument('filename', help='File (.h5) to write')
+    parser.add_argument('--trains', type=int, default=100, help='Number of trains')
+    parser.add_argument('--images-per-train', type=int, default=10,
+                        help='Number of images in each train')
+    parser.add_argument('--size', type=float, default=None,
+                        help='Approximate size of file in GB, used instead of --trains')
+    parser.add_argument('--layout', choices=sorted(LAYOUTS), default='data',
+                        help='Layout of datasets in the file')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the random data and faults')
+    parser.add_argument('--train-interval', type=float, default=None,
+                        help='Write a train every this many seconds in SWMR mode, as the DAQ would')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    num_trains = args.trains
+    if args.size is not None:
+        num_trains = get_num_trains(args.size * 1024 ** 3, args.images_per_train)
+    if args.train_interval is None:
+        write_lpd_file(args.filename, num_trains, args.images_per_train, args.layout,
+                       seed=args.seed)
+    else:
+        write_live_lpd_file(args.filename, num_trains, args.images_per_train, args.layout,
+                            seed=args.seed, train_interval=args.train_interval)
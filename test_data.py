@@ -3,83 +3,72 @@ import numpy as np
 import plot
 import extract_data
 import fault_tiles
+import pedestal
+import threshold_maps
 
 
-def bad_chips(tile_data, fault_tile, test_type):
+def bad_chips(tile_data, fault_tile, test_type, tile=None):
     ''' Test number of bad chips based on the input from tile_data
     '''
-    chip_threshold = get_thresholds(test_type)
-
-    below_threshold_chips = 0
-    above_threshold_chips = 0
-
-    for chip in range(0, 8):
-        # Calculate the mean of each chip, slicing each chip from tile_data
-        fault_chip = extract_data.get_single_chip(fault_tile, chip)
-        # Determine whether the chip needs testing
-        test_chip = fault_tiles.detect(fault_chip)
-
-        if test_chip:
-            # Take mean value of each chip
-            mean_chip_value = np.mean(extract_data.get_single_chip(tile_data, chip))
-
-            if mean_chip_value < chip_threshold[0]:
-                below_threshold_chips, chip_position = chips_addition(below_threshold_chips,chip)
-                # Add fault to tile
-                fault_tiles.add_fault(fault_tile, test_type, 0, chip_position, (32, chip_position + 16))
-            elif mean_chip_value > chip_threshold[1]:
-                above_threshold_chips, chip_position = chips_addition(above_threshold_chips,chip)
-                #Add fault to tile 
-                fault_tiles.add_fault(fault_tile, test_type, 0, chip_position, (32, chip_position + 16))
-
-    # Collate results of bad chips to be used in test_results.py
-    num_bad_chips = [below_threshold_chips, above_threshold_chips]
+    # Each chip is 16 columns wide
+    num_bad_chips = bad_sections(tile_data, fault_tile, test_type, 16, tile)
     return num_bad_chips
 
 
-def bad_columns(tile_data, fault_tile, test_type):
+def bad_columns(tile_data, fault_tile, test_type, tile=None):
     ''' Test number of bad columns based on the input from tile_data
     '''
-    column_threshold = get_thresholds(test_type)
-
-    below_threshold_columns = 0
-    above_threshold_columns = 0
-
-    for column in range(0, 128):
-        fault_column = extract_data.get_single_column(fault_tile, column)
-        test_column = fault_tiles.detect(fault_column)
-        if test_column:
-            mean_column_value = np.mean(extract_data.get_single_column(tile_data, column))
-            if mean_column_value < column_threshold[0]:
-                below_threshold_columns += 1
-                fault_tiles.add_fault(fault_tile, test_type, 0, column, (32, column + 1))
-            elif mean_column_value > column_threshold[1]:
-                above_threshold_columns += 1
-                fault_tiles.add_fault(fault_tile, test_type, 0, column, (32, column + 1))
-
-    num_bad_cols = [below_threshold_columns, above_threshold_columns]
+    num_bad_cols = bad_sections(tile_data, fault_tile, test_type, 1, tile)
     return num_bad_cols
 
 
-def bad_pixels(tile_data, fault_tile, test_type):
+def bad_sections(tile_data, fault_tile, test_type, section_width, tile=None):
+    ''' Test the mean value of each section (chip or column) of tile_data against the thresholds,
+        adding faulty sections to fault_tile. Sections that are mostly faulty already aren't tested.
+        tile_data and fault_tile can be a single tile or a stack of tiles - the counts returned are
+        then arrays with a value for each tile
+        tile - which tile(s) of the supermodule are tested, see get_thresholds()
+    '''
+    section_threshold = get_thresholds(test_type, tile)
+    if np.ndim(section_threshold[0]) > 0:
+        # Thresholds of a section are the mean of the thresholds of its pixels
+        section_threshold = [extract_data.get_section_means(threshold, section_width)
+                             for threshold in section_threshold]
+
+    # Determine which sections need testing and take the mean value of each section
+    test_sections = fault_tiles.detect_sections(fault_tile, section_width)
+    section_means = extract_data.get_section_means(tile_data, section_width)
+
+    below_threshold = test_sections & (section_means < section_threshold[0])
+    above_threshold = test_sections & ~below_threshold & (section_means > section_threshold[1])
+
+    # Add faults to tile
+    fault_mask = fault_tiles.expand_sections(below_threshold | above_threshold, section_width,
+                                             fault_tile.shape[-2])
+    fault_tiles.add_faults(fault_tile, test_type, fault_mask,
+                           fault_tiles.SECTION_LEVELS[section_width])
+
+    # Collate results of bad sections to be used in test_results.py
+    num_bad_sections = [np.count_nonzero(below_threshold, axis=-1),
+                        np.count_nonzero(above_threshold, axis=-1)]
+    return num_bad_sections
+
+
+def bad_pixels(tile_data, fault_tile, test_type, tile=None):
     ''' Test number of bad pixels based on the input from tile_data
+        Pixels that are already part of a fault aren't tested
+        tile - which tile(s) of the supermodule are tested, see get_thresholds()
     '''
-    pixel_threshold = get_thresholds(test_type)
-
-    above_threshold_pixels = 0
-    below_threshold_pixels = 0
-
-    for i in range(0, len(tile_data)):
-        for j in range(0, len(tile_data[i])):
-            if fault_tile[i][j] == 0:
-                if tile_data[i][j] < pixel_threshold[0]:
-                    below_threshold_pixels += 1
-                    fault_tiles.add_fault(fault_tile, test_type, i, j)
-                elif tile_data[i][j] > pixel_threshold[1]:
-                    above_threshold_pixels += 1
-                    fault_tiles.add_fault(fault_tile, test_type, i, j)
-
-    num_bad_pixels = [below_threshold_pixels, above_threshold_pixels]
+    pixel_threshold = get_thresholds(test_type, tile)
+
+    test_pixels = fault_tile == 0
+    below_threshold = test_pixels & (tile_data < pixel_threshold[0])
+    above_threshold = test_pixels & ~below_threshold & (tile_data > pixel_threshold[1])
+
+    fault_tiles.add_faults(fault_tile, test_type, below_threshold | above_threshold)
+
+    num_bad_pixels = [np.count_nonzero(below_threshold, axis=(-2, -1)),
+                      np.count_nonzero(above_threshold, axis=(-2, -1))]
     return num_bad_pixels
 
 
@@ -91,18 +80,45 @@ def manage_figure(tile_data, tile_plot, tile_colorbar, histogram, colorbar_type)
     plot.display_histogram(histogram, tile_data)
 
 
-def get_thresholds(test_type):
+def update_figure(tile_data, tile_image, histogram, histogram_bars):
+    ''' Display new tile data on plots created once with plot.setup_data_plot() and
+        plot.setup_histogram() - used instead of manage_figure() when plots are reused
+    '''
+    plot.update_data_plot(tile_image, tile_data)
+    plot.update_histogram(histogram, histogram_bars, tile_data)
+
+
+def get_thresholds(test_type, tile=None):
     ''' Return thresholds used to test data against dependent on the type of test
+        tile - index of the tile tested in analysis.get_supermodule_tiles(), or a slice/list of
+            indices for a stack of tiles. If given and a threshold map is loaded (see
+            threshold_maps), the thresholds are arrays with a value for each pixel, which broadcast
+            against the tile data. Otherwise the same thresholds are used for every pixel
+        If a dark run is registered (see pedestal), mean data has its pedestal subtracted, so the
+        thresholds (and threshold map) for pedestal subtracted data are used instead of raw data
+    '''
+    pedestal_subtracted = pedestal.get_pedestal_version() is not None
+    threshold_map = threshold_maps.get_threshold_map(pedestal_subtracted)
+    if tile is not None and threshold_map is not None and test_type in (1, 2):
+        # (low, high) thresholds of each pixel
+        return tuple(threshold_map[test_type - 1, :, tile])
+    return get_default_thresholds(test_type, pedestal_subtracted)
+
+
+def get_default_thresholds(test_type, pedestal_subtracted=False):
+    ''' Return the thresholds used for every pixel, unless a threshold map is loaded, dependent on
+        the type of test
+        pedestal_subtracted - thresholds of data with the pedestal of a dark run subtracted
     '''
     if test_type == 1:
         # Mean data thresholds
+        if pedestal_subtracted:
+            # Window of the same width as raw data, centred on the pedestal
+            return (-245.4792, 245.4792)
         return (3148.428, 3639.3864)
     elif test_type == 2:
-        # Standard deviation thresholds
+        # Standard deviation thresholds - a constant offset doesn't change them
         return (10, 42)
     else:
         # Unknown test
         return (0, 300)
-
-def chips_addition(threshold, chip): 
-    return threshold + 1 , chip * 16
\ No newline at end of file
@@ -0,0 +1,114 @@
+''' Finds delaminated pixels - pixels whose bump bond has come away from the sensor, which respond
+    differently to their neighbours but can still be within the thresholds of test_data. Each pixel
+    is compared with the median of the pixels around it in the same tile, so gradual changes across
+    a tile aren't mistaken for faults
+'''
+
+import numpy as np
+
+import fault_tiles
+
+# Width and height of the neighbourhood each pixel is compared with (pixels, odd)
+NEIGHBOURHOOD_SIZE = 5
+
+# Number of robust standard deviations (of the differences between pixels and their neighbourhoods
+# across a tile) a pixel must differ from its neighbourhood by to be delaminated
+DEVIATION_THRESHOLD = 6
+
+# Smallest difference from the neighbourhood counted as delaminated, for mean (and LED) data and
+# standard deviation data - stops very uniform tiles flagging tiny differences
+MIN_DEVIATION = {1: 100, 2: 10}
+
+# Scales the median absolute deviation to the standard deviation of normally distributed values
+MAD_TO_STDEV = 1.4826
+
+
+def split_tiles(image):
+    ''' Split a full image (256, 256) into its 16 tiles (16, 32, 128), in the order of
+        analysis.get_supermodule_tiles() - left tiles are on the right of the image
+    '''
+    return image.reshape(8, 32, 2, 128).swapaxes(1, 2)[:, ::-1].reshape(16, 32, 128)
+
+
+def join_tiles(tiles):
+    ''' Combine a stack of 16 tiles from split_tiles() back into a full image
+    '''
+    return tiles.reshape(8, 2, 32, 128)[:, ::-1].swapaxes(1, 2).reshape(256, 256)
+
+
+def get_local_medians(tiles, size=NEIGHBOURHOOD_SIZE):
+    ''' Median of the size x size neighbourhood of every pixel of a tile or stack of tiles
+        (..., rows, columns). Neighbourhoods are reflected at the edges of each tile, so they never
+        include pixels of another tile
+    '''
+    tiles = np.asarray(tiles, dtype=np.float32)
+    pad = size // 2
+    padding = [(0, 0)] * (tiles.ndim - 2) + [(pad, pad), (pad, pad)]
+    padded = np.pad(tiles, padding, mode='reflect')
+
+    rows, cols = tiles.shape[-2:]
+    # Every pixel of each neighbourhood, stacked along the first axis
+    neighbourhoods = np.stack([padded[..., row:row + rows, col:col + cols]
+                               for row in range(size) for col in range(size)])
+    return np.median(neighbourhoods, axis=0)
+
+
+def get_local_deviations(tiles, size=NEIGHBOURHOOD_SIZE):
+    ''' Difference between each pixel and the median of its neighbourhood, and a robust estimate of
+        the standard deviation of the differences in each tile (from their median absolute value)
+        Returns (deviations (..., rows, columns), spread (..., 1, 1))
+    '''
+    deviations = np.asarray(tiles, dtype=np.float32) - get_local_medians(tiles, size)
+    spread = MAD_TO_STDEV * np.median(np.abs(deviations), axis=(-2, -1), keepdims=True)
+    return (deviations, spread)
+
+
+def delaminated_pixels(tile_data, fault_tile, test_type, size=NEIGHBOURHOOD_SIZE,
+                       threshold=DEVIATION_THRESHOLD, min_deviation=None):
+    ''' Test for pixels of tile_data that differ from their neighbourhood by more than threshold
+        robust standard deviations (and at least min_deviation), adding them to fault_tile as
+        delaminated faults of test_type (see fault_tiles.add_fault()). Pixels that are already part
+        of a fault aren't tested. tile_data and fault_tile can be a single tile or a stack of tiles,
+        as for test_data.bad_pixels()
+        min_deviation - MIN_DEVIATION of the test type if not given
+        Returns the number of pixels lower and higher than their neighbourhood
+    '''
+    if min_deviation is None:
+        min_deviation = MIN_DEVIATION.get(test_type, 0)
+
+    deviations, spread = get_local_deviations(tile_data, size)
+    limit = np.maximum(threshold * spread, min_deviation)
+
+    test_pixels = fault_tile == 0
+    below_neighbours = test_pixels & (deviations < -limit)
+    above_neighbours = test_pixels & (deviations > limit)
+
+    fault_tiles.add_faults(fault_tile, test_type, below_neighbours | above_neighbours,
+                           'delaminated')
+
+    num_delaminated_pixels = [np.count_nonzero(below_neighbours, axis=(-2, -1)),
+                              np.count_nonzero(above_neighbours, axis=(-2, -1))]
+    return num_delaminated_pixels
+
+
+def delaminated_image_pixels(mean_image, stdev_image, led_image=None, fault_image=None,
+                             size=NEIGHBOURHOOD_SIZE, threshold=DEVIATION_THRESHOLD):
+    ''' Test every tile of full images (256, 256) for delaminated pixels in the mean and standard
+        deviation data, and in an LED (trigger) image if given. Faults in the mean and LED images
+        are mean faults, those in the standard deviation image are stdev faults
+        fault_image - faults already found (e.g. by test_data), which aren't tested again
+        Returns the fault image and the counts of delaminated pixels lower and higher than their
+        neighbourhood in each test, with a value for each tile of analysis.get_supermodule_tiles()
+    '''
+    if fault_image is None:
+        fault_image = fault_tiles.create_fault_tile((256, 256))
+    fault_stack = split_tiles(fault_image).copy()
+
+    counts = {}
+    images = [('mean', mean_image, 1), ('stdev', stdev_image, 2), ('led', led_image, 1)]
+    for name, image, test_type in images:
+        if image is not None:
+            counts[name] = delaminated_pixels(split_tiles(image), fault_stack, test_type, size,
+                                              threshold)
+
+    return (join_tiles(fault_stack), counts)
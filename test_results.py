@@ -1,11 +1,21 @@
 import plot
 import extract_data
+import file_preview
+import pedestal
 import test_data
+import threshold_maps
 
 import matplotlib.pyplot as plt
 import numpy as np
+import os
 from datetime import datetime
 
+# Column and row labels for results table
+RESULTS_COLUMNS = ("Bad Chips", "Bad Columns", "Bad Pixels")
+RESULTS_ROWS = ("Mean Total", "    Lower Than Threshold", "    Higher Than Threshold",
+                "Standard Deviation Total", "    Lower Than Threshold", "    Higher Than Threshold",
+                "Overall Total")
+
 
 def setup_results_figure():
     ''' Gives statistics on the bad components of a tile based on all tests completed.
@@ -21,17 +31,13 @@ def setup_results_figure():
     analysis_textarea.axis('off')
     plt.subplots_adjust(left=0.3)
 
-    # Column and row labels for table
-    columns = ("Bad Chips", "Bad Columns", "Bad Pixels")
-    rows = ("Mean Total", "    Lower Than Threshold", "    Higher Than Threshold",
-            "Standard Deviation Total", "    Lower Than Threshold", "    Higher Than Threshold",
-            "Overall Total")
     # Only need 16 bit ints as max value of an array element will be 4096
     table_values = np.zeros((7, 3), dtype=np.int16)
 
     # Create table ready to be updated upon analysis
-    results_table = plt.table(cellText=table_values, rowLabels=rows, colLabels=columns,
-                              loc="upper center", bbox=[0.0, 0.0, 1.1, 1.2])
+    results_table = plt.table(cellText=table_values, rowLabels=RESULTS_ROWS,
+                              colLabels=RESULTS_COLUMNS, loc="upper center",
+                              bbox=[0.0, 0.0, 1.1, 1.2])
 
     # Setting style and weight of row labels
     italic_label_index = (2, 3, 5, 6)
@@ -77,8 +83,17 @@ def set_analysis_text(analysis_textarea, analysis_text_list, filename, data_path
     # Get date analysis took place, i.e. runtime's date
     new_data.append(datetime.today().strftime('%d/%m/%Y'))
     # Get thresholds used for testing
+    dark_file_name = pedestal.get_dark_file_name()
+    # Thresholds for pedestal subtracted data are used while a dark run is registered
+    map_filename = threshold_maps.get_map_filename(dark_file_name is not None)
     for i in range(1, 3):
-        new_data.append(test_data.get_thresholds(i))
+        if map_filename is None:
+            thresholds = str(test_data.get_thresholds(i))
+        else:
+            thresholds = 'per pixel, from {}'.format(os.path.basename(map_filename))
+        if i == 1 and dark_file_name is not None:
+            thresholds += ' after pedestal of {}'.format(os.path.basename(dark_file_name))
+        new_data.append(thresholds)
 
     # Number of images per train
     new_data.append(extract_data.get_num_images_per_train(metadata))
@@ -135,6 +150,7 @@ def display_trigger_images(lpd_data, tile_position, fig_trigger, trigger_plots,
     # Create each trigger image
     for trigger_pos in range(0, 4):
         tile = extract_data.get_single_tile(lpd_data, tile_position, (trigger_gap * trigger_pos))
+        tile = pedestal.subtract_pedestal(tile, tile_position)
 
         # Only pass a colorbar once to display_data_plot() - all 4 plots share one colorbar
         if trigger_pos is 3:
@@ -147,5 +163,66 @@ def display_first_image(lpd_data, first_image_plot, first_image_colorbar):
     ''' Display first image to user dependent on status of checkbox
     '''
     # Get first image of data and plot it
-    first_image = extract_data.get_first_image(lpd_data)
+    first_image = pedestal.subtract_pedestal(extract_data.get_first_image(lpd_data))
     plot.display_data_plot(first_image_plot, first_image, first_image_colorbar)
+
+
+def setup_trigger_images(trigger_plots, trigger_colorbar):
+    ''' Create the images of the first 4 triggers once, so they can be updated with
+        update_trigger_images()
+        Returns a list of the images
+    '''
+    trigger_images = []
+    for trigger_pos in range(0, 4):
+        # All 4 plots share one colorbar
+        colorbar = trigger_colorbar if trigger_pos == 3 else None
+        trigger_images.append(plot.setup_data_plot(trigger_plots[trigger_pos], (32, 128),
+                                                   colorbar))
+    return trigger_images
+
+
+def update_trigger_images(lpd_data, tile_position, trigger_images, metadata):
+    ''' Display the first 4 triggers (images 1, 11, 21, 31) on images from setup_trigger_images()
+    '''
+    trigger_gap = extract_data.get_num_images_per_train(metadata)
+
+    for trigger_pos, trigger_image in enumerate(trigger_images):
+        tile = extract_data.get_single_tile(lpd_data, tile_position, (trigger_gap * trigger_pos))
+        plot.update_data_plot(trigger_image, pedestal.subtract_pedestal(tile, tile_position))
+
+
+def update_first_image(lpd_data, first_image):
+    ''' Display the first image of data on an image created once with plot.setup_data_plot()
+    '''
+    first_image_data = pedestal.subtract_pedestal(extract_data.get_first_image(lpd_data))
+    plot.update_data_plot(first_image, first_image_data)
+
+
+def update_trigger_images_from_preview(preview, tile_position, trigger_images):
+    ''' Display the first 4 triggers on images from setup_trigger_images(), from the preview of a
+        file (see file_preview.get_preview()) rather than the file itself
+    '''
+    for trigger_image, image in zip(trigger_images, preview['trigger_images']):
+        tile = image[tile_position[0]:tile_position[0] + 32, tile_position[1]:tile_position[1] + 128]
+        plot.update_data_plot(trigger_image, pedestal.subtract_pedestal(tile, tile_position))
+
+
+def update_first_image_from_preview(preview, first_image):
+    ''' Display the first image of a file on an image created once with plot.setup_data_plot(), from
+        the preview of the file
+    '''
+    plot.update_data_plot(first_image, pedestal.subtract_pedestal(preview['first_image']))
+
+
+def update_preview(preview, thumbnail_images, preview_histogram):
+    ''' Display the preview of a file (see file_preview.get_preview()) on the plots from
+        plot.setup_preview_plots()
+    '''
+    thumbnail_size = thumbnail_images[0].get_array().shape[0]
+    for thumbnail_image, frame in zip(thumbnail_images, file_preview.PYRAMID_FRAMES):
+        plot.update_data_plot(thumbnail_image, file_preview.get_level(preview, frame,
+                                                                      thumbnail_size))
+
+    preview_histogram.cla()
+    preview_histogram.set_title('Histogram of Raw Data', fontsize=10)
+    plot.display_counts(preview_histogram, preview['histogram'])
@@ -0,0 +1,104 @@
+''' Per-pixel thresholds loaded from a calibration file, used in place of the fixed thresholds of
+    test_data.get_thresholds() so differences in gain across tiles and chips are allowed for.
+    Separate maps can be loaded for raw data and for data with the pedestal of a dark run subtracted
+'''
+
+import hashlib
+import os
+
+import numpy as np
+
+# Shape of a threshold map: (test type (mean, stdev), threshold (low, high), tile, rows, columns)
+# Tiles are in the order of analysis.get_supermodule_tiles()
+MAP_SHAPE = (2, 2, 16, 32, 128)
+
+# Maps currently in use, the (path, size, modification time) of the files they were loaded from and
+# hashes of their values, for raw data (False) and for data with a pedestal subtracted (True) - None
+# when the default thresholds are used
+_threshold_maps = {False: None, True: None}
+_map_files = {False: None, True: None}
+_map_versions = {False: None, True: None}
+
+
+def load_threshold_map(filename, pedestal_subtracted=False):
+    ''' Load the threshold map in a calibration file (.npy) to be used by every test, until another
+        is loaded. The file is memory-mapped, so thresholds are only read when they're used. Loading
+        a file that's already loaded (and hasn't changed since) does nothing
+        filename - None to go back to the default thresholds
+        pedestal_subtracted - whether the map's thresholds are for data with the pedestal of a dark
+            run subtracted, used instead of the raw data map while a dark run is registered
+    '''
+    if filename is None:
+        clear_threshold_map(pedestal_subtracted)
+        return
+
+    filename = os.path.abspath(filename)
+    file_stat = os.stat(filename)
+    map_file = (filename, file_stat.st_size, file_stat.st_mtime_ns)
+    if map_file == _map_files[pedestal_subtracted]:
+        return
+
+    threshold_map = np.load(filename, mmap_mode='r')
+    if threshold_map.shape != MAP_SHAPE:
+        raise ValueError('Threshold map in {} has shape {}, expected {}'.format(
+            filename, threshold_map.shape, MAP_SHAPE))
+
+    _threshold_maps[pedestal_subtracted] = threshold_map
+    _map_files[pedestal_subtracted] = map_file
+    _map_versions[pedestal_subtracted] = hashlib.sha1(threshold_map.tobytes()).hexdigest()
+
+
+def clear_threshold_map(pedestal_subtracted=False):
+    ''' Go back to using the default thresholds for raw data, or for pedestal subtracted data
+    '''
+    _threshold_maps[pedestal_subtracted] = None
+    _map_files[pedestal_subtracted] = None
+    _map_versions[pedestal_subtracted] = None
+
+
+def get_threshold_map(pedestal_subtracted=False):
+    ''' Returns the threshold map in use for raw data or pedestal subtracted data, or None if the
+        default thresholds are used
+    '''
+    return _threshold_maps[pedestal_subtracted]
+
+
+def get_map_filename(pedestal_subtracted=False):
+    ''' Returns the path of the calibration file in use for raw data or pedestal subtracted data, or
+        None if the default thresholds are used
+    '''
+    if _map_files[pedestal_subtracted] is None:
+        return None
+    return _map_files[pedestal_subtracted][0]
+
+
+def get_map_version():
+    ''' Returns hashes of the values of the threshold maps in use (for raw data and pedestal
+        subtracted data), None for defaults - changes whenever the thresholds do
+    '''
+    return (_map_versions[False], _map_versions[True])
+
+
+def expand_thresholds(thresholds):
+    ''' Expand thresholds given per tile (2, 2, 16), per chip (2, 2, 16, 8) or per pixel
+        (2, 2, 16, 32, 128) into a full threshold map
+    '''
+    thresholds = np.asarray(thresholds, dtype=np.float64)
+    if thresholds.shape == MAP_SHAPE[:3]:
+        # Same thresholds for every pixel of a tile
+        thresholds = thresholds[..., np.newaxis, np.newaxis]
+    elif thresholds.shape == MAP_SHAPE[:3] + (8,):
+        # Each chip is 16 columns wide
+        thresholds = np.repeat(thresholds, 16, axis=-1)[..., np.newaxis, :]
+    elif thresholds.shape != MAP_SHAPE:
+        raise ValueError('Thresholds of shape {} are not per tile, chip or pixel'.format(
+            thresholds.shape))
+
+    return np.broadcast_to(thresholds, MAP_SHAPE)
+
+
+def save_threshold_map(filename, thresholds):
+    ''' Save thresholds (see expand_thresholds()) as a calibration file that can be loaded with
+        load_threshold_map()
+    '''
+    np.save(filename, np.ascontiguousarray(expand_thresholds(thresholds)))
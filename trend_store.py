@@ -0,0 +1,274 @@
+''' Store of the mean, stdev and fault tiles and results tables of every run analysed, so the
+    history of a pixel, chip or tile can be followed across weeks of tests. Results are kept in a
+    chunked HDF5 file with runs along the first axis of each dataset, chunked so the history of a
+    small area of a tile is read from a few chunks however many runs are stored
+'''
+
+import os
+from datetime import datetime
+
+import h5py
+import numpy as np
+
+import analysis
+import extract_data
+import fault_tiles
+import test_results
+
+# Default file the trends are stored in
+TREND_STORE_FILENAME = os.path.join(os.path.expanduser('~'), 'develop', 'projects', 'lpd',
+                                    'tile_trends.h5')
+
+# Number of runs in each chunk of the stored datasets
+RUN_CHUNK = 64
+
+# Datasets of per-pixel maps of each run (runs, tiles, rows, columns) and their types. Each chunk
+# holds one chip (16 columns) of one tile for RUN_CHUNK runs. Chunks aren't compressed - adding a
+# run to a partly filled compressed chunk means decompressing and compressing it again, which made
+# adding each run around 20 times slower
+MAP_DATASETS = {
+    'mean': np.float32,
+    'stdev': np.float32,
+    'fault': fault_tiles.FAULT_DTYPE,
+}
+MAP_CHUNKS = (RUN_CHUNK, 1, 32, 16)
+
+# Format of the run date in the metadata of data files
+RUN_DATE_FORMAT = '%d-%m-%Y %H:%M:%S'
+
+
+def get_run_date(lpd_file_name, metadata):
+    ''' Returns the date a run was taken as a Unix timestamp - from the metadata if it's there,
+        otherwise the modification time of the file
+    '''
+    date_str = extract_data.get_file_date_created(lpd_file_name, metadata)
+    if isinstance(date_str, bytes):
+        date_str = date_str.decode()
+    try:
+        return datetime.strptime(str(date_str), RUN_DATE_FORMAT).timestamp()
+    except ValueError:
+        return os.path.getmtime(lpd_file_name)
+
+
+def get_tile(tile_orientation, mini_connector):
+    ''' Returns the index of a tile in the stored tiles, which are in the order of
+        analysis.get_supermodule_tiles()
+    '''
+    return analysis.get_supermodule_tiles().index((tile_orientation, mini_connector))
+
+
+class TrendStore():
+    ''' The results of each run analysed, indexed by run and tile. The names, dates and file
+        identities of the runs are held in memory, so finding the runs in a date range doesn't touch
+        the file. Can be used as a context manager
+        Only one process should write to a store at a time
+    '''
+
+    def __init__(self, filename=TREND_STORE_FILENAME, mode='a'):
+        self.filename = filename
+        if mode != 'r':
+            os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+        self.file = h5py.File(filename, mode)
+        if 'runs' not in self.file:
+            self.create_datasets()
+
+        # Stores created before the format of fault tiles was versioned are version 1
+        self.fault_format_version = int(self.file.attrs.get('faultFormatVersion', 1))
+        if self.fault_format_version > fault_tiles.FAULT_FORMAT_VERSION:
+            self.file.close()
+            raise ValueError('Trend store {} has fault tiles in format version {}, newer than this '
+                             'code reads'.format(filename, self.fault_format_version))
+        if self.fault_format_version < fault_tiles.FAULT_FORMAT_VERSION and mode != 'r':
+            self.convert_faults()
+
+        runs = self.file['runs']
+        self.names = [name.decode() if isinstance(name, bytes) else name
+                      for name in runs['name'][()]]
+        self.dates = runs['date'][()]
+        self.file_keys = list(zip(runs['size'][()].tolist(), runs['mtime_ns'][()].tolist()))
+        self._run_indices = {name: index for index, name in enumerate(self.names)}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        ''' Close the store's file
+        '''
+        self.file.close()
+
+    @property
+    def num_runs(self):
+        ''' Number of runs stored
+        '''
+        return len(self.names)
+
+    def create_datasets(self):
+        ''' Create the empty, extendable datasets of a new store
+        '''
+        runs = self.file.create_group('runs')
+        runs.create_dataset('name', (0, ), dtype=h5py.special_dtype(vlen=str), maxshape=(None, ),
+                            chunks=(1024, ))
+        for run_dataset, dtype in (('date', np.float64), ('size', np.int64),
+                                   ('mtime_ns', np.int64)):
+            runs.create_dataset(run_dataset, (0, ), dtype=dtype, maxshape=(None, ),
+                                chunks=(1024, ))
+
+        for map_dataset, dtype in MAP_DATASETS.items():
+            self.file.create_dataset(map_dataset, (0, 16, 32, 128), dtype=dtype,
+                                     maxshape=(None, 16, 32, 128), chunks=MAP_CHUNKS)
+        self.file.create_dataset('results', (0, 16, 7, 3), dtype=np.int16,
+                                 maxshape=(None, 16, 7, 3), chunks=(RUN_CHUNK, 16, 7, 3))
+        self.file.attrs['faultFormatVersion'] = fault_tiles.FAULT_FORMAT_VERSION
+
+    def convert_faults(self):
+        ''' Convert the stored fault tiles of every run to the current format, a chunk of runs at a
+            time
+        '''
+        fault_dataset = self.file['fault']
+        for start in range(0, fault_dataset.shape[0], RUN_CHUNK):
+            runs = slice(start, start + RUN_CHUNK)
+            fault_dataset[runs] = fault_tiles.convert_fault_tile(fault_dataset[runs],
+                                                                 self.fault_format_version)
+        self.fault_format_version = fault_tiles.FAULT_FORMAT_VERSION
+        self.file.attrs['faultFormatVersion'] = self.fault_format_version
+        self.file.flush()
+
+    def add_run(self, name, date, results, file_key=None):
+        ''' Store the results of a run, replacing any previous results of a run of the same name
+            results - mean, stdev and fault tiles (16, 32, 128) and results tables (16, 7, 3), as
+                returned by analysis.analyse_supermodule()
+            file_key - (size, mtime_ns) of the data file - results of a file that hasn't changed
+                since it was stored aren't written again
+            Returns the index of the run in the store
+        '''
+        index = self._run_indices.get(name)
+        if index is not None and file_key is not None and self.file_keys[index] == file_key:
+            return index
+        if file_key is None:
+            file_key = (-1, -1)
+
+        if index is None:
+            index = self.num_runs
+            for dataset in self.get_run_datasets():
+                dataset.resize(index + 1, axis=0)
+            self.names.append(name)
+            self.dates = np.append(self.dates, date)
+            self.file_keys.append(file_key)
+            self._run_indices[name] = index
+        else:
+            self.dates[index] = date
+            self.file_keys[index] = file_key
+
+        runs = self.file['runs']
+        runs['name'][index] = name
+        runs['date'][index] = date
+        runs['size'][index], runs['mtime_ns'][index] = file_key
+        for map_dataset, result in zip(MAP_DATASETS, results[:3]):
+            self.file[map_dataset][index] = result
+        self.file['results'][index] = results[3]
+        self.file.flush()
+        return index
+
+    def add_file(self, lpd_file_name, results):
+        ''' Store the results of a data file, named after the file, dated from its metadata
+        '''
+        file_stat = os.stat(lpd_file_name)
+        with extract_data.LPDFile(lpd_file_name) as metadata:
+            date = get_run_date(lpd_file_name, metadata)
+        return self.add_run(os.path.basename(lpd_file_name), date, results,
+                            (file_stat.st_size, file_stat.st_mtime_ns))
+
+    def get_run_datasets(self):
+        ''' Returns every dataset with runs along its first axis
+        '''
+        runs = self.file['runs']
+        return [runs['name'], runs['date'], runs['size'], runs['mtime_ns']] + \
+            [self.file[map_dataset] for map_dataset in MAP_DATASETS] + [self.file['results']]
+
+    def get_run_indices(self, start_date=None, end_date=None):
+        ''' Returns the indices of the runs taken between start_date and end_date (datetimes, or
+            unbounded if None), in date order
+        '''
+        order = np.argsort(self.dates, kind='stable')
+        dates = self.dates[order]
+        start = 0 if start_date is None else np.searchsorted(dates, start_date.timestamp())
+        end = len(dates) if end_date is None else np.searchsorted(dates, end_date.timestamp(),
+                                                                  side='right')
+        return order[start:end]
+
+    def get_run_names(self, run_indices):
+        ''' Returns the names of runs, from their indices
+        '''
+        return [self.names[index] for index in run_indices]
+
+    def get_dates(self, run_indices):
+        ''' Returns the dates of runs, from their indices, as datetime64 values
+        '''
+        return self.dates[run_indices].astype('datetime64[s]')
+
+    def get_history(self, quantity, tile_orientation, mini_connector, rows=slice(None),
+                    cols=slice(None), start_date=None, end_date=None):
+        ''' Returns the history of an area of a tile in the runs between start_date and end_date
+            quantity - 'mean', 'stdev' or 'fault'
+            rows, cols - index or slice of the rows and columns of the area
+            Returns (dates, values) in date order, with runs along the first axis of values
+        '''
+        run_indices = self.get_run_indices(start_date, end_date)
+        # Reading every run then selecting is quicker than reading scattered runs, as each chunk
+        # covers many runs
+        values = self.file[quantity][:, get_tile(tile_orientation, mini_connector), rows, cols]
+        if quantity == 'fault':
+            # Stores opened read only aren't converted, so their fault tiles are converted as read
+            values = fault_tiles.convert_fault_tile(values, self.fault_format_version)
+        return (self.get_dates(run_indices), values[run_indices])
+
+    def get_pixel_history(self, quantity, tile_orientation, mini_connector, row, col,
+                          start_date=None, end_date=None):
+        ''' Returns (dates, values) of a single pixel of a tile in the runs between start_date and
+            end_date, e.g. get_pixel_history('stdev', 'Left Tile', 5, row, col)
+        '''
+        return self.get_history(quantity, tile_orientation, mini_connector, row, col, start_date,
+                                end_date)
+
+    def get_chip_history(self, quantity, tile_orientation, mini_connector, chip,
+                         start_date=None, end_date=None):
+        ''' Returns (dates, values) of the mean of a chip (0 - 7, 16 columns each) of a tile in the
+            runs between start_date and end_date
+        '''
+        dates, values = self.get_history(quantity, tile_orientation, mini_connector,
+                                         cols=slice(chip * 16, (chip + 1) * 16),
+                                         start_date=start_date, end_date=end_date)
+        return (dates, np.mean(values, axis=(1, 2)))
+
+    def get_results_history(self, start_date=None, end_date=None):
+        ''' Returns (dates, results tables (runs, 16, 7, 3)) of the runs between start_date and
+            end_date
+        '''
+        run_indices = self.get_run_indices(start_date, end_date)
+        return (self.get_dates(run_indices), self.file['results'][()][run_indices])
+
+    def find_rising_counts(self, results_row='Overall Total', results_column='Bad Columns',
+                           start_date=None, end_date=None, min_increase=1):
+        ''' Find tiles whose count of bad components rose by at least min_increase between the first
+            and last runs between start_date and end_date
+            results_row, results_column - which count of the results table, from
+                test_results.RESULTS_ROWS and test_results.RESULTS_COLUMNS (rows are matched
+                ignoring indentation, so the first match is used)
+            Returns a list of (tile_orientation, mini_connector, first count, last count)
+        '''
+        row = [row_name.strip() for row_name in test_results.RESULTS_ROWS].index(results_row)
+        column = test_results.RESULTS_COLUMNS.index(results_column)
+        _, results = self.get_results_history(start_date, end_date)
+        if len(results) < 2:
+            return []
+
+        counts = results[:, :, row, column].astype(np.int64)
+        first_counts = counts[0]
+        last_counts = counts[-1]
+        rising_tiles = np.flatnonzero(last_counts - first_counts >= min_increase)
+        supermodule_tiles = analysis.get_supermodule_tiles()
+        return [supermodule_tiles[tile] + (int(first_counts[tile]), int(last_counts[tile]))
+                for tile in rising_tiles]
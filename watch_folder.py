@@ -0,0 +1,311 @@
+''' Watches a data directory, analysing every tile of each new LPD data file as soon as it has been
+    completely written, in a pool of processes. Results (and optionally reports) are saved as by
+    batch_analysis. Run as a script - see --help for the options
+'''
+
+import matplotlib
+# Figures are only ever saved to file, so no display is needed
+matplotlib.use('Agg')
+
+import argparse
+import os
+import time
+import xml.etree.ElementTree as ET
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+import batch_analysis
+import extract_data
+import file_preview
+import pedestal
+import report_pages
+import threshold_maps
+import trend_store
+
+# Seconds between scans of the data directory
+POLL_INTERVAL = 5
+
+# Seconds a file's size and modification time must stay the same before it's treated as complete
+SETTLE_TIME = 10
+
+# Seconds a file can stay unchanged without holding every image before it's given up on - a run
+# that was aborted never gets the rest of its images
+INCOMPLETE_TIMEOUT = 300
+
+# Maximum number of files waiting for or being analysed - when reached, new files are left on disk
+# until there's room, so a burst of acquisitions doesn't overload the host
+QUEUE_SIZE = 8
+
+
+def is_file_complete(file_path):
+    ''' Returns whether a data file has been completely written: it can be opened, its metadata
+        read, and its dataset holds every image the metadata says it should
+    '''
+    try:
+        with extract_data.LPDFile(file_path) as lpd_file:
+            return lpd_file.dataset.shape[0] >= lpd_file.total_num_images
+    except (OSError, KeyError, ValueError, ET.ParseError):
+        # Files still being written may be locked, or not have (all of) their metadata yet
+        return False
+
+
+def is_analysed(output_path, filename, mtime):
+    ''' Returns whether the results of a file are saved in output_path, and are newer than the file
+    '''
+    results_filename = batch_analysis.get_results_filename(output_path, filename)
+    return os.path.exists(results_filename) and os.path.getmtime(results_filename) >= mtime
+
+
+class FolderWatcher():
+    ''' Polls data_path for .h5 files which have been completely written. A file is complete once
+        its size and modification time haven't changed for settle_time seconds and
+        is_file_complete() is True. Files which change after they've been taken are found again.
+        Files which can't be checked, or are still incomplete after incomplete_timeout seconds, are
+        given up on (see pop_failed_files()) until they change
+        since - if given, only files modified from this time (seconds since the epoch) are watched
+    '''
+
+    def __init__(self, data_path, settle_time=SETTLE_TIME, since=None,
+                 incomplete_timeout=INCOMPLETE_TIMEOUT):
+        self.data_path = data_path
+        self.settle_time = settle_time
+        self.since = since
+        self.incomplete_timeout = incomplete_timeout
+        # (size, mtime_ns, time it was first seen at that size and mtime) of each file being watched
+        self._file_states = {}
+        # (size, mtime_ns) of each file when it was taken or given up on
+        self._taken = {}
+        # (filename, error) of each file given up on since pop_failed_files() was last called
+        self._failed_files = []
+
+    def poll(self):
+        ''' Scan the directory once
+            Returns a list of (filename, mtime) of complete files not taken yet, oldest first
+        '''
+        now = time.time()
+        complete_files = []
+        file_states = {}
+        with os.scandir(self.data_path) as entries:
+            for entry in entries:
+                if not entry.name.endswith('.h5') or entry.name.startswith('.') or \
+                        not entry.is_file():
+                    continue
+                file_stat = entry.stat()
+                if self.since is not None and file_stat.st_mtime < self.since:
+                    continue
+                version = (file_stat.st_size, file_stat.st_mtime_ns)
+                if self._taken.get(entry.name) == version:
+                    continue
+
+                previous_state = self._file_states.get(entry.name)
+                if previous_state is not None and previous_state[:2] == version:
+                    stable_since = previous_state[2]
+                else:
+                    stable_since = now
+
+                if now - stable_since >= self.settle_time:
+                    try:
+                        complete = is_file_complete(entry.path)
+                    # A file that can't be checked (e.g. malformed metadata) only fails that file,
+                    # so watching carries on
+                    except Exception as error:
+                        self._give_up(entry.name, version, error)
+                        continue
+                    if complete:
+                        complete_files.append((entry.name, file_stat.st_mtime))
+                    elif now - stable_since >= self.incomplete_timeout:
+                        self._give_up(entry.name, version, ValueError(
+                            'File is incomplete - unchanged for {:.0f} s without every '
+                            'image'.format(now - stable_since)))
+                        continue
+                file_states[entry.name] = version + (stable_since, )
+
+        # Files which have been deleted are forgotten
+        self._file_states = file_states
+        complete_files.sort(key=lambda complete_file: complete_file[1])
+        return complete_files
+
+    def take(self, filename):
+        ''' Mark a file returned by poll() as taken, so it's not returned again unless it changes
+        '''
+        file_stat = os.stat(os.path.join(self.data_path, filename))
+        self._taken[filename] = (file_stat.st_size, file_stat.st_mtime_ns)
+        self._file_states.pop(filename, None)
+
+    def _give_up(self, filename, version, error):
+        ''' Stop checking a file until it changes from version (size, mtime_ns), recording why
+        '''
+        self._taken[filename] = version
+        self._failed_files.append((filename, error))
+
+    def pop_failed_files(self):
+        ''' Returns a list of (filename, error) of files given up on since this was last called
+        '''
+        failed_files = self._failed_files
+        self._failed_files = []
+        return failed_files
+
+
+def process_file(data_path, filename, output_path, create_report=False,
+                 memory_limit=extract_data.MEMORY_LIMIT):
+    ''' Analyse every tile of a data file, saving the results to output_path, and create its PDF
+        report if create_report is True. The file's preview is cached too, so it can be browsed
+        in the notebook straight away
+        Returns the results tables (16, 7, 3)
+    '''
+    # Paths of data files are formed by appending the filename to data_path
+    data_path = os.path.join(data_path, '')
+    results = batch_analysis.analyse_file(data_path, filename, output_path, memory_limit)
+    file_preview.get_preview(extract_data.get_lpd_filename(data_path, filename),
+                             memory_limit=memory_limit)
+    if create_report:
+        report_pages.create_file_report(data_path, filename, output_path,
+                                        memory_limit=memory_limit)
+    return results
+
+
+def watch_directory(data_path, output_path, create_report=False, max_workers=None,
+                    queue_size=QUEUE_SIZE, poll_interval=POLL_INTERVAL, settle_time=SETTLE_TIME,
+                    existing=False, memory_limit=extract_data.MEMORY_LIMIT,
+                    threshold_filename=None, dark_file_name=None, trends_filename=None,
+                    max_polls=None, pedestal_threshold_filename=None,
+                    incomplete_timeout=INCOMPLETE_TIMEOUT):
+    ''' Analyse each data file written to data_path until interrupted (Ctrl+C), or for max_polls
+        scans of the directory. Files are analysed in the order they were written
+        existing - also analyse files already in data_path that don't have up to date results in
+            output_path, otherwise only files modified after starting are analysed
+        incomplete_timeout - seconds a file can stay unchanged without every image before it's
+            recorded as failed
+        threshold_filename, dark_file_name, trends_filename, pedestal_threshold_filename - as for
+            batch_analysis.analyse_directory()
+        Returns a list of (filename, error) for any files which couldn't be analysed
+    '''
+    os.makedirs(output_path, exist_ok=True)
+    # Pedestal is calculated once here, then shared with the workers through its cache
+    batch_analysis.initialise_worker(threshold_filename, dark_file_name,
+                                     pedestal_threshold_filename)
+    watcher = FolderWatcher(data_path, settle_time, None if existing else time.time(),
+                            incomplete_timeout)
+
+    failed_files = []
+    pending = {}
+
+    def create_executor():
+        return ProcessPoolExecutor(max_workers=max_workers,
+                                   initializer=report_pages.initialise_worker,
+                                   initargs=(threshold_maps.get_map_filename(),
+                                             pedestal.get_dark_file_name(),
+                                             threshold_maps.get_map_filename(True)))
+
+    def collect(futures):
+        ''' Record the outcome of each finished analysis
+            Returns whether the pool of processes has broken
+        '''
+        pool_broken = False
+        for future in futures:
+            filename = pending.pop(future)
+            try:
+                future.result()
+                if trends_filename is not None:
+                    batch_analysis.store_trends(trends_filename, data_path, output_path,
+                                                [filename])
+                print('Analysed {}'.format(filename))
+            # Any error only fails this file, so watching carries on
+            except Exception as error:
+                failed_files.append((filename, error))
+                print('Could not analyse {}: {}'.format(filename, error))
+                pool_broken = pool_broken or isinstance(error, BrokenProcessPool)
+        return pool_broken
+
+    executor = create_executor()
+    try:
+        num_polls = 0
+        try:
+            while max_polls is None or num_polls < max_polls:
+                try:
+                    complete_files = watcher.poll()
+                # The directory may be briefly unavailable (e.g. a network share) - tried again at
+                # the next scan
+                except OSError as error:
+                    print('Could not scan {}: {}'.format(data_path, error))
+                    complete_files = []
+                for filename, error in watcher.pop_failed_files():
+                    failed_files.append((filename, error))
+                    print('Could not analyse {}: {}'.format(filename, error))
+
+                for filename, mtime in complete_files:
+                    if len(pending) >= queue_size:
+                        # Left for a later scan, once files in the queue have been analysed
+                        break
+                    watcher.take(filename)
+                    if is_analysed(output_path, filename, mtime):
+                        continue
+                    pending[executor.submit(process_file, data_path, filename, output_path,
+                                            create_report, memory_limit)] = filename
+                num_polls += 1
+
+                if pending:
+                    # Returns early if an analysis finishes, making room in the queue
+                    done, _ = wait(pending, timeout=poll_interval, return_when=FIRST_COMPLETED)
+                    if collect(done):
+                        # A worker died (e.g. killed for running out of memory), failing every
+                        # file in the pool - a new pool is started for the files still to come
+                        collect(wait(pending).done)
+                        executor.shutdown(wait=False)
+                        executor = create_executor()
+                        print('Restarted the pool of processes')
+                else:
+                    time.sleep(poll_interval)
+        except KeyboardInterrupt:
+            print('Stopping - waiting for {} file(s) being analysed'.format(len(pending)))
+
+        collect(wait(pending).done)
+    finally:
+        executor.shutdown()
+
+    return failed_files
+
+
+def parse_args():
+    ''' Parse command line arguments
+    '''
+    parser = argparse.ArgumentParser(
+        description='Analyse all tiles of each LPD data file as it is written to a directory')
+    parser.add_argument('data_path', help='Directory the .h5 data files are written to')
+    parser.add_argument('output_path', help='Directory the results and reports are saved to')
+    parser.add_argument('--existing', action='store_true',
+                        help='Also analyse files already in the directory without results')
+    parser.add_argument('--thresholds', default=None,
+                        help='Calibration file (.npy) of per-pixel thresholds to test against')
+    parser.add_argument('--dark-run', default=None,
+                        help='Dark run (.h5) whose pedestal is subtracted from the mean data')
+    parser.add_argument('--pedestal-thresholds', default=None,
+                        help='Calibration file (.npy) of per-pixel thresholds to test against '
+                        'when a dark run is given')
+    parser.add_argument('--trends', nargs='?', const=trend_store.TREND_STORE_FILENAME,
+                        default=None, help='Add the results to a trend store (.h5), {} if no file '
+                        'is given'.format(trend_store.TREND_STORE_FILENAME))
+    parser.add_argument('--reports', action='store_true', help='Create a PDF report for each file')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Number of processes to use (default: number of CPUs)')
+    parser.add_argument('--queue-size', type=int, default=QUEUE_SIZE,
+                        help='Maximum number of files waiting for or being analysed')
+    parser.add_argument('--poll-interval', type=float, default=POLL_INTERVAL,
+                        help='Seconds between scans of the directory')
+    parser.add_argument('--settle-time', type=float, default=SETTLE_TIME,
+                        help='Seconds a file must be unchanged before it is analysed')
+    parser.add_argument('--incomplete-timeout', type=float, default=INCOMPLETE_TIMEOUT,
+                        help='Seconds a file can be unchanged without every image before it is '
+                        'given up on')
+    parser.add_argument('--memory-limit', type=int, default=extract_data.MEMORY_LIMIT,
+                        help='Maximum bytes of image data each process reads at once')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    watch_directory(args.data_path, args.output_path, args.reports, args.workers,
+                    args.queue_size, args.poll_interval, args.settle_time, args.existing,
+                    args.memory_limit, args.thresholds, args.dark_run, args.trends,
+                    pedestal_threshold_filename=args.pedestal_thresholds,
+                    incomplete_timeout=args.incomplete_timeout)